@@ -0,0 +1,79 @@
+import click
+import sys
+import traceback
+from fileutilslib.classes.Bencher import get_registry
+from fileutilslib.misclib.benchtools import run_benchmarks, save_baseline, load_baseline, compare_baselines, \
+	format_comparison, DEFAULT_REPEAT, DEFAULT_THRESHOLD
+
+
+def print_result(name, stats):
+	print("{0:44} {1:>10.3f} ms median {2:>14.0f} items/s".format(name[0:44], stats["median_s"] * 1e3, stats["items_per_s"]))
+
+
+@click.group()
+def cli():
+	pass
+
+
+@cli.command()
+@click.option("--output", help="Write the results as JSON baseline to this file")
+@click.option("--only", multiple=True, help="Only run benchmarks whose names contain this (repeatable)")
+@click.option("--repeat", default=DEFAULT_REPEAT, help="Measured runs per benchmark")
+@click.option("--scale", default=1.0, help="Factor for the input sizes")
+@click.option("--workdir", help="Directory for the generated files (the copy benchmarks measure its disk)")
+@click.option("--profile", is_flag=True, help="Print the timings of the library sections as well")
+def run(output, only, repeat, scale, workdir, profile):
+	baseline = run_benchmarks(list(only), repeat, 1, scale, workdir, print_result)
+	if output is not None:
+		save_baseline(baseline, output)
+		print("Baseline written to '{}'".format(output))
+	if profile:
+		print("")
+		print(get_registry().dump_table())
+
+
+@cli.command()
+@click.argument("baseline")
+@click.option("--current", help="Compare this result file instead of running the suite")
+@click.option("--threshold", default=DEFAULT_THRESHOLD, help="Relative slowdown counted as regression (0.1 = 10 %)")
+@click.option("--only", multiple=True, help="Only run benchmarks whose names contain this (repeatable)")
+@click.option("--repeat", default=None, type=int, help="Measured runs per benchmark, defaults to the baseline's")
+@click.option("--scale", default=None, type=float, help="Factor for the input sizes, defaults to the baseline's")
+@click.option("--workdir", help="Directory for the generated files (the copy benchmarks measure its disk)")
+def compare(baseline, current, threshold, only, repeat, scale, workdir):
+	base = load_baseline(baseline)
+	meta = base["meta"]
+	if current is not None:
+		cur = load_baseline(current)
+	else:
+		cur = run_benchmarks(
+			list(only),
+			repeat if repeat is not None else meta.get("repeat", DEFAULT_REPEAT),
+			1,
+			scale if scale is not None else meta.get("scale", 1.0),
+			workdir,
+			print_result
+		)
+		print("")
+
+	for key in ("host", "machine", "python"):
+		if meta.get(key) != cur["meta"].get(key):
+			print("Note: The {} differs ('{}' vs. '{}'), timings may not be comparable".format(
+				key, meta.get(key), cur["meta"].get(key)
+			))
+
+	rows = compare_baselines(base, cur, threshold)
+	print(format_comparison(rows))
+	regressions = [r["name"] for r in rows if r["regression"]]
+	if len(regressions) > 0:
+		print("")
+		print("{} regression(s) beyond {:.0f} %: {}".format(len(regressions), threshold * 100, ", ".join(regressions)))
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	try:
+		cli()
+	except Exception as e:
+		traceback.print_exc()
+		sys.exit(2)
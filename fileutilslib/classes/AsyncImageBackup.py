@@ -0,0 +1,276 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Dict, List
+from fileutilslib.classes.ImageBackup import ImageBackup
+from fileutilslib.classes.ProgressTracker import ProgressEvent
+from fileutilslib.disklib.tunetools import device_bus
+
+DEFAULT_BUS_LIMIT = 2
+DEFAULT_MAX_JOBS = 32
+
+JOB_STATE_QUEUED = "queued"
+JOB_STATE_RUNNING = "running"
+JOB_STATE_DONE = "done"
+JOB_STATE_FAILED = "failed"
+JOB_STATE_CANCELLED = "cancelled"
+
+
+class AsyncImageJob:
+	"""
+	One imaging job of an AsyncImageBackup. Await wait() for the return code of start_dd() and iterate
+	the ProgressEvents with "async for event in job".
+	"""
+
+	_backup = None
+	""":type: ImageBackup"""
+
+	_bus = None
+	""":type: str"""
+
+	_state = None
+	""":type: str"""
+
+	_task = None
+	""":type: asyncio.Task"""
+
+	_subscribers = None
+	""":type: List[asyncio.Queue]"""
+
+	_last_event = None
+	""":type: ProgressEvent"""
+
+	def __init__(self, backup: ImageBackup, bus: str):
+		self._backup = backup
+		self._bus = bus
+		self._state = JOB_STATE_QUEUED
+		self._subscribers = []
+
+	def get_backup(self) -> ImageBackup:
+		return self._backup
+
+	def get_bus(self) -> str:
+		return self._bus
+
+	def get_state(self) -> str:
+		return self._state
+
+	def get_last_event(self) -> ProgressEvent:
+		return self._last_event
+
+	def done(self) -> bool:
+		return self._task is not None and self._task.done()
+
+	def _publish(self, event: ProgressEvent) -> None:
+		self._last_event = event
+		for q in self._subscribers:
+			q.put_nowait(event)
+
+	def _close(self) -> None:
+		# Wakes up iterators that won't see a final event (e.g. when cancelled while queued)
+		for q in self._subscribers:
+			q.put_nowait(None)
+
+	async def events(self) -> AsyncIterator[ProgressEvent]:
+		"""
+		Yields the ProgressEvents from now on until the job finished, failed or was cancelled
+		"""
+		if self.done():
+			return
+		q = asyncio.Queue()
+		self._subscribers.append(q)
+		try:
+			while True:
+				event = await q.get()
+				if event is None:
+					return
+				yield event
+				if event.is_final():
+					return
+		finally:
+			self._subscribers.remove(q)
+
+	def __aiter__(self) -> AsyncIterator[ProgressEvent]:
+		return self.events()
+
+	def cancel(self) -> None:
+		"""
+		Cancels the job. A running job is stopped by ImageBackup.cancel(), wait() then raises asyncio.CancelledError.
+		"""
+		if self.done():
+			return
+		if self._state == JOB_STATE_RUNNING:
+			self._state = JOB_STATE_CANCELLED
+			self._backup.cancel()
+		else:
+			self._state = JOB_STATE_CANCELLED
+			self._task.cancel()
+			# A task cancelled before its first step never reaches the cleanup of _run()
+			self._close()
+
+	async def wait(self) -> int:
+		"""
+		:return: The return code of ImageBackup.start_dd()
+		"""
+		return await asyncio.shield(self._task)
+
+
+class AsyncImageBackup:
+	"""
+	Runs the imaging jobs of many devices concurrently on one event loop. Each job runs ImageBackup.start_dd()
+	in a worker thread; how many jobs run at once on the same bus (USB root hub or storage controller,
+	see tunetools.device_bus) is limited, so devices sharing a controller don't slow each other down.
+	"""
+
+	_bus_limits = None
+	""":type: Dict[str, int]"""
+
+	_default_bus_limit = None
+	""":type: int"""
+
+	_semaphores = None
+	""":type: Dict[str, asyncio.Semaphore]"""
+
+	_executor = None
+	""":type: ThreadPoolExecutor"""
+
+	_jobs = None
+	""":type: List[AsyncImageJob]"""
+
+	def __init__(
+		self,
+		bus_limits: Dict[str, int] = None,
+		default_bus_limit: int = DEFAULT_BUS_LIMIT,
+		max_jobs: int = DEFAULT_MAX_JOBS
+	):
+		"""
+		:param bus_limits: Concurrent jobs per bus key (as returned by tunetools.device_bus)
+		:param default_bus_limit: Concurrent jobs on buses without an entry in bus_limits
+		:param max_jobs: Concurrent jobs in total (threads of the executor)
+		"""
+		if default_bus_limit < 1 or max_jobs < 1:
+			raise Exception("Job limits have to be at least 1")
+		self._bus_limits = dict(bus_limits) if bus_limits is not None else {}
+		self._default_bus_limit = default_bus_limit
+		self._semaphores = {}
+		self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+		self._jobs = []
+
+	def set_bus_limit(self, bus: str, limit: int) -> None:
+		"""
+		Only affects jobs on buses that had no job yet
+		"""
+		if limit < 1:
+			raise Exception("Job limits have to be at least 1")
+		self._bus_limits[bus] = limit
+
+	def get_bus_limit(self, bus: str) -> int:
+		return self._bus_limits.get(bus, self._default_bus_limit)
+
+	def _semaphore(self, bus: str) -> asyncio.Semaphore:
+		if bus not in self._semaphores:
+			self._semaphores[bus] = asyncio.Semaphore(self.get_bus_limit(bus))
+		return self._semaphores[bus]
+
+	def get_jobs(self) -> List[AsyncImageJob]:
+		return list(self._jobs)
+
+	def submit(
+		self,
+		backup: ImageBackup,
+		ddbatchsize: str = None,
+		native: bool = False,
+		resume: bool = False,
+		bus: str = None
+	) -> AsyncImageJob:
+		"""
+		Queues the imaging of a configured ImageBackup (device and image path set). Must be called
+		from a coroutine or callback of the running event loop.
+		:param ddbatchsize: See ImageBackup.start_dd
+		:param native: See ImageBackup.start_dd
+		:param resume: See ImageBackup.start_dd
+		:param bus: The bus key the job is limited by, determined from the device if None
+		"""
+		backup.assert_devicepath_is_valid()
+		if bus is None:
+			bus = device_bus(str(backup.get_devicepath().absolute()))
+		job = AsyncImageJob(backup, bus)
+		job._task = asyncio.get_running_loop().create_task(self._run(job, ddbatchsize, native, resume))
+		self._jobs.append(job)
+		return job
+
+	async def run(
+		self,
+		backup: ImageBackup,
+		ddbatchsize: str = None,
+		native: bool = False,
+		resume: bool = False,
+		bus: str = None
+	) -> int:
+		"""
+		Like submit(), but waits for the job
+		"""
+		return await self.submit(backup, ddbatchsize, native, resume, bus).wait()
+
+	async def _run(self, job: AsyncImageJob, ddbatchsize: str, native: bool, resume: bool) -> int:
+		loop = asyncio.get_running_loop()
+
+		def handle_event(event: ProgressEvent) -> None:
+			loop.call_soon_threadsafe(job._publish, event)
+
+		try:
+			async with self._semaphore(job.get_bus()):
+				job._state = JOB_STATE_RUNNING
+				future = loop.run_in_executor(
+					self._executor,
+					partial(
+						job.get_backup().start_dd,
+						False,
+						ddbatchsize,
+						None,
+						native,
+						resume,
+						handle_event,
+						False
+					)
+				)
+				try:
+					# Shielded, so the bus slot is only released once the thread has really stopped
+					retcode = await asyncio.shield(future)
+				except asyncio.CancelledError:
+					job._state = JOB_STATE_CANCELLED
+					job.get_backup().cancel()
+					await asyncio.wait([future])
+					raise
+				# Lets the events the thread scheduled last reach the subscribers
+				await asyncio.sleep(0)
+		except asyncio.CancelledError:
+			job._state = JOB_STATE_CANCELLED
+			raise
+		except BaseException:
+			job._state = JOB_STATE_FAILED
+			raise
+		finally:
+			job._close()
+
+		if job.get_state() == JOB_STATE_CANCELLED:
+			raise asyncio.CancelledError()
+		job._state = JOB_STATE_DONE
+		return retcode
+
+	async def wait_all(self) -> List:
+		"""
+		Waits for all submitted jobs
+		:return: The return codes, or the exceptions of jobs that failed or were cancelled
+		"""
+		return await asyncio.gather(*[j._task for j in self._jobs], return_exceptions=True)
+
+	def cancel_all(self) -> None:
+		for job in self._jobs:
+			job.cancel()
+
+	def close(self) -> None:
+		"""
+		Shuts down the worker threads once all jobs are done
+		"""
+		self._executor.shutdown(wait=False)
@@ -0,0 +1,326 @@
+from os import statvfs, stat
+from os.path import dirname, abspath
+from threading import Thread, Condition, Lock
+from typing import Dict, List, Tuple
+from fileutilslib.classes.ImageBackup import ImageBackup
+from fileutilslib.disklib.filetools import find_mount_point, sizeinfo_from_statvfs_result
+from fileutilslib.disklib.tunetools import device_disk, device_bus
+
+JOB_STATE_PENDING = "pending"
+JOB_STATE_RUNNING = "running"
+JOB_STATE_DONE = "done"
+JOB_STATE_FAILED = "failed"
+
+
+class SpaceReservations:
+	"""
+	Bookkeeping of the target space promised to running jobs, per mount point. A reservation shrinks while
+	its image grows, because the written part is already missing from the free space statvfs reports.
+	"""
+
+	_reservations = None
+	""":type: Dict[str, Dict[str, int]]"""
+
+	_margin = None
+	""":type: int"""
+
+	def __init__(self, safe_free_targetspace_margin: int = None):
+		"""
+		:param safe_free_targetspace_margin: Bytes that have to stay free on each mount point
+		"""
+		sf = safe_free_targetspace_margin
+		self._margin = 0 if (sf is None or sf < 0) else sf
+		self._reservations = {}
+		self._lock = Lock()
+
+	@staticmethod
+	def _allocated(imagepath: str) -> int:
+		try:
+			return stat(imagepath).st_blocks * 512
+		except FileNotFoundError:
+			return 0
+
+	@staticmethod
+	def mount_point(imagepath: str) -> str:
+		# The image usually doesn't exist yet
+		return find_mount_point(dirname(abspath(imagepath)))
+
+	def _outstanding(self, mountpoint: str) -> int:
+		return sum(
+			max(0, size_b - self._allocated(p)) for (p, size_b) in self._reservations.get(mountpoint, {}).items()
+		)
+
+	def get_available(self, mountpoint: str) -> int:
+		"""
+		:return: Free bytes of the mount point minus margin and outstanding reservations
+		"""
+		with self._lock:
+			free = sizeinfo_from_statvfs_result(statvfs(mountpoint))["free"]
+			return free - self._margin - self._outstanding(mountpoint)
+
+	def reserve(self, imagepath: str, size_b: int) -> bool:
+		"""
+		Atomically checks the space on the image's mount point and reserves size_b bytes for it
+		:return: False if there isn't enough space left
+		"""
+		mp = self.mount_point(imagepath)
+		with self._lock:
+			free = sizeinfo_from_statvfs_result(statvfs(mp))["free"]
+			# The image may exist from an earlier (resumed) run and only needs the rest
+			needed = max(0, size_b - self._allocated(imagepath))
+			if free - self._margin - self._outstanding(mp) <= needed:
+				return False
+			self._reservations.setdefault(mp, {})[abspath(imagepath)] = size_b
+			return True
+
+	def release(self, imagepath: str) -> None:
+		mp = self.mount_point(imagepath)
+		with self._lock:
+			reservations = self._reservations.get(mp, {})
+			reservations.pop(abspath(imagepath), None)
+			if len(reservations) == 0:
+				self._reservations.pop(mp, None)
+
+	def get_reserved(self) -> Dict[str, int]:
+		"""
+		:return: The outstanding reserved bytes per mount point
+		"""
+		with self._lock:
+			return {mp: self._outstanding(mp) for mp in self._reservations}
+
+
+class BackupJob:
+	"""
+	An imaging job queued in a BackupScheduler
+	"""
+
+	_backup = None
+	""":type: ImageBackup"""
+
+	_start_args = None
+	""":type: Dict"""
+
+	_size_b = None
+	""":type: int"""
+
+	_disk = None
+	""":type: str"""
+
+	_bus = None
+	""":type: str"""
+
+	_state = None
+	""":type: str"""
+
+	_retcode = None
+	""":type: int"""
+
+	_error = None
+	""":type: BaseException"""
+
+	def __init__(self, backup: ImageBackup, start_args: Dict):
+		devpath = str(backup.get_devicepath().absolute())
+		self._backup = backup
+		self._start_args = start_args
+		size_b = backup.get_target_image_ondisk_sizebytes()
+		# Sources of unknown size reserve nothing, a full target then fails the copy instead of the submit
+		self._size_b = size_b if size_b is not None else 0
+		self._disk = device_disk(devpath)
+		self._bus = device_bus(devpath)
+		self._state = JOB_STATE_PENDING
+		self._finished = Condition()
+
+	def get_backup(self) -> ImageBackup:
+		return self._backup
+
+	def get_imagepath(self) -> str:
+		return str(self._backup.get_imagepath().absolute())
+
+	def get_size_b(self) -> int:
+		return self._size_b
+
+	def get_disk(self) -> str:
+		return self._disk
+
+	def get_bus(self) -> str:
+		return self._bus
+
+	def get_state(self) -> str:
+		return self._state
+
+	def get_retcode(self) -> int:
+		return self._retcode
+
+	def get_error(self) -> BaseException:
+		return self._error
+
+	def _finish(self, state: str, retcode: int = None, error: BaseException = None) -> None:
+		with self._finished:
+			self._state = state
+			self._retcode = retcode
+			self._error = error
+			self._finished.notify_all()
+
+	def wait(self, timeout: float = None) -> bool:
+		"""
+		:return: False if the job is still pending or running after timeout seconds
+		"""
+		with self._finished:
+			return self._finished.wait_for(
+				lambda: self._state == JOB_STATE_DONE or self._state == JOB_STATE_FAILED, timeout
+			)
+
+
+class BackupScheduler:
+	"""
+	Queues imaging jobs and runs as many at once as the targets have space for. Target space is reserved
+	per mount point before a job starts (see SpaceReservations), so concurrent jobs can't run out of space
+	together. Source disks are read by one job at a time, as parallel reads of one disk mostly add seeks.
+	Among the startable jobs the one on the least busy bus is started first, then the largest.
+	"""
+
+	_max_jobs = None
+	""":type: int"""
+
+	_bus_limit = None
+	""":type: int"""
+
+	_reservations = None
+	""":type: SpaceReservations"""
+
+	_jobs = None
+	""":type: List[BackupJob]"""
+
+	def __init__(self, max_jobs: int = 4, bus_limit: int = 2, safe_free_targetspace_margin: int = None):
+		"""
+		:param max_jobs: Jobs running at once in total
+		:param bus_limit: Jobs running at once on one bus (see tunetools.device_bus)
+		:param safe_free_targetspace_margin: Bytes that have to stay free on each target mount point
+		"""
+		if max_jobs < 1 or bus_limit < 1:
+			raise Exception("Job limits have to be at least 1")
+		self._max_jobs = max_jobs
+		self._bus_limit = bus_limit
+		self._reservations = SpaceReservations(safe_free_targetspace_margin)
+		self._jobs = []
+		self._changed = Condition()
+
+	def get_reservations(self) -> SpaceReservations:
+		return self._reservations
+
+	def get_jobs(self) -> List[BackupJob]:
+		return list(self._jobs)
+
+	def add(
+		self,
+		backup: ImageBackup,
+		ddbatchsize: str = None,
+		native: bool = False,
+		resume: bool = False
+	) -> BackupJob:
+		"""
+		Queues the imaging of a configured ImageBackup (device and image path set)
+		:param ddbatchsize: See ImageBackup.start_dd
+		:param native: See ImageBackup.start_dd
+		:param resume: See ImageBackup.start_dd
+		"""
+		backup.assert_devicepath_is_valid()
+		imagepath = str(backup.get_imagepath().absolute())
+		with self._changed:
+			for j in self._jobs:
+				if j.get_imagepath() == imagepath and (
+					j.get_state() == JOB_STATE_PENDING or j.get_state() == JOB_STATE_RUNNING
+				):
+					raise Exception("Image '{}' is already queued".format(imagepath))
+			job = BackupJob(backup, {"ddbatchsize": ddbatchsize, "native": native, "resume": resume})
+			self._jobs.append(job)
+			self._changed.notify_all()
+		return job
+
+	def _running(self) -> List[BackupJob]:
+		return [j for j in self._jobs if j.get_state() == JOB_STATE_RUNNING]
+
+	def _pending(self) -> List[BackupJob]:
+		return [j for j in self._jobs if j.get_state() == JOB_STATE_PENDING]
+
+	def _candidates(self) -> List[BackupJob]:
+		running = self._running()
+		if len(running) >= self._max_jobs:
+			return []
+		busy_disks = set(j.get_disk() for j in running)
+		bus_load = {}
+		for j in running:
+			bus_load[j.get_bus()] = bus_load.get(j.get_bus(), 0) + 1
+
+		candidates = [
+			j for j in self._pending()
+			if j.get_disk() not in busy_disks and bus_load.get(j.get_bus(), 0) < self._bus_limit
+		]
+
+		def priority(j: BackupJob) -> Tuple[int, int]:
+			return bus_load.get(j.get_bus(), 0), -j.get_size_b()
+
+		return sorted(candidates, key=priority)
+
+	def _run_job(self, job: BackupJob) -> None:
+		try:
+			retcode = job.get_backup().start_dd(confirm=False, **job._start_args)
+			state = (JOB_STATE_DONE, retcode, None)
+		except BaseException as e:
+			state = (JOB_STATE_FAILED, None, e)
+		self._reservations.release(job.get_imagepath())
+		with self._changed:
+			job._finish(*state)
+			self._changed.notify_all()
+
+	def _dispatch(self) -> bool:
+		"""
+		Starts the next startable job
+		:return: False if no job could be started
+		"""
+		for job in self._candidates():
+			if not self._reservations.reserve(job.get_imagepath(), job.get_size_b()):
+				continue
+			job._state = JOB_STATE_RUNNING
+			Thread(target=self._run_job, args=(job,), daemon=True).start()
+			return True
+		return False
+
+	def run(self) -> List[BackupJob]:
+		"""
+		Runs the queued jobs (jobs may be added from other threads meanwhile) and returns when all are finished.
+		Jobs that don't fit on their target even when nothing else runs fail with an exception.
+		:return: All jobs of the scheduler
+		"""
+		with self._changed:
+			while True:
+				while self._dispatch():
+					pass
+
+				pending = self._pending()
+				if len(self._running()) == 0:
+					if len(pending) == 0:
+						break
+					# Nothing runs, so nothing will free or use up space any more
+					for job in pending:
+						job._finish(JOB_STATE_FAILED, None, Exception(
+							"There is not enough free space to create the image '{}'".format(job.get_imagepath())
+						))
+					continue
+
+				# Woken up by finished or added jobs; the timeout re-checks space freed by others
+				self._changed.wait(5.0)
+
+		return self.get_jobs()
+
+	def cancel_all(self) -> None:
+		"""
+		Cancels the running jobs (see ImageBackup.cancel) and removes the pending ones
+		"""
+		with self._changed:
+			for job in self._jobs:
+				if job.get_state() == JOB_STATE_RUNNING:
+					job.get_backup().cancel()
+				elif job.get_state() == JOB_STATE_PENDING:
+					job._finish(JOB_STATE_FAILED, None, Exception("Cancelled"))
+			self._changed.notify_all()
@@ -1,26 +1,289 @@
-from datetime import datetime
+import json
+import math
+import random
+import threading
+from datetime import timedelta
+from functools import wraps
+from time import perf_counter_ns
+from typing import Callable, Dict, List
+
+DEFAULT_MAX_SAMPLES = 10000
+
+_local = threading.local()
+
+
+def _stack() -> List[str]:
+	stack = getattr(_local, "stack", None)
+	if stack is None:
+		stack = _local.stack = []
+	return stack
+
+
+class BenchStats:
+	"""
+	The timings of one section. Beyond max_samples the kept samples are a uniform random subset
+	(reservoir sampling), so percentiles stay representative at constant memory.
+	"""
+
+	__slots__ = ("path", "count", "total_ns", "min_ns", "max_ns", "samples", "max_samples")
+
+	def __init__(self, path: str, max_samples: int = DEFAULT_MAX_SAMPLES):
+		self.path = path
+		self.count = 0
+		self.total_ns = 0
+		self.min_ns = None
+		self.max_ns = None
+		self.samples = []
+		self.max_samples = max_samples
+
+	def add(self, ns: int) -> None:
+		self.count += 1
+		self.total_ns += ns
+		if self.min_ns is None or ns < self.min_ns:
+			self.min_ns = ns
+		if self.max_ns is None or ns > self.max_ns:
+			self.max_ns = ns
+		if len(self.samples) < self.max_samples:
+			self.samples.append(ns)
+		else:
+			i = random.randrange(self.count)
+			if i < self.max_samples:
+				self.samples[i] = ns
+
+	def percentile(self, p: float) -> int:
+		"""
+		:param p: 0 to 100
+		:return: The nearest-rank percentile in nanoseconds
+		"""
+		if len(self.samples) == 0:
+			return 0
+		ordered = sorted(self.samples)
+		rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+		return ordered[rank]
+
+	def to_dict(self) -> Dict:
+		"""
+		:return: count and seconds for total, mean, min, median, p95 and max
+		"""
+		return {
+			"count": self.count,
+			"total_s": self.total_ns / 1e9,
+			"mean_s": (self.total_ns / self.count / 1e9) if self.count > 0 else 0.0,
+			"min_s": (self.min_ns or 0) / 1e9,
+			"median_s": self.percentile(50) / 1e9,
+			"p95_s": self.percentile(95) / 1e9,
+			"max_s": (self.max_ns or 0) / 1e9
+		}
+
+
+class BenchRegistry:
+	"""
+	Collects the timings of named Benchers by section path ("outer/inner" for nested sections)
+	"""
+
+	_stats = None
+	""":type: Dict[str, BenchStats]"""
+
+	_enabled = None
+	""":type: bool"""
+
+	_max_samples = None
+	""":type: int"""
+
+	def __init__(self, enabled: bool = True, max_samples: int = DEFAULT_MAX_SAMPLES):
+		self._stats = {}
+		self._enabled = enabled
+		self._max_samples = max_samples
+		self._lock = threading.Lock()
+
+	def is_enabled(self) -> bool:
+		return self._enabled
+
+	def set_enabled(self, enabled: bool) -> None:
+		"""
+		A disabled registry records nothing and decorated functions are called directly
+		"""
+		self._enabled = enabled
+
+	def record(self, path: str, ns: int) -> None:
+		with self._lock:
+			stats = self._stats.get(path)
+			if stats is None:
+				stats = self._stats[path] = BenchStats(path, self._max_samples)
+			stats.add(ns)
+
+	def get_stats(self, path: str) -> BenchStats:
+		return self._stats.get(path)
+
+	def stats(self) -> Dict[str, Dict]:
+		with self._lock:
+			return {path: s.to_dict() for (path, s) in sorted(self._stats.items())}
+
+	def reset(self) -> None:
+		with self._lock:
+			self._stats = {}
+
+	def dump_table(self) -> str:
+		"""
+		:return: The statistics of all sections as text table, nested sections indented below their parents
+		"""
+		header = "{0:40} {1:>8} {2:>11} {3:>11} {4:>11} {5:>11} {6:>11} {7:>11}".format(
+			"Section", "Count", "Total", "Mean", "Min", "Median", "P95", "Max"
+		)
+		lines = [header, "-" * len(header)]
+		for (path, s) in self.stats().items():
+			depth = path.count("/")
+			lines.append("{0:40} {1:>8} {2:>11} {3:>11} {4:>11} {5:>11} {6:>11} {7:>11}".format(
+				("  " * depth + path.rsplit("/", 1)[-1])[0:40],
+				s["count"],
+				_format_seconds(s["total_s"]),
+				_format_seconds(s["mean_s"]),
+				_format_seconds(s["min_s"]),
+				_format_seconds(s["median_s"]),
+				_format_seconds(s["p95_s"]),
+				_format_seconds(s["max_s"])
+			))
+		return "\n".join(lines)
+
+	def dump_json(self, path: str = None) -> str:
+		"""
+		:param path: Also write the JSON to this file
+		:return: The statistics of all sections as JSON object keyed by section path
+		"""
+		data = json.dumps(self.stats(), indent=2)
+		if path is not None:
+			with open(path, "w") as f:
+				f.write(data)
+		return data
+
+
+def _format_seconds(secs: float) -> str:
+	if secs >= 1:
+		return "{:.3f} s".format(secs)
+	if secs >= 0.001:
+		return "{:.3f} ms".format(secs * 1e3)
+	return "{:.3f} us".format(secs * 1e6)
+
+
+_registry = BenchRegistry()
+
+
+def get_registry() -> BenchRegistry:
+	return _registry
 
 
 class Bencher:
-	_d1 = None
-	_d2 = None
+	"""
+	Measures intervals with perf_counter_ns (monotonic, unaffected by clock changes).
+	Named Benchers record into a registry (the global one by default) and nest: a section started while
+	another runs on the same thread is recorded as "outer/inner". Use it as context manager
+	("with Bencher('copy'):"), as decorator ("@Bencher('copy')") or with startbench() and endbench().
+	"""
+
+	_t1 = None
+	""":type: int"""
+
+	_t2 = None
+	""":type: int"""
 
-	def __init__(self):
-		pass
+	_name = None
+	""":type: str"""
+
+	_registry = None
+	""":type: BenchRegistry"""
+
+	_path = None
+	""":type: str"""
+
+	def __init__(self, name: str = None, registry: BenchRegistry = None):
+		"""
+		:param name: The section name, None for a plain stopwatch that records nothing
+		:param registry: Where the timings are recorded, defaults to get_registry()
+		"""
+		self._name = name
+		self._registry = registry if registry is not None else _registry
 
 	def _assert_bench_ran(self):
-		if self._d1 is None or self._d2 is None:
+		if self._t1 is None or self._t2 is None:
 			raise Exception("startbench() or endbench() hasn't been called")
 
+	def get_path(self) -> str:
+		return self._path
+
 	def startbench(self):
-		self._d1 = datetime.now()
+		self._t2 = None
+		if self._name is not None and self._registry.is_enabled():
+			stack = _stack()
+			self._path = stack[-1] + "/" + self._name if len(stack) > 0 else self._name
+			stack.append(self._path)
+		else:
+			self._path = None
+		self._t1 = perf_counter_ns()
 
 	def endbench(self):
-		self._d2 = datetime.now()
+		self._t2 = perf_counter_ns()
+		if self._path is not None:
+			stack = _stack()
+			if len(stack) > 0 and stack[-1] == self._path:
+				stack.pop()
+			elif self._path in stack:
+				stack.remove(self._path)
+			self._registry.record(self._path, self._t2 - self._t1)
 
-	def get_result(self):
+	def get_result_ns(self) -> int:
 		self._assert_bench_ran()
-		return self._d2 - self._d1
+		return self._t2 - self._t1
+
+	def get_result(self) -> timedelta:
+		return timedelta(microseconds=self.get_result_ns() / 1000)
+
+	def get_result_seconds(self) -> float:
+		return self.get_result_ns() / 1e9
+
+	def __enter__(self):
+		self.startbench()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.endbench()
+		return False
+
+	def __call__(self, func: Callable) -> Callable:
+		name = self._name if self._name is not None else func.__qualname__
+		registry = self._registry
+
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			if not registry.is_enabled():
+				return func(*args, **kwargs)
+			with Bencher(name, registry):
+				return func(*args, **kwargs)
+
+		return wrapper
 
-	def get_result_seconds(self):
-		return (self._d2 - self._d1).total_seconds()
\ No newline at end of file
+	@staticmethod
+	def repeat(func: Callable, repeat: int = 10, warmup: int = 1, name: str = None, registry: BenchRegistry = None) -> Dict:
+		"""
+		Runs func several times and records each run
+		:param func: Called without arguments
+		:param repeat: Measured runs
+		:param warmup: Unmeasured runs before (caches, imports)
+		:param name: The section name, defaults to the name of func
+		:param registry: Defaults to get_registry()
+		:return: The statistics of these runs (see BenchStats.to_dict)
+		"""
+		reg = BenchRegistry(True, max(repeat, 1))
+		target = registry if registry is not None else _registry
+		n = name if name is not None else getattr(func, "__qualname__", "repeat")
+		for _ in range(warmup):
+			func()
+		for _ in range(repeat):
+			b = Bencher(n, reg)
+			b.startbench()
+			try:
+				func()
+			finally:
+				b.endbench()
+			if target.is_enabled():
+				target.record(b.get_path(), b.get_result_ns())
+		return reg.stats()[b.get_path()] if repeat > 0 else BenchStats(n).to_dict()
@@ -0,0 +1,374 @@
+import fcntl
+import hashlib
+import json
+import os
+import random
+import threading
+from contextlib import contextmanager
+from os import O_RDONLY, O_WRONLY, O_CREAT, O_TRUNC, SEEK_SET, lseek
+from os.path import abspath, isfile, join, getsize
+from typing import Callable, Dict, List, Iterator, Tuple
+from fileutilslib.classes.Bencher import Bencher
+from fileutilslib.disklib.copytools import fd_size, blocksize_to_bytes, timed_io, IO_READ, IO_WRITE
+from fileutilslib.disklib.filetools import walk_flat
+
+CHUNKING_FIXED = "fixed"
+CHUNKING_CDC = "cdc"
+
+_STORE_VERSION = 1
+_CONFIG_FILE = "store.json"
+_REGISTRY_FILE = "recipes.list"
+_LOCK_FILE = "store.lock"
+_CHUNK_DIR = "chunks"
+
+# 64-bit gear table for content-defined chunking. It is seeded, because chunk boundaries (and therefore
+# deduplication) must stay stable across processes and versions.
+_GEAR_RNG = random.Random(0x6765617200)
+_GEAR = [_GEAR_RNG.getrandbits(64) for _ in range(256)]
+_U64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _cdc_boundaries(data: bytes, min_size: int, avg_bits: int, max_size: int) -> Iterator[int]:
+	# Gear hash chunking as in FastCDC: A boundary is set where the highest avg_bits bits of the hash are 0.
+	# Pure Python, so it is CPU-bound at a few MB/s (see ChunkStore).
+	mask = ((1 << avg_bits) - 1) << (64 - avg_bits)
+	gear = _GEAR
+	u64 = _U64
+	mv = memoryview(data)
+	n = len(data)
+	start = 0
+	while start < n:
+		end = min(start + max_size, n)
+		i = start + min_size
+		h = 0
+		cut = end
+		for b in mv[i:end]:
+			h = ((h << 1) + gear[b]) & u64
+			i += 1
+			if not h & mask:
+				cut = i
+				break
+		yield cut
+		start = cut
+
+
+class ChunkStore:
+	"""
+	Content-addressed store for images: Images are split into chunks (fixed or content-defined boundaries),
+	every unique chunk is stored once under its hash and an image is reduced to a small recipe file,
+	which lists the hashes of its chunks. Storage and write volume therefore scale with unique data.
+	Content-defined chunking finds the boundaries in Python at a few MB/s, which only suits files where
+	insertions shift the data; images of devices dedup as well with fixed chunks, which run at disk speed.
+	Several processes can write images into one store, gc() waits until they are done.
+	"""
+
+	_rootpath = None
+	""":type: str"""
+
+	_config = None
+	""":type: Dict"""
+
+	def __init__(
+		self,
+		rootpath: str,
+		chunking: str = CHUNKING_FIXED,
+		chunk_size: str = "1M",
+		hash_name: str = "sha256"
+	):
+		"""
+		Opens the store at rootpath or creates it. The chunking parameters are only used on creation,
+		as chunks written with different parameters wouldn't deduplicate.
+		:param rootpath: The directory of the store
+		:param chunking: CHUNKING_FIXED or CHUNKING_CDC (average chunk size is chunk_size, min 1/4, max 4x,
+		see the class description)
+		:param chunk_size: dd-style (average) chunk size
+		:param hash_name: A hashlib algorithm
+		"""
+		self._rootpath = abspath(rootpath)
+		configpath = join(self._rootpath, _CONFIG_FILE)
+
+		if isfile(configpath):
+			with open(configpath, "r") as f:
+				self._config = json.load(f)
+			if self._config.get("version") != _STORE_VERSION:
+				raise Exception("Unsupported chunk store version in '{}'".format(configpath))
+		else:
+			if chunking != CHUNKING_FIXED and chunking != CHUNKING_CDC:
+				raise Exception("Unknown chunking '{}'".format(chunking))
+			cs = blocksize_to_bytes(chunk_size)
+			if chunking == CHUNKING_CDC and cs & (cs - 1) != 0:
+				raise Exception("The average chunk size for content-defined chunking has to be a power of 2")
+			hashlib.new(hash_name)
+			self._config = {
+				"version": _STORE_VERSION,
+				"chunking": chunking,
+				"chunk_size": cs,
+				"hash": hash_name
+			}
+			os.makedirs(join(self._rootpath, _CHUNK_DIR), exist_ok=True)
+			with open(configpath, "w") as f:
+				json.dump(self._config, f)
+
+	def get_rootpath(self) -> str:
+		return self._rootpath
+
+	def get_config(self) -> Dict:
+		return dict(self._config)
+
+	@contextmanager
+	def _locked(self, exclusive: bool):
+		"""
+		Holds the lock of the store: shared while images are written (they reuse chunks before their recipe is
+		registered), exclusive while gc() decides which chunks are unreferenced and rewrites the registry
+		"""
+		fd = os.open(join(self._rootpath, _LOCK_FILE), O_WRONLY | O_CREAT, 0o644)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+			yield
+		finally:
+			os.close(fd)
+
+	def _chunkpath(self, digest: str) -> str:
+		return join(self._rootpath, _CHUNK_DIR, digest[0:2], digest)
+
+	def has_chunk(self, digest: str) -> bool:
+		return isfile(self._chunkpath(digest))
+
+	def put_chunk(self, data) -> Tuple[str, bool]:
+		"""
+		Stores a chunk unless it exists
+		:return: The digest and True if the chunk was new
+		"""
+		digest = hashlib.new(self._config["hash"], data).hexdigest()
+		cp = self._chunkpath(digest)
+		if isfile(cp):
+			return digest, False
+		os.makedirs(join(self._rootpath, _CHUNK_DIR, digest[0:2]), exist_ok=True)
+		# Jobs of one process (e.g. of a BackupScheduler) can store the same chunk at the same time
+		tmp = "{}.{}.{}.tmp".format(cp, os.getpid(), threading.get_ident())
+		with open(tmp, "wb") as f:
+			timed_io(IO_WRITE, f.write, data)
+		os.replace(tmp, cp)
+		return digest, True
+
+	def get_chunk(self, digest: str) -> bytes:
+		cp = self._chunkpath(digest)
+		if not isfile(cp):
+			raise Exception("Chunk '{}' is missing in store '{}'".format(digest, self._rootpath))
+		with open(cp, "rb") as f:
+			return f.read()
+
+	def _chunks(self, fd: int, size: int) -> Iterator[bytes]:
+		cs = self._config["chunk_size"]
+		lseek(fd, 0, SEEK_SET)
+		if self._config["chunking"] == CHUNKING_FIXED:
+			pos = 0
+			while pos < size:
+				data = timed_io(IO_READ, os.read, fd, min(cs, size - pos))
+				if len(data) == 0:
+					break
+				pos += len(data)
+				yield data
+		else:
+			# Boundaries are searched in windows of several max-sized chunks; the unfinished
+			# last chunk of a window is carried over into the next one
+			max_size = cs * 4
+			window = max_size * 8
+			carry = b""
+			pos = 0
+			while True:
+				data = timed_io(IO_READ, os.read, fd, min(window, size - pos)) if pos < size else b""
+				pos += len(data)
+				eof = len(data) == 0
+				buf = carry + data
+				if len(buf) == 0:
+					break
+				start = 0
+				for cut in _cdc_boundaries(buf, cs // 4, cs.bit_length() - 1, max_size):
+					if cut == len(buf) and not eof:
+						break
+					yield buf[start:cut]
+					start = cut
+				carry = buf[start:]
+				if eof:
+					break
+
+	def _register(self, recipepath: str) -> None:
+		rp = abspath(recipepath)
+		if rp not in self._registered_recipes():
+			with open(join(self._rootpath, _REGISTRY_FILE), "a") as f:
+				f.write(rp + "\n")
+
+	def _registered_recipes(self) -> List[str]:
+		registry = join(self._rootpath, _REGISTRY_FILE)
+		if not isfile(registry):
+			return []
+		with open(registry, "r") as f:
+			return [line.rstrip("\n") for line in f if len(line.strip()) > 0]
+
+	@Bencher("ChunkStore.write_image")
+	def write_image(
+		self,
+		srcpath: str,
+		recipepath: str,
+		progress_handler: Callable = None,
+		block_handler: Callable = None
+	) -> Dict:
+		"""
+		Stores a device or image file in the store and writes its recipe
+		:param srcpath: The device or image to store
+		:param recipepath: The recipe file to create (it stands in for the image)
+		:param progress_handler: Called with (processed_bytes, total_bytes) after each chunk
+		:param block_handler: Called with (offset, data) for each chunk in order
+		:return: A dict with the image size ("size_b"), its number of chunks ("chunks"),
+		the number of new chunks ("new_chunks") and the bytes actually written to the store ("new_b")
+		"""
+		chunks = []
+		new_chunks = 0
+		new_b = 0
+		processed = 0
+
+		with self._locked(False):
+			fd = os.open(srcpath, O_RDONLY)
+			try:
+				size = fd_size(fd)
+				for data in self._chunks(fd, size):
+					if block_handler is not None:
+						block_handler(processed, data)
+					(digest, isnew) = self.put_chunk(data)
+					chunks.append([digest, len(data)])
+					processed += len(data)
+					if isnew:
+						new_chunks += 1
+						new_b += len(data)
+					if progress_handler is not None:
+						progress_handler(processed, size)
+			finally:
+				os.close(fd)
+
+			recipe = {
+				"version": _STORE_VERSION,
+				"store": self._rootpath,
+				"hash": self._config["hash"],
+				"size_b": processed,
+				"chunks": chunks
+			}
+			tmp = recipepath + ".tmp"
+			with open(tmp, "w") as f:
+				json.dump(recipe, f)
+			os.replace(tmp, recipepath)
+			self._register(recipepath)
+
+		return {
+			"size_b": processed,
+			"chunks": len(chunks),
+			"new_chunks": new_chunks,
+			"new_b": new_b
+		}
+
+	def load_recipe(self, recipepath: str) -> Dict:
+		with open(recipepath, "r") as f:
+			recipe = json.load(f)
+		if recipe.get("version") != _STORE_VERSION or recipe.get("hash") != self._config["hash"]:
+			raise Exception("'{}' is not a recipe of this chunk store".format(recipepath))
+		return recipe
+
+	@Bencher("ChunkStore.read_image")
+	def read_image(
+		self,
+		recipepath: str,
+		outputpath: str,
+		truncate: bool = True,
+		progress_handler: Callable = None
+	) -> int:
+		"""
+		Reassembles the image of a recipe into a file or onto a device
+		:param truncate: Truncate the target first (set to False when writing to devices)
+		:param progress_handler: Called with (written_bytes, total_bytes) after each chunk
+		:return: The number of bytes written
+		"""
+		recipe = self.load_recipe(recipepath)
+		written = 0
+		fd = os.open(outputpath, O_WRONLY | O_CREAT | (O_TRUNC if truncate else 0), 0o644)
+		try:
+			for (digest, length) in recipe["chunks"]:
+				mv = memoryview(self.get_chunk(digest))
+				if len(mv) != length:
+					raise Exception("Chunk '{}' has the wrong length".format(digest))
+				while len(mv) > 0:
+					mv = mv[timed_io(IO_WRITE, os.write, fd, mv):]
+				written += length
+				if progress_handler is not None:
+					progress_handler(written, recipe["size_b"])
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+		return written
+
+	def iter_chunkfiles(self) -> Iterator[str]:
+		chunkdir = join(self._rootpath, _CHUNK_DIR)
+		for sub in walk_flat(chunkdir, onlydirs=True, yieldresults=True):
+			for digest in walk_flat(join(chunkdir, sub), onlyfiles=True, yieldresults=True):
+				if not digest.endswith(".tmp"):
+					yield digest
+
+	def _referenced(self) -> Tuple[List[str], Dict]:
+		recipes = [r for r in self._registered_recipes() if isfile(r)]
+		referenced = {}
+		for r in recipes:
+			for (digest, length) in self.load_recipe(r)["chunks"]:
+				referenced[digest] = referenced.get(digest, 0) + length
+		return recipes, referenced
+
+	def gc(self) -> Dict:
+		"""
+		Deletes all chunks no registered recipe refers to. Removing an image from the store
+		is done by deleting its recipe file and calling gc(). Waits for images being written to the store.
+		:return: A dict with the number of deleted chunks ("chunks") and freed bytes ("size_b")
+		"""
+		deleted = 0
+		freed = 0
+
+		with self._locked(True):
+			(recipes, referenced) = self._referenced()
+
+			for digest in list(self.iter_chunkfiles()):
+				if digest not in referenced:
+					cp = self._chunkpath(digest)
+					freed += getsize(cp)
+					os.remove(cp)
+					deleted += 1
+
+			registry = join(self._rootpath, _REGISTRY_FILE)
+			tmp = registry + ".tmp"
+			with open(tmp, "w") as f:
+				for r in recipes:
+					f.write(r + "\n")
+			os.replace(tmp, registry)
+
+		return {
+			"chunks": deleted,
+			"size_b": freed
+		}
+
+	def stats(self) -> Dict:
+		"""
+		:return: A dict with the number of recipes ("images"), the sum of their sizes ("logical_b"),
+		the number and size of stored chunks ("chunks", "stored_b") and "dedup_ratio" (logical_b / stored_b)
+		"""
+		recipes = [r for r in self._registered_recipes() if isfile(r)]
+		logical = 0
+		for r in recipes:
+			logical += self.load_recipe(r)["size_b"]
+		chunks = 0
+		stored = 0
+		for digest in self.iter_chunkfiles():
+			chunks += 1
+			stored += getsize(self._chunkpath(digest))
+		return {
+			"images": len(recipes),
+			"logical_b": logical,
+			"chunks": chunks,
+			"stored_b": stored,
+			"dedup_ratio": (logical / stored) if stored > 0 else 0.0
+		}
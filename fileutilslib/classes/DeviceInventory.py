@@ -0,0 +1,302 @@
+import os
+from enum import Enum
+from os.path import isdir, join
+from select import select
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Tuple
+from fileutilslib.classes.DeviceTable import DeviceTable
+from fileutilslib.disklib.fdisktools import fdisklist
+from fileutilslib.disklib.inotifytools import inotify_init, inotify_add_watch, inotify_read, IN_CREATE, IN_DELETE, \
+	IN_MOVED_FROM, IN_MOVED_TO, IN_CLOSE_WRITE, IN_ONLYDIR
+from fileutilslib.disklib.sysfstools import sysfslist, sysfs_available, read_sysattr, DEFAULT_SYSFS_ROOT, \
+	DEFAULT_PROCFS_ROOT, DEFAULT_UDEV_ROOT, DEFAULT_DEV_ROOT
+
+DEFAULT_TTL = 30.0
+DEFAULT_POLL_INTERVAL = 2.0
+# Hotplugging a disk creates its node and those of its partitions one after the other
+_DEBOUNCE = 0.2
+
+
+class DeviceEventType(Enum):
+	ADDED = "added"
+	REMOVED = "removed"
+	CHANGED = "changed"
+
+
+class DeviceEvent:
+	"""
+	A disk or partition that appeared, disappeared or changed its size. record is the DiskRecord or
+	PartitionRecord of the new table, for REMOVED the one of the old table.
+	"""
+
+	__slots__ = ("type", "dev", "record")
+
+	def __init__(self, event_type: DeviceEventType, dev: str, record):
+		self.type = event_type
+		self.dev = dev
+		self.record = record
+
+	def __repr__(self):
+		return "DeviceEvent({}, {})".format(self.type.value, self.dev)
+
+
+def _records(table: DeviceTable) -> Dict[str, object]:
+	result = {}
+	if table is not None:
+		for disk in table:
+			result[disk.dev] = disk
+			for part in disk.partitions:
+				result[part.dev] = part
+	return result
+
+
+def diff_tables(old: DeviceTable, new: DeviceTable) -> List[DeviceEvent]:
+	"""
+	:return: The events turning old into new, removals first
+	"""
+	before = _records(old)
+	after = _records(new)
+	events = [DeviceEvent(DeviceEventType.REMOVED, dev, r) for (dev, r) in before.items() if dev not in after]
+	for (dev, r) in after.items():
+		if dev not in before:
+			events.append(DeviceEvent(DeviceEventType.ADDED, dev, r))
+		elif before[dev].size_b != r.size_b:
+			events.append(DeviceEvent(DeviceEventType.CHANGED, dev, r))
+	return events
+
+
+class DeviceInventory:
+	"""
+	Caches the DeviceTable of the host. Within ttl seconds get_table() costs a lookup; after that a fingerprint
+	of /proc/partitions (or sysfs) and the udev database decides whether the devices have to be listed again.
+	With start_watching() a thread keeps the table current and tells the subscribers about added, removed and
+	resized devices as they happen: device nodes appearing in and vanishing from /dev and udev finishing to
+	probe a device are noticed with inotify (procfs and sysfs don't report changes), resizes by comparing the
+	fingerprint every poll_interval seconds.
+	"""
+
+	_ttl = None
+	""":type: float"""
+
+	_use_fdisk = None
+	""":type: bool"""
+
+	_table = None
+	""":type: DeviceTable"""
+
+	_fingerprint = None
+	""":type: str"""
+
+	_checked = None
+	""":type: float"""
+
+	_handlers = None
+	""":type: List[Callable]"""
+
+	_watcher = None
+	""":type: Thread"""
+
+	_wakeup = None
+	""":type: Tuple[int, int]"""
+
+	def __init__(
+		self,
+		ttl: float = DEFAULT_TTL,
+		use_fdisk: bool = False,
+		sysfs_root: str = DEFAULT_SYSFS_ROOT,
+		procfs_root: str = DEFAULT_PROCFS_ROOT,
+		udev_root: str = DEFAULT_UDEV_ROOT,
+		dev_root: str = DEFAULT_DEV_ROOT
+	):
+		"""
+		:param ttl: Seconds the table is used without checking the fingerprint, 0 to check on every call
+		:param use_fdisk: List the devices with "sudo fdisk -l" instead of reading sysfs
+		:param sysfs_root: See sysfstools.sysfslist
+		:param procfs_root: See sysfstools.sysfslist
+		:param udev_root: See sysfstools.sysfslist
+		:param dev_root: See sysfstools.sysfslist, watched for device nodes
+		"""
+		self._ttl = ttl
+		self._use_fdisk = use_fdisk
+		self._roots = (sysfs_root, procfs_root, udev_root, dev_root)
+		self._handlers = []
+		self._lock = Lock()
+		self._stop = Event()
+
+	def add_handler(self, handler: Callable) -> None:
+		"""
+		:param handler: Called with a list of DeviceEvents after each change, from the thread that noticed it
+		"""
+		with self._lock:
+			self._handlers.append(handler)
+
+	def remove_handler(self, handler: Callable) -> None:
+		with self._lock:
+			if handler in self._handlers:
+				self._handlers.remove(handler)
+
+	def fingerprint(self) -> str:
+		"""
+		Cheap summary of the block devices (one read of /proc/partitions and a listing of the udev database),
+		changes with any device appearing, disappearing or changing its size and when udev has probed a device
+		"""
+		(sysfs_root, procfs_root, udev_root, _) = self._roots
+		fp = read_sysattr(join(procfs_root, "partitions"))
+		if fp == "" and sysfs_available(sysfs_root):
+			blockdir = join(sysfs_root, "class", "block")
+			if not isdir(blockdir):
+				blockdir = join(sysfs_root, "block")
+			fp = "\n".join(
+				"{} {}".format(name, read_sysattr(join(blockdir, name, "size"))) for name in sorted(os.listdir(blockdir))
+			)
+		# A node shows up in /dev before udev has written type, label and links of the device
+		return fp + "\n" + self._udev_fingerprint(join(udev_root, "data"))
+
+	@staticmethod
+	def _udev_fingerprint(datadir: str) -> str:
+		try:
+			entries = [e for e in os.scandir(datadir) if e.name.startswith("b")]
+		except OSError:
+			return ""
+		lines = []
+		for entry in entries:
+			try:
+				lines.append("{} {}".format(entry.name, entry.stat().st_mtime_ns))
+			except OSError:
+				# Replaced or removed while listing
+				pass
+		return "\n".join(sorted(lines))
+
+	def _list(self) -> DeviceTable:
+		(sysfs_root, procfs_root, udev_root, dev_root) = self._roots
+		if self._use_fdisk is True or not sysfs_available(sysfs_root):
+			return DeviceTable(fdisklist(False), dev_root)
+		return DeviceTable(sysfslist(False, sysfs_root, procfs_root, udev_root, dev_root), dev_root)
+
+	def refresh(self, force: bool = False) -> List[DeviceEvent]:
+		"""
+		Lists the devices again if the fingerprint changed (or force) and notifies the handlers
+		:return: The changes
+		"""
+		with self._lock:
+			fp = self.fingerprint()
+			self._checked = monotonic()
+			if not force and self._table is not None and fp == self._fingerprint:
+				return []
+			old = self._table
+			self._table = self._list()
+			self._fingerprint = fp
+			events = diff_tables(old, self._table) if old is not None else []
+			handlers = list(self._handlers)
+
+		if len(events) > 0:
+			for handler in handlers:
+				handler(events)
+		return events
+
+	def invalidate(self) -> None:
+		"""
+		Makes the next get_table() check the fingerprint
+		"""
+		self._checked = None
+
+	def get_table(self) -> DeviceTable:
+		"""
+		:return: The cached table, checked against the fingerprint once the ttl has passed. While watching, the
+		watcher keeps it current and this never touches the filesystem.
+		"""
+		table = self._table
+		if table is None or (not self.is_watching() and (
+			self._checked is None or monotonic() - self._checked >= self._ttl
+		)):
+			self.refresh()
+			table = self._table
+		return table
+
+	def is_watching(self) -> bool:
+		return self._watcher is not None and self._watcher.is_alive()
+
+	def start_watching(self, poll_interval: float = DEFAULT_POLL_INTERVAL) -> None:
+		"""
+		Starts a daemon thread keeping the table current (see the class description)
+		:param poll_interval: Seconds between fingerprint checks, the only detection where inotify is missing
+		"""
+		if self.is_watching():
+			return
+		# Watching before listing, so no change between the two is missed
+		fd = self._open_watch()
+		self.refresh()
+		self._stop.clear()
+		self._wakeup = os.pipe()
+		self._watcher = Thread(target=self._watch, args=(fd, poll_interval), daemon=True)
+		self._watcher.start()
+
+	def stop_watching(self) -> None:
+		self._stop.set()
+		if self._watcher is not None:
+			os.write(self._wakeup[1], b"\0")
+			self._watcher.join()
+			self._watcher = None
+			os.close(self._wakeup[0])
+			os.close(self._wakeup[1])
+			self._wakeup = None
+
+	def _open_watch(self):
+		(_, _, udev_root, dev_root) = self._roots
+		try:
+			fd = inotify_init()
+		except Exception:
+			return None
+		try:
+			inotify_add_watch(fd, dev_root, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR)
+		except OSError:
+			os.close(fd)
+			return None
+		try:
+			# udev replaces the entries of its database once it has probed a device
+			inotify_add_watch(
+				fd, join(udev_root, "data"), IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+			)
+		except OSError:
+			# Without udev, the nodes in /dev are all there is to watch
+			pass
+		return fd
+
+	def _watch(self, fd: int, poll_interval: float) -> None:
+		wakeup = self._wakeup[0]
+		try:
+			while not self._stop.is_set():
+				# Woken by device nodes, udev, stop_watching or after poll_interval to see resizes
+				(readable, _, _) = select([wakeup] if fd is None else [fd, wakeup], [], [], poll_interval)
+				if fd is not None and fd in readable:
+					inotify_read(fd)
+					sleep(_DEBOUNCE)
+					while len(inotify_read(fd)) > 0:
+						pass
+				if not self._stop.is_set():
+					try:
+						self.refresh()
+					except Exception:
+						# Devices vanishing while they are listed, the next round sees a settled state
+						pass
+		finally:
+			if fd is not None:
+				os.close(fd)
+
+
+_inventories = {}
+""":type: Dict[bool, DeviceInventory]"""
+
+_inventories_lock = Lock()
+
+
+def get_inventory(use_fdisk: bool = False) -> DeviceInventory:
+	"""
+	:return: The inventory shared by all ImageBackups of the process
+	"""
+	with _inventories_lock:
+		inv = _inventories.get(use_fdisk)
+		if inv is None:
+			inv = _inventories[use_fdisk] = DeviceInventory(use_fdisk=use_fdisk)
+		return inv
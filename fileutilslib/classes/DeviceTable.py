@@ -0,0 +1,185 @@
+from os import listdir, readlink
+from os.path import join, normpath, dirname, isdir, islink, realpath
+from typing import Dict, Iterator, List
+from fileutilslib.disklib.filetools import bytes_to_unit
+from fileutilslib.disklib.sysfstools import DEFAULT_DEV_ROOT
+
+# Subdirectories of /dev/disk whose symlinks are indexed as aliases
+ALIAS_DIRS = ("by-id", "by-uuid", "by-partuuid", "by-label", "by-partlabel", "by-path")
+
+
+def normalize_devpath(path) -> str:
+	"""
+	The index key of a device path. Lookups are case-insensitive, like fdisktools.fdiskdevicesize.
+	"""
+	return normpath(str(path)).lower()
+
+
+class PartitionRecord:
+	__slots__ = ("dev", "size_b", "type", "isntfs", "partn", "start", "major", "minor", "ro", "disk")
+
+	def __init__(self, part: Dict, disk: "DiskRecord"):
+		self.dev = part["dev"]
+		self.size_b = part["size_b"]
+		self.type = part.get("type", "")
+		self.isntfs = part.get("isntfs", False)
+		self.partn = part.get("partn")
+		self.start = part.get("start")
+		self.major = part.get("major")
+		self.minor = part.get("minor")
+		self.ro = part.get("ro", False)
+		self.disk = disk
+
+	@property
+	def size_h(self) -> str:
+		return bytes_to_unit(self.size_b, True)
+
+	def is_partition(self) -> bool:
+		return True
+
+	def to_dict(self) -> Dict:
+		return {
+			"dev": self.dev, "size_b": self.size_b, "size_h": self.size_h, "type": self.type, "isntfs": self.isntfs,
+			"partn": self.partn, "start": self.start, "major": self.major, "minor": self.minor, "ro": self.ro
+		}
+
+
+class DiskRecord:
+	__slots__ = ("dev", "size_b", "isntfs", "major", "minor", "ro", "removable", "model", "serial", "partitions")
+
+	def __init__(self, dev: Dict):
+		self.dev = dev["dev"]
+		self.size_b = dev["size_b"]
+		self.isntfs = dev.get("isntfs", False)
+		self.major = dev.get("major")
+		self.minor = dev.get("minor")
+		self.ro = dev.get("ro", False)
+		self.removable = dev.get("removable", False)
+		self.model = dev.get("model", "")
+		self.serial = dev.get("serial", "")
+		self.partitions = tuple(PartitionRecord(p, self) for p in dev.get("partitions", []))
+
+	@property
+	def size_h(self) -> str:
+		return bytes_to_unit(self.size_b, True)
+
+	def is_partition(self) -> bool:
+		return False
+
+	def to_dict(self) -> Dict:
+		return {
+			"dev": self.dev, "size_b": self.size_b, "size_h": self.size_h, "isntfs": self.isntfs,
+			"major": self.major, "minor": self.minor, "ro": self.ro, "removable": self.removable,
+			"model": self.model, "serial": self.serial, "partitions": [p.to_dict() for p in self.partitions]
+		}
+
+
+class DeviceTable:
+	"""
+	The disks and partitions listed by sysfstools.sysfslist or fdisktools.fdisklist, indexed by normalized
+	device path and by the /dev/disk/by-* symlinks pointing to them, so size, parent disk and partitions of a
+	path are looked up in constant time.
+	"""
+
+	_disks = None
+	""":type: List[DiskRecord]"""
+
+	_index = None
+	""":type: Dict[str, object]"""
+
+	_aliases = None
+	""":type: Dict[str, List[str]]"""
+
+	def __init__(self, devices: List[Dict], dev_root: str = DEFAULT_DEV_ROOT, index_aliases: bool = True):
+		"""
+		:param devices: The list of device dicts of sysfslist or fdisklist
+		:param dev_root: The directory holding the "disk" directory with the by-* symlinks
+		:param index_aliases: Also index the by-* symlinks
+		"""
+		self._disks = [DiskRecord(d) for d in devices]
+		self._index = {}
+		self._aliases = {}
+		for disk in self._disks:
+			self._index[normalize_devpath(disk.dev)] = disk
+			for part in disk.partitions:
+				self._index[normalize_devpath(part.dev)] = part
+		if index_aliases:
+			self._index_aliases(dev_root)
+
+	def _index_aliases(self, dev_root: str) -> None:
+		for aliasdir in ALIAS_DIRS:
+			d = join(dev_root, "disk", aliasdir)
+			if not isdir(d):
+				continue
+			for name in listdir(d):
+				alias = join(d, name)
+				try:
+					target = readlink(alias)
+				except OSError:
+					continue
+				# The links are relative ("../../sda1"), resolving them lexically saves a syscall per link
+				record = self._index.get(normalize_devpath(join(dirname(alias), target)))
+				if record is not None:
+					self._index.setdefault(normalize_devpath(alias), record)
+					self._aliases.setdefault(record.dev, []).append(alias)
+
+	def __len__(self) -> int:
+		"""
+		:return: The number of disks and partitions
+		"""
+		return sum(1 + len(d.partitions) for d in self._disks)
+
+	def __iter__(self) -> Iterator[DiskRecord]:
+		return iter(self._disks)
+
+	def __contains__(self, path) -> bool:
+		return self.get(path) is not None
+
+	def get_disks(self) -> List[DiskRecord]:
+		return list(self._disks)
+
+	def get(self, path):
+		"""
+		:param path: A device or partition path, a by-* alias or another symlink to one
+		:return: The DiskRecord or PartitionRecord, None if unknown
+		"""
+		record = self._index.get(normalize_devpath(path))
+		if record is None and islink(str(path)):
+			record = self._index.get(normalize_devpath(realpath(str(path))))
+		return record
+
+	def get_size_b(self, path) -> int:
+		"""
+		:return: The size in bytes, None if the path is unknown
+		"""
+		record = self.get(path)
+		return record.size_b if record is not None else None
+
+	def get_disk(self, path) -> DiskRecord:
+		"""
+		:return: The disk itself for disks, the parent disk for partitions, None if unknown
+		"""
+		record = self.get(path)
+		if record is None:
+			return None
+		return record.disk if record.is_partition() else record
+
+	def get_partitions(self, path) -> List[PartitionRecord]:
+		"""
+		:return: The partitions of the disk the path belongs to, None if unknown
+		"""
+		disk = self.get_disk(path)
+		return list(disk.partitions) if disk is not None else None
+
+	def get_aliases(self, path) -> List[str]:
+		"""
+		:return: The by-* symlinks pointing to the device
+		"""
+		record = self.get(path)
+		return list(self._aliases.get(record.dev, [])) if record is not None else []
+
+	def to_dicts(self) -> List[Dict]:
+		"""
+		:return: The list of device dicts (e.g. for fdisktools.fdiskdevicesize or sysfstools.print_devices)
+		"""
+		return [d.to_dict() for d in self._disks]
@@ -1,14 +1,35 @@
 from pathlib import Path
 from plumbum import local
 from os import remove, statvfs, stat
+from os.path import isfile
+from stat import S_ISREG, S_ISBLK
 from subprocess import PIPE
 from datetime import datetime
-from typing import Dict, Callable
-from fileutilslib.disklib.fdisktools import fdisklist, fdiskdevicesize, predict_job_time
-from fileutilslib.misclib.helpertools import string_equal_utf8, strip, string_is_empty, humantime, singlecharinput
+from contextlib import nullcontext
+from typing import Dict, Callable, List, Tuple
+from fileutilslib.disklib.sysfstools import print_devices
+from fileutilslib.disklib.parttabletools import read_partition_table
+from fileutilslib.disklib.extfstools import copy_path_used, used_sizebytes
+from fileutilslib.misclib.helpertools import strip, string_is_empty, humantime, singlecharinput
 from fileutilslib.disklib.filetools import sizeinfo_from_statvfs_result, find_mount_point, bytes_to_unit, is_directory_path
-from fileutilslib.disklib.ddtools import parse_dd_info
+from fileutilslib.disklib.ddtools import parse_dd_info, iter_dd_output_lines, is_dd_progress_line
+from fileutilslib.disklib.compresstools import compress_path, compress_types, decompress_path, decompress_path_compare
+from fileutilslib.disklib.manifesttools import create_incremental, rebuild_image, rebuild_total_b, load_manifest, \
+	INCREMENTAL_MODE_DELTA, INCREMENTAL_MODE_PATCH
+from fileutilslib.disklib.hashtools import StreamHasher, write_checksums, verify, checksum_path, source_checksum_path
+from fileutilslib.disklib.tunetools import tuned_blocksize, IO_MODE_DIRECT
+from fileutilslib.disklib.journaltools import copy_path_resumable, remove_journal, DEFAULT_CHECKPOINT_INTERVAL
+from fileutilslib.disklib.copytools import copy_path, copy_path_compare, path_size, observe_io, blocksize_to_bytes, data_sizebytes, DEFAULT_EXTENT_SIZE
 from fileutilslib.classes.ConsoleColors import ConsoleColors, ConsoleColor
+from fileutilslib.classes.ChunkStore import ChunkStore, CHUNKING_CDC
+from fileutilslib.classes.DeviceTable import DeviceTable
+from fileutilslib.classes.DeviceInventory import get_inventory
+from fileutilslib.classes.PartitionView import PartitionView, open_partition
+from fileutilslib.classes.Bencher import Bencher
+from fileutilslib.classes.ProgressTracker import ProgressTracker, ProgressEvent, ProgressEventType
+from fileutilslib.classes.RateLimiter import RateLimiter
+from fileutilslib.classes.ImageMetrics import ImageMetrics
+from fileutilslib.disklib.iopriotools import ioprio_class, ioprio_get, ioprio_set, ionice_args
 
 
 class ImageBackup:
@@ -22,11 +43,76 @@ class ImageBackup:
 	""":type: bool"""
 
 	_devices = None
-	""":type: List[object]"""
+	""":type: DeviceTable"""
 
-	def __init__(self, list_devices: bool = False):
+	_sparse = None
+	""":type: bool"""
+
+	_fs_aware = None
+	""":type: bool"""
+
+	_workers = None
+	""":type: int"""
+
+	_extent_size = None
+	""":type: str"""
+
+	_compression = None
+	""":type: Dict"""
+
+	_incremental = None
+	""":type: Dict"""
+
+	_chunkstore = None
+	""":type: ChunkStore"""
+
+	_checksums = None
+	""":type: List[str]"""
+
+	_direct_io = None
+	""":type: bool"""
+
+	_checkpoint_interval = None
+	""":type: str"""
+
+	_progress_tracker = None
+	""":type: ProgressTracker"""
+
+	_cancelled = None
+	""":type: bool"""
+
+	_rate_limiter = None
+	""":type: RateLimiter"""
+
+	_io_priority = None
+	""":type: Tuple[int, int]"""
+
+	_metrics = None
+	""":type: ImageMetrics"""
+
+	_ddprocess = None
+	""":type: Popen"""
+
+	def __init__(self, list_devices: bool = False, use_fdisk: bool = False):
+		"""
+		:param list_devices: Print the devices found
+		:param use_fdisk: List the devices with "sudo fdisk -l" instead of reading sysfs (see sysfstools.sysfslist).
+		The devices are cached process-wide (see DeviceInventory.get_inventory).
+		"""
 		self._device_ok = False
-		self._devices = fdisklist(list_devices)
+		self._sparse = False
+		self._fs_aware = False
+		self._workers = 1
+		self._extent_size = None
+		self._direct_io = False
+		self._cancelled = False
+		inventory = get_inventory(use_fdisk)
+		if list_devices:
+			# The printed table is checked against the fingerprint, not up to ttl seconds old
+			inventory.refresh()
+		self._devices = inventory.get_table()
+		if list_devices:
+			print_devices(self._devices.to_dicts())
 
 	def assert_devicepath_is_valid(self) -> None:
 		if self._devicepath is None or not self._devicepath.exists():
@@ -41,7 +127,7 @@ class ImageBackup:
 		sf = 0 if (sf is None or sf < 0) else sf
 
 		if self.get_image_mountpoint_sizeinfo()[
-			"free"] - sf <= self.get_target_image_sizebytes():
+			"free"] - sf <= self.get_target_image_ondisk_sizebytes():
 			raise Exception("There is not enough free space to create the image")
 
 	def print_pre_dd_info(self):
@@ -49,18 +135,203 @@ class ImageBackup:
 			"Approximate image size: {}".format(self.get_target_image_sizehuman()),
 			ConsoleColors.UNDERLINE))
 
+		if self._sparse is True or self._fs_aware is True:
+			print(ConsoleColor.colorline(
+				"Approximate space needed ({}): {}".format(
+					"allocated blocks" if self._fs_aware is True else "sparse",
+					bytes_to_unit(self.get_target_image_ondisk_sizebytes(), True, True, False)
+				),
+				ConsoleColors.UNDERLINE))
+
 		print(ConsoleColor.colorline(
 			"Free space on image partition: {}".format(self.get_image_mountpoint_sizeinfo()["free_h"]),
 			ConsoleColors.UNDERLINE))
 
-	def get_devicepath(self) -> str:
-		return Path(self._device_str)
+	def get_devices(self) -> DeviceTable:
+		return self._devices
+
+	def get_devicepath(self) -> Path:
+		return self._devicepath
 
 	def get_target_image_sizehuman(self) -> str:
 		return bytes_to_unit(self.get_target_image_sizebytes(), True, True, False)
 
-	def get_target_image_sizebytes(self) -> str:
-		return fdiskdevicesize(self._devices, str(self._devicepath.absolute()))
+	def get_target_image_sizebytes(self) -> int:
+		"""
+		The size of the device, or of the file for sources that aren't in the device table (e.g. images)
+		"""
+		sizebytes = self._devices.get_size_b(self._devicepath.absolute())
+		if sizebytes is None:
+			sizebytes = path_size(str(self._devicepath.absolute()))
+		return sizebytes
+
+	def get_target_image_ondisk_sizebytes(self) -> int:
+		"""
+		The space the image will occupy on the target. Equals get_target_image_sizebytes(), unless sparse mode
+		is active and the source reports holes (SEEK_DATA/SEEK_HOLE), which block devices usually don't, or
+		filesystem-aware mode is active and the device holds ext filesystems (see set_fs_aware).
+		Zero blocks skipped while copying only make the image smaller than this.
+		"""
+		sizebytes = self.get_target_image_sizebytes()
+		if self._fs_aware is True:
+			try:
+				return used_sizebytes(str(self._devicepath.absolute()))
+			except Exception:
+				pass
+		if self._sparse is True:
+			try:
+				return min(sizebytes, data_sizebytes(str(self._devicepath.absolute())))
+			except OSError:
+				pass
+		return sizebytes
+
+	def is_sparse(self) -> bool:
+		return self._sparse
+
+	def set_sparse(self, sparse: bool) -> None:
+		"""
+		Skip unallocated regions and zero blocks of the device and leave holes in the image instead
+		"""
+		self._sparse = sparse
+
+	def is_fs_aware(self) -> bool:
+		return self._fs_aware
+
+	def set_fs_aware(self, fs_aware: bool) -> None:
+		"""
+		Copy only the blocks the ext2/3/4 filesystems of the device have allocated (only used by start_native).
+		The device may be a partition or a whole disk, whose partition table, other partitions and gaps are
+		copied completely. Free blocks become holes of the image and zeros when it's restored, so the image
+		can't be used for recovering deleted files. Filesystems have to be unmounted (or mounted read-only).
+		"""
+		self._fs_aware = fs_aware
+
+	def is_direct_io(self) -> bool:
+		return self._direct_io
+
+	def set_direct_io(self, direct_io: bool) -> None:
+		"""
+		Open device and image with O_DIRECT (only used by start_native), so imaging a large disk doesn't evict
+		the page cache of everything else running on the host. Can't be combined with sparse or parallel copying.
+		"""
+		self._direct_io = direct_io
+
+	def get_rate_limit(self) -> float:
+		return self._rate_limiter.get_rate() if self._rate_limiter is not None else None
+
+	def set_rate_limit(self, rate=None, burst=None) -> None:
+		"""
+		Cap the bandwidth of start_native and restore (token bucket, see RateLimiter). Can be changed from
+		another thread while a copy runs, e.g. to speed up a backup once the host is idle.
+		:param rate: Bytes per second as int or dd-style string (e.g. "50M"), None for no limit
+		:param burst: Bytes that may pass at once as int or dd-style string, defaults to a quarter second
+		"""
+		rate_b = blocksize_to_bytes(rate) if rate is not None else None
+		burst_b = blocksize_to_bytes(burst) if burst is not None else None
+		if self._rate_limiter is None:
+			self._rate_limiter = RateLimiter(rate_b, burst_b)
+		else:
+			self._rate_limiter.set_rate(rate_b, burst_b)
+
+	def get_io_priority(self) -> Tuple[int, int]:
+		return self._io_priority
+
+	def set_io_priority(self, ioclass=None, level: int = 4) -> None:
+		"""
+		Run the copy with an I/O priority like ionice (dd is started through ionice)
+		:param ioclass: "realtime", "best-effort", "idle" or an IOPRIO_CLASS_* constant, None for the default
+		:param level: 0 (highest) to 7 within realtime and best-effort
+		"""
+		if ioclass is None:
+			self._io_priority = None
+		else:
+			if not 0 <= level <= 7:
+				raise Exception("The I/O priority level has to be between 0 and 7")
+			self._io_priority = (ioprio_class(ioclass), level)
+
+	def _apply_io_priority(self) -> Tuple[int, int]:
+		# Set on the calling thread, the worker threads of the copy engines inherit it
+		if self._io_priority is None:
+			return None
+		previous = ioprio_get()
+		ioprio_set(*self._io_priority)
+		return previous
+
+	def _reset_io_priority(self, previous: Tuple[int, int]) -> None:
+		if previous is not None:
+			try:
+				ioprio_set(*previous)
+			except OSError:
+				# Called from finally blocks, where raising would replace the result of the copy
+				pass
+
+	def get_metrics(self) -> ImageMetrics:
+		return self._metrics
+
+	def set_metrics(self, metrics: ImageMetrics = None) -> None:
+		"""
+		Record counters and histograms of the jobs (see ImageMetrics, which exports them for Prometheus).
+		Syscall latencies and written bytes are only measured by start_native and restore.
+		:param metrics: The metrics to update, None to stop recording
+		"""
+		self._metrics = metrics
+
+	def _observe_io(self):
+		return observe_io(self._metrics.observe_io) if self._metrics is not None else nullcontext()
+
+	def _written_b(self) -> int:
+		return self._metrics.snapshot()["written_bytes_total"] if self._metrics is not None else 0
+
+	def get_checkpoint_interval(self) -> str:
+		return self._checkpoint_interval
+
+	def set_resumable(self, resumable: bool, checkpoint_interval: str = None) -> None:
+		"""
+		Write a checkpoint journal next to the image while it is created (only used by start_native for plain
+		images), so an interrupted run can be continued with start_dd(native=True, resume=True).
+		:param resumable: False disables the journal
+		:param checkpoint_interval: dd-style bytes between checkpoints, defaults to 256M
+		"""
+		if resumable is False:
+			self._checkpoint_interval = None
+		else:
+			self._checkpoint_interval = checkpoint_interval or str(DEFAULT_CHECKPOINT_INTERVAL)
+
+	def get_workers(self) -> int:
+		return self._workers
+
+	def set_workers(self, workers: int, extent_size: str = None) -> None:
+		"""
+		Copy the device with several threads, each working on its own extent (only used by start_native)
+		:param workers: Number of threads, 1 copies sequentially
+		:param extent_size: dd-style size of one extent (e.g. "256M"), defaults to 64M
+		"""
+		if workers < 1:
+			raise Exception("At least one worker is needed")
+		self._workers = workers
+		self._extent_size = extent_size
+
+	def get_compression(self) -> Dict:
+		return self._compression
+
+	def set_compression(self, compress_type: str = None, level: int = None, workers: int = None) -> None:
+		"""
+		Compress the image while it is created (only used by start_native), which needs no space for a raw image
+		and reads the device only once. Sparse mode and set_workers() don't apply to compressed images.
+		:param compress_type: "gz" or "xz", None to disable compression
+		:param level: Compression level (gzip: 1-9, xz: preset 0-9)
+		:param workers: Number of compressing threads, defaults to the number of CPUs
+		"""
+		if compress_type is None:
+			self._compression = None
+		elif compress_type not in compress_types():
+			raise Exception("Wrong compression algorithm (use {})".format(" or ".join(compress_types())))
+		else:
+			self._compression = {
+				"type": compress_type,
+				"level": level,
+				"workers": workers
+			}
 
 	def image_exists(self) -> bool:
 		return self._imagepath is not None and self._imagepath.exists()
@@ -86,6 +357,7 @@ class ImageBackup:
 
 				imagefilepath = str(self._imagepath.absolute())
 				remove(imagefilepath)
+				remove_journal(imagefilepath)
 				image = Path(str(imagefilepath))
 
 				if image.exists():
@@ -100,6 +372,27 @@ class ImageBackup:
 	def get_imagepath(self) -> Path:
 		return self._imagepath
 
+	def get_image_partitions(self) -> Dict:
+		"""
+		Reads the partition table of a plain (uncompressed, not chunked) image without fdisk and root
+		:return: See parttabletools.read_partition_table
+		"""
+		self.assert_imagepath_is_valid()
+		if self._compression is not None or self._chunkstore is not None:
+			raise Exception("The partitions of compressed or chunked images can only be read after a restore")
+		return read_partition_table(str(self._imagepath))
+
+	def open_image_partition(self, partn: int) -> PartitionView:
+		"""
+		Opens a partition of a plain image as read-only file object, e.g. to hash or copy it without extracting
+		it first (see PartitionView)
+		:param partn: The partition number as in get_image_partitions()
+		"""
+		self.assert_imagepath_is_valid()
+		if self._compression is not None or self._chunkstore is not None:
+			raise Exception("The partitions of compressed or chunked images can only be opened after a restore")
+		return open_partition(str(self._imagepath), partn)
+
 	def set_image_path(self, image_path: str = None) -> bool:
 		is_dir_msg = "Image path '{}' is not accepted, as it is a directory!"
 
@@ -158,28 +451,432 @@ class ImageBackup:
 			if string_is_empty(device_str):
 				raise Exception("Device-String is empty")
 
-			devok = False
+			if device_str not in self._devices:
+				raise Exception("Device or partition '{}' not found".format(device_str))
+			else:
+				self._devicepath = Path(device_str)
 
-			for dev in self._devices:
-				if string_equal_utf8(dev["dev"], device_str, False):
-					devok = True
+	def print_progress_event(self, event: ProgressEvent) -> None:
+		if event.type != ProgressEventType.PROGRESS:
+			return
+		print(
+			"{0:10}{1:4}{2:9}{3:3}{4:10}{5:4}{6:8}{7:3}{8:14}{9}".format(
+				bytes_to_unit(event.done_b, True, True, False),
+				"of",
+				self.get_target_image_sizehuman(),
+				"|",
+				humantime(event.elapsed),
+				"of",
+				humantime(event.elapsed + event.eta) if event.eta is not None else "-",
+				"|",
+				"{}/s".format(bytes_to_unit(event.throughput, True, True, False)),
+				"Total time: {}".format(humantime(event.elapsed))
+			),
+			end="\r"
+		)
 
-				if devok is False:
-					if "partitions" in dev:
-						for devpart in dev["partitions"]:
-							if devpart["dev"] == device_str:
-								devok = True
-								break
+	def get_progress_tracker(self) -> ProgressTracker:
+		"""
+		The tracker the next start_dd() reports to. Add handlers to receive ProgressEvents
+		or iterate its events() in another thread.
+		"""
+		if self._progress_tracker is None:
+			self._progress_tracker = ProgressTracker(None, min_interval=1.0)
+		return self._progress_tracker
 
-				if devok is True:
-					break
+	def cancel(self) -> None:
+		"""
+		Aborts a running start_dd() from another thread, which then returns -1.
+		Calling it before start_dd() makes the next run return -1 right away.
+		"""
+		self._cancelled = True
+		p = self._ddprocess
+		if p is not None and p.poll() is None:
+			try:
+				p.terminate()
+			except PermissionError:
+				# sudo may run with the real uid of root, it relays the signal to dd
+				local["sudo"]["kill", "-TERM", str(p.pid)].run(retcode=None)
 
-			if not devok:
-				raise Exception("Device or partition '{}' not found".format(self._device_str))
-			else:
-				self._devicepath = Path(device_str)
+	def is_cancelled(self) -> bool:
+		return self._cancelled is True
+
+	def _cancelled_error(self) -> Exception:
+		return Exception("Creation of image '{}' was cancelled".format(self._imagepath))
+
+	def print_post_dd_info(self, starttime: datetime, retcode: int) -> None:
+		print()
+
+		currenttime = datetime.now()
+		deltatime = currenttime - starttime
+		print(
+			ConsoleColor.colorline(
+				"Total time: {}".format(
+					humantime(deltatime.total_seconds())
+				), ConsoleColors.OKGREEN
+			)
+		)
+
+		st = stat(str(self._imagepath.absolute()))
+		print(
+			ConsoleColor.colorline(
+				"Final image size: {}".format(
+					bytes_to_unit(st.st_size, True, True, False)
+				), ConsoleColors.OKGREEN
+			)
+		)
+		if self._sparse is True or self._fs_aware is True:
+			print(
+				ConsoleColor.colorline(
+					"Allocated on disk: {}".format(
+						bytes_to_unit(st.st_blocks * 512, True, True, False)
+					), ConsoleColors.OKGREEN
+				)
+			)
+		if retcode == 0:
+			print(ConsoleColor.colorline("Successfully created image!", ConsoleColors.OKGREEN))
+		else:
+			print(ConsoleColor.colorline("No Result from dd (image might be ok)!", ConsoleColors.WARNING))
+
+	def get_incremental(self) -> Dict:
+		return self._incremental
+
+	def set_incremental(
+		self,
+		enabled: bool,
+		base_imagepath: str = None,
+		mode: str = INCREMENTAL_MODE_DELTA,
+		block_size: str = None
+	) -> None:
+		"""
+		Keep a block-hash manifest next to the image (only used by start_native). With the path of a previous
+		image of the device only changed blocks are written (see manifesttools.create_incremental).
+		:param enabled: False disables manifests and incremental imaging
+		:param base_imagepath: The previous image, None to create a full image with manifest
+		:param mode: "delta" (changed blocks only, needs the chain to rebuild) or "patch" (complete image)
+		:param block_size: dd-style block size of the manifest, ignored if there is a base image
+		"""
+		if enabled is False:
+			self._incremental = None
+		else:
+			self._incremental = {
+				"base": base_imagepath,
+				"mode": mode,
+				"block_size": block_size
+			}
+
+	def get_chunkstore(self) -> ChunkStore:
+		return self._chunkstore
+
+	def set_chunkstore(self, chunkstore: ChunkStore = None) -> None:
+		"""
+		Store the image's chunks in a deduplicating ChunkStore (only used by start_native).
+		The image path then receives the recipe of the image instead of the image itself.
+		Devices need a store with fixed chunking (see ChunkStore).
+		:param chunkstore: The store, None to create plain images
+		"""
+		self._chunkstore = chunkstore
+
+	def get_checksums(self) -> List[str]:
+		return self._checksums
+
+	def set_checksums(self, hash_names: List[str] = None) -> None:
+		"""
+		Compute digests of the device while it is copied (only used by start_native, not with set_workers())
+		and write them to the sidecar file "<image>.checksums", which "sha256sum -c" or "b2sum -c" can check.
+		Compressed, chunked and delta images don't hold the device data as it is, their digests are written to
+		"<image>.source.checksums" and name the device instead.
+		:param hash_names: e.g. ["sha256", "blake2b"], None or an empty list disables checksums
+		"""
+		if hash_names is None or len(hash_names) == 0:
+			self._checksums = None
+		else:
+			StreamHasher(hash_names)
+			self._checksums = list(hash_names)
+
+	def _write_checksums(self, devpath: str, imagepath: str, hasher: StreamHasher) -> None:
+		raw = self._compression is None and self._chunkstore is None and (
+			self._incremental is None or string_is_empty(self._incremental["base"]) or
+			self._incremental["mode"] == INCREMENTAL_MODE_PATCH
+		)
+		write_checksums(imagepath, hasher.hexdigests(), None if raw else devpath)
+		# A sidecar of an earlier run in the other mode would contradict the new image
+		stale = source_checksum_path(imagepath) if raw else checksum_path(imagepath)
+		if isfile(stale):
+			remove(stale)
+
+	def tune_batchsize(self, use_cache: bool = True, interactive: bool = False, apply_io_mode: bool = False) -> str:
+		"""
+		Benchmarks block sizes on a sample of the device (see tunetools.tuned_blocksize) and returns the fastest
+		as dd-style batch size. The result is cached per device model and serial.
+		:param apply_io_mode: Also switch direct I/O (see set_direct_io) on or off as measured, if the configured
+		image type is a plain copy that can use it
+		"""
+		self.assert_devicepath_is_valid()
+		best = tuned_blocksize(str(self._devicepath.absolute()), use_cache)
+
+		if interactive is True:
+			for r in best.get("results", []):
+				print("{0:10}{1:10}{2}/s".format(
+					r["blocksize_h"], r["mode"], bytes_to_unit(r["throughput"], True, True, False)
+				))
+			print(ConsoleColor.colorline(
+				"Best batch size: {} ({})".format(best["blocksize_h"], best["mode"]), ConsoleColors.OKGREEN
+			))
+
+		if apply_io_mode is True and self._plain_copy():
+			self._direct_io = best["mode"] == IO_MODE_DIRECT
+
+		return "{}c".format(best["blocksize"]) if best["blocksize"] % 1024 != 0 else "{}K".format(best["blocksize"] // 1024)
 
-	def start_dd(self, interactive: bool = False, ddbatchsize: str = None, finished_handler: Callable=None) -> int:
+	def _plain_copy(self) -> bool:
+		"""
+		Whether start_native copies with copytools.copy_path, the only mode that can use direct I/O
+		"""
+		return self._chunkstore is None and self._compression is None and self._incremental is None and \
+			self._checkpoint_interval is None and self._fs_aware is not True and self._sparse is not True and self._workers <= 1
+
+	@Bencher("ImageBackup.verify")
+	def verify(self, workers: int = None, progress_handler: Callable = None) -> bool:
+		"""
+		Compares the image with the device in large mmap'd windows, several of them in parallel.
+		Only works for plain (also sparse or patched incremental) images.
+		:param workers: Number of threads, defaults to the number of CPUs
+		:param progress_handler: Called with (compared_bytes, total_bytes)
+		:return: True if image and device are equal
+		"""
+		self.assert_devicepath_is_valid()
+		self.assert_imagepath_is_valid()
+		return len(verify(
+			str(self._imagepath.absolute()), str(self._devicepath.absolute()), workers=workers,
+			progress_handler=progress_handler
+		)) == 0
+
+	def _start_tracking(self, interactive: bool, progress_handler: Callable, total_b: int) -> ProgressTracker:
+		tracker = self.get_progress_tracker()
+		tracker.set_total_b(total_b)
+		if interactive is True:
+			tracker.add_handler(self.print_progress_event)
+		if progress_handler is not None:
+			tracker.add_handler(progress_handler)
+		if self._metrics is not None:
+			tracker.add_handler(self._metrics.handle_progress)
+		tracker.start()
+		return tracker
+
+	def _cancellable_progress(self, tracker: ProgressTracker) -> Callable:
+		last_b = None
+
+		def handle_progress(done_b, total_b=None):
+			nonlocal last_b
+			# Raising from the progress handler is the way to stop the copy engines
+			if self._cancelled is True:
+				raise self._cancelled_error()
+			# The first report is the baseline, as resumed copies don't start at 0
+			if self._rate_limiter is not None and last_b is not None and done_b > last_b:
+				self._rate_limiter.consume(done_b - last_b, self.is_cancelled)
+			last_b = done_b
+			tracker.update(done_b, total_b)
+		return handle_progress
+
+	def _stop_tracking(self, tracker: ProgressTracker, interactive: bool, progress_handler: Callable) -> None:
+		if interactive is True:
+			tracker.remove_handler(self.print_progress_event)
+		if progress_handler is not None:
+			tracker.remove_handler(progress_handler)
+		if self._metrics is not None:
+			tracker.remove_handler(self._metrics.handle_progress)
+
+	@Bencher("ImageBackup.start_native")
+	def start_native(
+		self,
+		interactive: bool = False,
+		ddbatchsize: str = None,
+		resume: bool = False,
+		progress_handler: Callable = None
+	) -> int:
+		"""
+		Creates the image in-process with the copy engine of copytools instead of spawning dd
+		:param interactive: Print progress lines
+		:param ddbatchsize: dd-style block size (e.g. "4M"), defaults to 1M
+		:param resume: Continue an interrupted run from its last checkpoint (see set_resumable)
+		:param progress_handler: Called with each ProgressEvent (see get_progress_tracker)
+		:return: 0 on success, 1 if the device ended before its expected size was copied
+		"""
+		devpath = str(self._devicepath.absolute())
+		imagepath = str(self._imagepath.absolute())
+
+		if self._compression is not None and self._incremental is not None:
+			raise Exception("Compressed images can't be incremental")
+
+		hasher = StreamHasher(self._checksums) if self._checksums is not None else None
+		tracker = self._start_tracking(interactive, progress_handler, self.get_target_image_sizebytes())
+
+		previous_ioprio = self._apply_io_priority()
+
+		try:
+			if self._cancelled is True:
+				raise self._cancelled_error()
+
+			written_b = self._written_b()
+			with self._observe_io():
+				retcode = self._start_native_copy(
+					devpath, imagepath, ddbatchsize, hasher, self._cancellable_progress(tracker), interactive, resume
+				)
+			if self._metrics is not None and self._compression is None:
+				# Holes, zero blocks, unchanged or deduplicated blocks and resumed parts
+				self._metrics.add_skipped(tracker.get_done_b() - (self._written_b() - written_b))
+
+			if hasher is not None:
+				self._write_checksums(devpath, imagepath, hasher)
+		except Exception as e:
+			tracker.fail(e)
+			if self._cancelled is True:
+				return -1
+			raise
+		except BaseException as e:
+			tracker.fail(e)
+			raise
+		else:
+			tracker.finish(retcode)
+		finally:
+			self._reset_io_priority(previous_ioprio)
+			self._stop_tracking(tracker, interactive, progress_handler)
+			self._cancelled = False
+
+		return retcode
+
+	def _start_native_copy(
+		self,
+		devpath: str,
+		imagepath: str,
+		ddbatchsize: str,
+		hasher: StreamHasher,
+		progress_handler: Callable,
+		interactive: bool,
+		resume: bool
+	) -> int:
+		if resume is True and self._checkpoint_interval is None:
+			raise Exception("Only resumable images (see set_resumable) can be resumed")
+
+		if self._checkpoint_interval is not None and (
+			self._chunkstore is not None or self._compression is not None or self._incremental is not None or
+			self._sparse is True or self._workers > 1 or self._direct_io is True or self._fs_aware is True
+		):
+			raise Exception("Only plain images can be resumable")
+
+		if self._fs_aware is True and (
+			self._chunkstore is not None or self._compression is not None or self._incremental is not None or
+			self._workers > 1 or self._direct_io is True
+		):
+			raise Exception("Filesystem-aware images are plain images copied by one worker without direct I/O")
+
+		if self._chunkstore is not None:
+			if self._compression is not None or self._incremental is not None:
+				raise Exception("Images in a chunk store can't be compressed or incremental")
+			if self._chunkstore.get_config()["chunking"] == CHUNKING_CDC and S_ISBLK(stat(devpath).st_mode):
+				# Finding the boundaries would take days for a disk, fixed chunks dedup device images as well
+				raise Exception("Devices can only be stored in chunk stores with fixed chunking")
+			copied = self._chunkstore.write_image(devpath, imagepath, progress_handler, hasher)["size_b"]
+		elif self._compression is not None:
+			compress_path(
+				devpath,
+				imagepath,
+				self._compression["type"],
+				self._compression["level"],
+				workers=self._compression["workers"],
+				progress_handler=progress_handler,
+				block_handler=hasher
+			)
+			return 0
+		elif self._incremental is not None:
+			manifest = create_incremental(
+				devpath,
+				imagepath,
+				self._incremental["base"],
+				self._incremental["mode"],
+				self._incremental["block_size"],
+				progress_handler=progress_handler,
+				block_handler=hasher
+			)
+			if interactive is True:
+				print()
+				print(ConsoleColor.colorline(
+					"Changed blocks: {} of {}".format(len(manifest["changed"]), len(manifest["blocks"])),
+					ConsoleColors.OKBLUE
+				))
+			copied = manifest["size_b"]
+		elif self._fs_aware is True:
+			copied = copy_path_used(
+				devpath, imagepath, blocksize_to_bytes(ddbatchsize), progress_handler, hasher
+			)["size_b"]
+		elif self._checkpoint_interval is not None:
+			copied = copy_path_resumable(
+				devpath,
+				imagepath,
+				blocksize_to_bytes(ddbatchsize),
+				blocksize_to_bytes(self._checkpoint_interval),
+				resume,
+				progress_handler,
+				hasher
+			)
+		else:
+			if hasher is not None and self._workers > 1:
+				raise Exception("Checksums can't be computed while copying with several workers")
+			copied = copy_path(
+				devpath,
+				imagepath,
+				blocksize_to_bytes(ddbatchsize),
+				progress_handler,
+				sparse=self._sparse,
+				workers=self._workers,
+				extent_size=blocksize_to_bytes(self._extent_size or DEFAULT_EXTENT_SIZE),
+				block_handler=hasher,
+				direct=self._direct_io
+			)
+
+		expected = self.get_target_image_sizebytes()
+		return 0 if expected is None or copied >= expected else 1
+
+	@Bencher("ImageBackup.start_dd")
+	def start_dd(
+		self,
+		interactive: bool = False,
+		ddbatchsize: str = None,
+		finished_handler: Callable=None,
+		native: bool = False,
+		resume: bool = False,
+		progress_handler: Callable = None,
+		confirm: bool = True
+	) -> int:
+		"""
+		Creates the image of the device
+		:param interactive: If True the creation is not confirmed and progress is printed
+		:param ddbatchsize: dd-style block size (e.g. "4M"), defaults to 1M, "auto" to use tune_batchsize(), which
+		for native copies also picks direct or buffered I/O
+		:param finished_handler: Called with (retcode, imagepath) when done
+		:param native: Copy in-process (see start_native) instead of running "sudo dd"
+		:param resume: Continue an interrupted native run (see set_resumable)
+		:param progress_handler: Called with each ProgressEvent (see get_progress_tracker)
+		:param confirm: False to skip the confirmation of non-interactive runs (e.g. in background jobs)
+		:return: The return code of dd or start_native, -1 if cancelled (also see cancel())
+		"""
+		try:
+			return self._start_dd(interactive, ddbatchsize, finished_handler, native, resume, progress_handler, confirm)
+		finally:
+			self._cancelled = False
+			self._ddprocess = None
+
+	def _start_dd(
+		self,
+		interactive: bool,
+		ddbatchsize: str,
+		finished_handler: Callable,
+		native: bool,
+		resume: bool,
+		progress_handler: Callable,
+		confirm: bool
+	) -> int:
 		retcode = None
 		devpath = str(self._devicepath.absolute())
 		imagepath = str(self._imagepath.absolute())
@@ -187,19 +884,30 @@ class ImageBackup:
 		param_if = "if={}".format(devpath.replace(" ", "\\ "))
 		param_of = "of={}".format(imagepath.replace(" ", "\\ "))
 		param_status = "status=progress"
+		param_conv = "conv=sparse" if self._sparse is True else None
+
+		if ddbatchsize == "auto":
+			# Direct I/O is only used by the native copy, dd keeps its default
+			ddbatchsize = self.tune_batchsize(True, interactive, native)
 
-		# todo: make configurable batch size
 		if ddbatchsize is not None:
 			param_bs = "bs={}".format(ddbatchsize)
 		else:
 			param_bs = "bs=1M"
 
-		if interactive is True:
+		if interactive is True or confirm is False:
 			yn = "y"
 		else:
-			print(ConsoleColor.colorline("Will execute \"{}\"".format(
-				"sudo dd {} {} {} {}".format(param_if, param_of, param_status, param_bs)
-			), ConsoleColors.OKGREEN))
+			if native is True:
+				print(ConsoleColor.colorline("Will copy \"{}\" to \"{}\" in-process with {}".format(
+					devpath, imagepath, param_bs
+				), ConsoleColors.OKGREEN))
+			else:
+				print(ConsoleColor.colorline("Will execute \"{}\"".format(
+					"sudo dd {} {} {} {}{}".format(
+						param_if, param_of, param_status, param_bs, "" if param_conv is None else " " + param_conv
+					)
+				), ConsoleColors.OKGREEN))
 
 			yn = singlecharinput(
 				"Confirm the creation of image '{}' from device '{}' (y/n)!".format(
@@ -207,98 +915,236 @@ class ImageBackup:
 				), ConsoleColors.OKGREEN
 			)
 
+		if self._cancelled is True:
+			yn = "n"
+
 		if yn == "n":
 			if interactive is True:
 				print(ConsoleColor.colorline("Cancelled image creation on your wish", ConsoleColors.OKBLUE))
 			return -1
+		elif yn == "y" and native is False and self._compression is not None:
+			raise Exception("Compression while imaging needs the native copy engine (native=True)")
+		elif yn == "y" and native is False and self.get_rate_limit() is not None:
+			raise Exception("Rate limiting needs the native copy engine (native=True)")
+		elif yn == "y" and native is True:
+			starttime = datetime.now()
+
+			if interactive is True:
+				print()
+
+			retcode = self.start_native(interactive, ddbatchsize, resume, progress_handler)
+
+			if interactive is True:
+				self.print_post_dd_info(starttime, retcode)
+			if finished_handler is not None:
+				finished_handler(retcode, imagepath)
+			return retcode
 		elif yn == "y":
 			sudo = local["sudo"]
+			env = local["env"]
 			dd = local["dd"]
 
 			starttime = datetime.now()
 
-			p = sudo[dd[param_if, param_of, param_status, param_bs]].popen(stderr=PIPE)
-			line = ''
-			# retcode = 0
+			ddparams = [param_if, param_of, param_status, param_bs]
+			if param_conv is not None:
+				ddparams.append(param_conv)
+
+			# The C locale keeps the progress lines parseable
+			cmd = env["LC_ALL=C", dd[ddparams]]
+			if self._io_priority is not None:
+				cmd = local["ionice"][ionice_args(*self._io_priority) + [cmd]]
+			p = sudo[cmd].popen(stderr=PIPE)
+			self._ddprocess = p
 
-			# Intention is not to get the first "\r" from dd-output
-			# sleep(1)
 			if interactive is True:
 				print()
 
-			target_image_sizehuman = self.get_target_image_sizehuman()
-			target_image_sizebytes = self.get_target_image_sizebytes()
+			tracker = self._start_tracking(interactive, progress_handler, self.get_target_image_sizebytes())
 
-			if interactive is False:
-				p._proc.communicate()
+			try:
+				if not tracker.has_handlers():
+					p.communicate()
+				else:
+					for line in iter_dd_output_lines(p.stderr):
+						if is_dd_progress_line(line):
+							tracker.update(parse_dd_info(line)["size_b"])
+				retcode = p.wait()
+				if self._cancelled is True:
+					raise self._cancelled_error()
+			except Exception as e:
+				tracker.fail(e)
+				if self._cancelled is False:
+					raise
+				retcode = -1
+			except BaseException as e:
+				tracker.fail(e)
+				raise
 			else:
-				while True:
-					retcode = p.poll()
-					if retcode is None:
-						out = p.stderr.read(1).decode("utf-8", errors="replace")
-						if out == '':
-							break
-						else:
-							if out == '\r':
-								line = strip(line)
-								if not string_is_empty(line):
-									dd_info = parse_dd_info(line)
-									currenttime = datetime.now()
-									deltatime = currenttime - starttime
-
-									print(
-										"{0:10}{1:4}{2:9}{3:3}{4:10}{5:4}{6:8}{7:3}{8}".format(
-											bytes_to_unit(dd_info["size_b"], True, True, False),
-											"of",
-											target_image_sizehuman,
-											"|",
-											dd_info["time_h"],
-											"of",
-											humantime(
-												predict_job_time(
-													dd_info["time"],
-													target_image_sizebytes,
-													dd_info["size_b"]
-												)
-											),
-											"|",
-											"Total time: {}".format(humantime(deltatime.total_seconds()))
-										),
-										end="\r"
-									)
-
-								line = ''
-							else:
-								line = line + out
-					else:
-						break
+				tracker.finish(retcode)
+			finally:
+				self._stop_tracking(tracker, interactive, progress_handler)
+
+			if interactive is True:
+				self.print_post_dd_info(starttime, retcode)
+			if finished_handler is not None:
+				finished_handler(retcode, imagepath)
+			return retcode
+
+	@Bencher("ImageBackup.restore")
+	def restore(
+		self,
+		targetpath: str = None,
+		compare: bool = False,
+		ddbatchsize: str = None,
+		interactive: bool = False,
+		progress_handler: Callable = None,
+		confirm: bool = True
+	) -> Dict:
+		"""
+		Writes the image back to the device (or another device or file) with the copy engine of copytools.
+		The image is read the way it was created: plain, compressed, from the chunk store or as incremental chain.
+		:param targetpath: The device or file to write to, defaults to the device of this backup
+		:param compare: Read each target block first and only write the blocks that changed (compare-before-write),
+		not for chunk store images and delta chains
+		:param ddbatchsize: dd-style block size (e.g. "4M"), defaults to 1M
+		:param interactive: If True the restore is not confirmed and progress is printed
+		:param progress_handler: Called with each ProgressEvent (see get_progress_tracker)
+		:param confirm: False to skip the confirmation of non-interactive runs
+		:return: A dict with the restored ("size_b"), written ("written_b") and unchanged ("skipped_b") bytes,
+		None if cancelled
+		"""
+		try:
+			return self._restore(targetpath, compare, ddbatchsize, interactive, progress_handler, confirm)
+		finally:
+			self._cancelled = False
 
-			retcode = retcode if retcode is not None else p._proc.returncode
+	def _restore(
+		self,
+		targetpath: str,
+		compare: bool,
+		ddbatchsize: str,
+		interactive: bool,
+		progress_handler: Callable,
+		confirm: bool
+	) -> Dict:
+		if not self.image_exists():
+			raise Exception("Image '{}' doesn't exist".format(self._imagepath))
+
+		imagepath = str(self._imagepath.absolute())
+		if targetpath is None:
+			self.assert_devicepath_is_valid()
+			targetpath = str(self._devicepath.absolute())
+		bs = blocksize_to_bytes(ddbatchsize)
+		delta = self._incremental is not None and load_manifest(imagepath)["base"] is not None
+
+		if compare is True and (self._chunkstore is not None or delta):
+			raise Exception("Compare-before-write needs a plain or compressed image")
+
+		if interactive is True or confirm is False:
+			yn = "y"
+		else:
+			yn = singlecharinput(
+				"Confirm overwriting '{}' with image '{}' (y/n)!".format(targetpath, imagepath), ConsoleColors.WARNING
+			)
 
+		if yn != "y" or self._cancelled is True:
 			if interactive is True:
-				print()
+				print(ConsoleColor.colorline("Cancelled restore on your wish", ConsoleColors.OKBLUE))
+			return None
 
-				currenttime = datetime.now()
-				deltatime = currenttime - starttime
-				print(
-					ConsoleColor.colorline(
-						"Total time: {}".format(
-							humantime(deltatime.total_seconds())
-						), ConsoleColors.OKGREEN
-					)
-				)
+		try:
+			# Devices keep their size, only files are truncated
+			truncate = S_ISREG(stat(targetpath).st_mode)
+		except FileNotFoundError:
+			truncate = True
 
-				st = stat(imagepath)
-				print(
-					ConsoleColor.colorline(
-						"Final image size: {}".format(
-							bytes_to_unit(st.st_size, True, True, False)
-						), ConsoleColors.OKGREEN
-					)
+		starttime = datetime.now()
+		tracker = self._start_tracking(interactive, progress_handler, None)
+		progress = self._cancellable_progress(tracker)
+		previous_ioprio = self._apply_io_priority()
+
+		try:
+			with self._observe_io():
+				result = self._restore_copy(imagepath, targetpath, compare, bs, truncate, delta, tracker, progress)
+			if self._metrics is not None:
+				self._metrics.add_skipped(result["skipped_b"])
+		except Exception as e:
+			tracker.fail(e)
+			if self._cancelled is True:
+				return None
+			raise
+		except BaseException as e:
+			tracker.fail(e)
+			raise
+		else:
+			tracker.finish(0)
+		finally:
+			self._reset_io_priority(previous_ioprio)
+			self._stop_tracking(tracker, interactive, progress_handler)
+
+		if interactive is True:
+			print()
+			print(ConsoleColor.colorline(
+				"Total time: {}".format(humantime((datetime.now() - starttime).total_seconds())), ConsoleColors.OKGREEN
+			))
+			print(ConsoleColor.colorline(
+				"Restored {} to '{}'".format(bytes_to_unit(result["size_b"], True, True, False), targetpath),
+				ConsoleColors.OKGREEN
+			))
+			if compare is True:
+				print(ConsoleColor.colorline(
+					"Unchanged (not written): {}".format(bytes_to_unit(result["skipped_b"], True, True, False)),
+					ConsoleColors.OKGREEN
+				))
+
+		return result
+
+	def _restore_copy(
+		self,
+		imagepath: str,
+		targetpath: str,
+		compare: bool,
+		bs: int,
+		truncate: bool,
+		delta: bool,
+		tracker: ProgressTracker,
+		progress: Callable
+	) -> Dict:
+		if self._chunkstore is not None:
+			recipe = self._chunkstore.load_recipe(imagepath)
+			tracker.set_total_b(recipe["size_b"])
+			size_b = self._chunkstore.read_image(imagepath, targetpath, truncate, progress)
+			result = {"size_b": size_b, "written_b": size_b, "skipped_b": 0}
+		elif self._compression is not None:
+			if compare is True:
+				result = decompress_path_compare(
+					imagepath, targetpath, self._compression["type"], bs, progress
 				)
-				if retcode == 0:
-					print(ConsoleColor.colorline("Successfully created image!", ConsoleColors.OKGREEN))
-				else:
-					print(ConsoleColor.colorline("No Result from dd (image might be ok)!", ConsoleColors.WARNING))
-			finished_handler(retcode, imagepath)
-			return retcode
+			else:
+				size_b = decompress_path(
+					imagepath, targetpath, self._compression["type"], bs, truncate, progress
+				)
+				result = {"size_b": size_b, "written_b": size_b, "skipped_b": 0}
+		elif delta:
+			tracker.set_total_b(rebuild_total_b(imagepath))
+			size_b = rebuild_image(imagepath, targetpath, truncate, bs, progress)
+			result = {"size_b": size_b, "written_b": size_b, "skipped_b": 0}
+		else:
+			tracker.set_total_b(path_size(imagepath))
+			if compare is True:
+				result = copy_path_compare(imagepath, targetpath, bs, progress)
+			else:
+				size_b = copy_path(
+					imagepath,
+					targetpath,
+					bs,
+					progress,
+					truncate=truncate,
+					sparse=self._sparse and truncate,
+					workers=self._workers,
+					extent_size=blocksize_to_bytes(self._extent_size or DEFAULT_EXTENT_SIZE),
+					direct=self._direct_io
+				)
+				result = {"size_b": size_b, "written_b": size_b, "skipped_b": 0}
+		return result
@@ -0,0 +1,279 @@
+import os
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+from time import time
+from typing import Dict, List, Tuple
+from fileutilslib.classes.ProgressTracker import ProgressEvent, ProgressEventType
+from fileutilslib.disklib.copytools import IO_READ, IO_WRITE, IO_COPY
+
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DEFAULT_STALL_THRESHOLD = 1.0
+DEFAULT_PREFIX = "fileutilslib_image"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+	"""
+	Cumulative histogram with fixed bucket bounds, like a Prometheus histogram
+	"""
+
+	__slots__ = ("bounds", "counts", "sum", "count")
+
+	def __init__(self, bounds: Tuple[float, ...]):
+		self.bounds = tuple(sorted(bounds))
+		self.counts = [0] * len(self.bounds)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value: float) -> None:
+		for i, bound in enumerate(self.bounds):
+			if value <= bound:
+				self.counts[i] += 1
+				break
+		self.sum += value
+		self.count += 1
+
+	def cumulative(self) -> List[Tuple[float, int]]:
+		result = []
+		total = 0
+		for (bound, c) in zip(self.bounds, self.counts):
+			total += c
+			result.append((bound, total))
+		return result
+
+
+def _escape_label(value: str) -> str:
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _format_labels(labels: Dict, extra: Dict = None) -> str:
+	merged = dict(labels)
+	if extra is not None:
+		merged.update(extra)
+	if len(merged) == 0:
+		return ""
+	return "{" + ",".join("{}=\"{}\"".format(k, _escape_label(v)) for (k, v) in sorted(merged.items())) + "}"
+
+
+def _format_value(value) -> str:
+	if value == float("inf"):
+		return "+Inf"
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+
+class ImageMetrics:
+	"""
+	Counters, gauges and histograms of the imaging jobs of an ImageBackup (see ImageBackup.set_metrics).
+	Syscall latencies are only measured for the native copy engine; jobs running dd only update the
+	progress-based metrics. All methods are thread-safe.
+	"""
+
+	_prefix = None
+	""":type: str"""
+
+	_labels = None
+	""":type: Dict[str, str]"""
+
+	_stall_threshold = None
+	""":type: float"""
+
+	_latency_buckets = None
+	""":type: Tuple[float, ...]"""
+
+	def __init__(
+		self,
+		labels: Dict[str, str] = None,
+		prefix: str = DEFAULT_PREFIX,
+		stall_threshold: float = DEFAULT_STALL_THRESHOLD,
+		latency_buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS
+	):
+		"""
+		:param labels: Labels added to every metric (e.g. {"device": "sdb", "host": "station1"})
+		:param prefix: Prefix of the metric names
+		:param stall_threshold: Seconds after which a single syscall counts as stall
+		:param latency_buckets: Upper bounds (seconds) of the latency histogram buckets
+		"""
+		self._prefix = prefix
+		self._labels = dict(labels) if labels is not None else {}
+		self._stall_threshold = stall_threshold
+		self._latency_buckets = tuple(latency_buckets)
+		self._lock = Lock()
+		self.reset()
+
+	def reset(self) -> None:
+		with self._lock:
+			self._counters = {
+				"read_bytes_total": 0,
+				"written_bytes_total": 0,
+				"skipped_bytes_total": 0,
+				"syscalls_total": {IO_READ: 0, IO_WRITE: 0, IO_COPY: 0},
+				"stalls_total": 0,
+				"stall_seconds_total": 0.0,
+				"jobs_total": {"finished": 0, "failed": 0}
+			}
+			self._latency = {kind: Histogram(self._latency_buckets) for kind in (IO_READ, IO_WRITE, IO_COPY)}
+			self._gauges = {
+				"progress_bytes": 0,
+				"total_bytes": 0,
+				"throughput_bytes_per_second": 0.0,
+				"eta_seconds": 0.0,
+				"running": 0,
+				"last_duration_seconds": 0.0,
+				"last_success_timestamp_seconds": 0.0
+			}
+
+	def get_labels(self) -> Dict[str, str]:
+		return dict(self._labels)
+
+	def observe_io(self, kind: str, n: int, seconds: float) -> None:
+		"""
+		Observer for copytools.observe_io
+		"""
+		with self._lock:
+			c = self._counters
+			if kind == IO_READ or kind == IO_COPY:
+				c["read_bytes_total"] += n
+			if kind == IO_WRITE or kind == IO_COPY:
+				c["written_bytes_total"] += n
+			c["syscalls_total"][kind] += 1
+			self._latency[kind].observe(seconds)
+			if seconds >= self._stall_threshold:
+				c["stalls_total"] += 1
+				c["stall_seconds_total"] += seconds
+
+	def add_skipped(self, n: int) -> None:
+		"""
+		Counts bytes that didn't have to be written (holes, zero blocks, unchanged or deduplicated blocks)
+		"""
+		if n > 0:
+			with self._lock:
+				self._counters["skipped_bytes_total"] += n
+
+	def handle_progress(self, event: ProgressEvent) -> None:
+		"""
+		Handler for a ProgressTracker
+		"""
+		with self._lock:
+			g = self._gauges
+			g["progress_bytes"] = event.done_b
+			g["total_bytes"] = event.total_b or 0
+			g["throughput_bytes_per_second"] = event.throughput
+			g["eta_seconds"] = event.eta or 0.0
+			if event.type == ProgressEventType.STARTED:
+				g["running"] = 1
+			elif event.is_final():
+				g["running"] = 0
+				g["last_duration_seconds"] = event.elapsed
+				if event.type == ProgressEventType.FINISHED and event.retcode == 0:
+					self._counters["jobs_total"]["finished"] += 1
+					g["last_success_timestamp_seconds"] = time()
+				else:
+					self._counters["jobs_total"]["failed"] += 1
+
+	def snapshot(self) -> Dict:
+		"""
+		:return: The current values as dict (histograms as dicts with "buckets", "sum" and "count")
+		"""
+		with self._lock:
+			result = {}
+			for (name, value) in self._counters.items():
+				result[name] = dict(value) if isinstance(value, dict) else value
+			result.update(self._gauges)
+			result["syscall_latency_seconds"] = {
+				kind: {"buckets": h.cumulative(), "sum": h.sum, "count": h.count}
+				for (kind, h) in self._latency.items()
+			}
+			return result
+
+	def to_prometheus(self) -> str:
+		"""
+		Renders all metrics in the Prometheus text exposition format
+		"""
+		s = self.snapshot()
+		p = self._prefix
+		lines = []
+
+		def add(name: str, mtype: str, help_text: str, samples: List[Tuple[str, Dict, object]]):
+			lines.append("# HELP {}_{} {}".format(p, name, help_text))
+			lines.append("# TYPE {}_{} {}".format(p, name, mtype))
+			for (suffix, extra, value) in samples:
+				lines.append("{}_{}{}{} {}".format(p, name, suffix, _format_labels(self._labels, extra), _format_value(value)))
+
+		add("read_bytes_total", "counter", "Bytes read from the source", [("", None, s["read_bytes_total"])])
+		add("written_bytes_total", "counter", "Bytes written to the target", [("", None, s["written_bytes_total"])])
+		add("skipped_bytes_total", "counter", "Bytes not written (holes, zeros, unchanged or deduplicated blocks)", [
+			("", None, s["skipped_bytes_total"])
+		])
+		add("syscalls_total", "counter", "I/O syscalls by kind", [
+			("", {"kind": k}, v) for (k, v) in sorted(s["syscalls_total"].items())
+		])
+		add("stalls_total", "counter", "Syscalls slower than the stall threshold", [("", None, s["stalls_total"])])
+		add("stall_seconds_total", "counter", "Seconds spent in stalled syscalls", [
+			("", None, s["stall_seconds_total"])
+		])
+		add("jobs_total", "counter", "Imaging jobs by result", [
+			("", {"result": k}, v) for (k, v) in sorted(s["jobs_total"].items())
+		])
+
+		latency = []
+		for (kind, h) in sorted(s["syscall_latency_seconds"].items()):
+			for (bound, count) in h["buckets"]:
+				latency.append(("_bucket", {"kind": kind, "le": _format_value(float(bound))}, count))
+			latency.append(("_bucket", {"kind": kind, "le": "+Inf"}, h["count"]))
+			latency.append(("_sum", {"kind": kind}, h["sum"]))
+			latency.append(("_count", {"kind": kind}, h["count"]))
+		add("syscall_latency_seconds", "histogram", "Latency of single I/O syscalls", latency)
+
+		add("progress_bytes", "gauge", "Bytes done of the current job", [("", None, s["progress_bytes"])])
+		add("total_bytes", "gauge", "Expected bytes of the current job", [("", None, s["total_bytes"])])
+		add("throughput_bytes_per_second", "gauge", "Moving average of the throughput", [
+			("", None, s["throughput_bytes_per_second"])
+		])
+		add("eta_seconds", "gauge", "Estimated seconds left", [("", None, s["eta_seconds"])])
+		add("running", "gauge", "1 while a job runs", [("", None, s["running"])])
+		add("last_duration_seconds", "gauge", "Duration of the last finished job", [
+			("", None, s["last_duration_seconds"])
+		])
+		add("last_success_timestamp_seconds", "gauge", "Unix time of the last successful job", [
+			("", None, s["last_success_timestamp_seconds"])
+		])
+
+		return "\n".join(lines) + "\n"
+
+	def write_prometheus(self, path: str) -> None:
+		"""
+		Writes the metrics atomically to a file, e.g. for the textfile collector of the node exporter
+		"""
+		tmp = "{}.{}.tmp".format(path, os.getpid())
+		with open(tmp, "w") as f:
+			f.write(self.to_prometheus())
+		os.replace(tmp, path)
+
+	def serve(self, port: int = 9477, host: str = "127.0.0.1") -> HTTPServer:
+		"""
+		Serves the metrics on http://host:port/metrics from a daemon thread
+		:return: The server, call shutdown() and server_close() on it to stop serving
+		"""
+		metrics = self
+
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] not in ("/", "/metrics"):
+					self.send_error(404)
+					return
+				body = metrics.to_prometheus().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = HTTPServer((host, port), MetricsHandler)
+		Thread(target=server.serve_forever, daemon=True).start()
+		return server
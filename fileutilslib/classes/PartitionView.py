@@ -0,0 +1,246 @@
+import io
+import mmap
+import os
+from errno import EINVAL, ENOSYS, EXDEV, EOPNOTSUPP, EBADF
+from os import O_RDONLY, O_WRONLY, O_CREAT, O_TRUNC
+from typing import Callable, Dict, Iterator, List, Tuple
+from fileutilslib.disklib.copytools import fd_size, blocksize_to_bytes, timed_io, IO_READ, IO_WRITE, IO_COPY, \
+	DEFAULT_BLOCKSIZE
+from fileutilslib.disklib.parttabletools import read_partition_table
+
+
+class PartitionView(io.RawIOBase):
+	"""
+	A read-only, seekable file object restricted to a byte range of an image file or device, usually one
+	partition of a whole-disk image. Reads are preads at the translated offset, so several views of one image
+	don't share a file position and nothing is extracted to a temporary file. map() exposes the range as a
+	memoryview of a read-only mmap, e.g. for hashing or scanning it without copying it into Python buffers.
+	"""
+
+	_fd = None
+	""":type: int"""
+
+	_owns_fd = None
+	""":type: bool"""
+
+	_offset = None
+	""":type: int"""
+
+	_length = None
+	""":type: int"""
+
+	_pos = None
+	""":type: int"""
+
+	_record = None
+	""":type: Dict"""
+
+	_mmap = None
+	""":type: mmap.mmap"""
+
+	_mapview = None
+	""":type: memoryview"""
+
+	def __init__(self, source, offset: int, length: int = None, record: Dict = None):
+		"""
+		:param source: A path (opened read-only and closed with the view) or an open file descriptor (left open)
+		:param offset: The byte offset of the range in source
+		:param length: The length of the range, None for the rest of source
+		:param record: The partition dict the range belongs to (see parttabletools.read_partition_table)
+		"""
+		super().__init__()
+		if isinstance(source, int):
+			self._fd = source
+			self._owns_fd = False
+		else:
+			self._fd = os.open(str(source), O_RDONLY)
+			self._owns_fd = True
+
+		try:
+			size_b = fd_size(self._fd)
+			if length is None:
+				length = size_b - offset
+			if offset < 0 or length < 0 or offset + length > size_b:
+				raise Exception("The range of {} bytes at byte {} exceeds the {} bytes of '{}'".format(
+					length, offset, size_b, source
+				))
+		except BaseException:
+			if self._owns_fd:
+				os.close(self._fd)
+			raise
+
+		self._offset = offset
+		self._length = length
+		self._pos = 0
+		self._record = record
+
+	def __repr__(self):
+		return "PartitionView(fd={}, offset={}, length={})".format(self._fd, self._offset, self._length)
+
+	def get_offset(self) -> int:
+		return self._offset
+
+	def get_length(self) -> int:
+		return self._length
+
+	def get_record(self) -> Dict:
+		return self._record
+
+	def readable(self) -> bool:
+		return True
+
+	def seekable(self) -> bool:
+		return True
+
+	def readinto(self, b) -> int:
+		if self.closed:
+			raise ValueError("I/O operation on closed file")
+		mv = memoryview(b).cast("B")
+		n = min(len(mv), self._length - self._pos)
+		if n <= 0:
+			return 0
+		n = timed_io(IO_READ, os.preadv, self._fd, [mv[0:n]], self._offset + self._pos)
+		self._pos += n
+		return n
+
+	def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+		if self.closed:
+			raise ValueError("I/O operation on closed file")
+		if whence == io.SEEK_SET:
+			newpos = pos
+		elif whence == io.SEEK_CUR:
+			newpos = self._pos + pos
+		elif whence == io.SEEK_END:
+			newpos = self._length + pos
+		else:
+			raise ValueError("Invalid whence ({})".format(whence))
+		if newpos < 0:
+			raise ValueError("Negative seek position {}".format(newpos))
+		# Like files, a view can be seeked past its end, where reads return nothing
+		self._pos = newpos
+		return newpos
+
+	def tell(self) -> int:
+		return self._pos
+
+	def map(self) -> memoryview:
+		"""
+		Maps the range read-only. Release the returned memoryview (and slices of it) before closing the view,
+		otherwise the mapping lives on until they are garbage collected.
+		:return: A memoryview of the whole range
+		"""
+		if self.closed:
+			raise ValueError("I/O operation on closed file")
+		if self._mapview is None:
+			if self._length == 0:
+				self._mapview = memoryview(b"")
+			else:
+				# mmap offsets have to be multiples of the allocation granularity
+				start = self._offset - self._offset % mmap.ALLOCATIONGRANULARITY
+				self._mmap = mmap.mmap(
+					self._fd, self._offset + self._length - start, access=mmap.ACCESS_READ, offset=start
+				)
+				self._mapview = memoryview(self._mmap)[self._offset - start:]
+		return self._mapview
+
+	def iter_blocks(self, blocksize=DEFAULT_BLOCKSIZE) -> Iterator[Tuple[int, memoryview]]:
+		"""
+		Walks the mapped range, the pairs fit the block_handlers of copytools (e.g. hashtools.StreamHasher)
+		:param blocksize: Bytes per block as int or dd-style string
+		:return: (offset in the view, memoryview) per block
+		"""
+		bs = blocksize_to_bytes(blocksize)
+		mv = self.map()
+		for pos in range(0, self._length, bs):
+			yield pos, mv[pos:pos + bs]
+
+	def copy_to(self, dstpath: str, blocksize=DEFAULT_BLOCKSIZE, progress_handler: Callable = None) -> int:
+		"""
+		Extracts the range into a file (or device) with copy_file_range, which shares the blocks on
+		filesystems with reflinks, or by writing from the mapped range
+		:param dstpath: The target, truncated
+		:param blocksize: Bytes per syscall as int or dd-style string
+		:param progress_handler: Called with (copied_bytes, total_bytes)
+		:return: The number of bytes copied
+		"""
+		bs = blocksize_to_bytes(blocksize)
+		dstfd = os.open(dstpath, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+		try:
+			pos = 0
+			try:
+				while pos < self._length:
+					n = timed_io(
+						IO_COPY, os.copy_file_range, self._fd, dstfd, min(bs, self._length - pos), self._offset + pos, pos
+					)
+					if n == 0:
+						break
+					pos += n
+					if progress_handler is not None:
+						progress_handler(pos, self._length)
+			except OSError as e:
+				if e.errno not in (EINVAL, ENOSYS, EXDEV, EOPNOTSUPP, EBADF):
+					raise
+				os.lseek(dstfd, pos, os.SEEK_SET)
+				mv = self.map()
+				while pos < self._length:
+					pos += timed_io(IO_WRITE, os.write, dstfd, mv[pos:min(pos + bs, self._length)])
+					if progress_handler is not None:
+						progress_handler(pos, self._length)
+			os.fsync(dstfd)
+			return pos
+		finally:
+			os.close(dstfd)
+
+	def close(self) -> None:
+		if self.closed:
+			return
+		if self._mapview is not None:
+			self._mapview.release()
+			self._mapview = None
+		if self._mmap is not None:
+			try:
+				self._mmap.close()
+			except BufferError:
+				# Slices handed out by map() are still alive, the mapping goes with them
+				pass
+			self._mmap = None
+		if self._owns_fd:
+			os.close(self._fd)
+		super().close()
+
+
+def open_partitions(imagepath: str, sector_size: int = None) -> List[PartitionView]:
+	"""
+	Opens a view per partition of a whole-disk image or device (see parttabletools.read_partition_table)
+	:return: The views in the order of the partition table, close them when done
+	"""
+	fd = os.open(str(imagepath), O_RDONLY)
+	try:
+		table = read_partition_table(fd, str(imagepath), sector_size)
+	finally:
+		os.close(fd)
+	views = []
+	try:
+		for p in table["partitions"]:
+			views.append(PartitionView(str(imagepath), p["start"] * table["sector_size"], p["size_b"], p))
+	except BaseException:
+		for view in views:
+			view.close()
+		raise
+	return views
+
+
+def open_partition(imagepath: str, partn: int, sector_size: int = None) -> PartitionView:
+	"""
+	:param partn: The partition number (e.g. 1 for sda1, logical partitions start at 5)
+	:return: A view of the partition, use it as context manager or close it when done
+	"""
+	fd = os.open(str(imagepath), O_RDONLY)
+	try:
+		table = read_partition_table(fd, str(imagepath), sector_size)
+	finally:
+		os.close(fd)
+	for p in table["partitions"]:
+		if p["partn"] == partn:
+			return PartitionView(str(imagepath), p["start"] * table["sector_size"], p["size_b"], p)
+	raise Exception("'{}' has no partition {}".format(imagepath, partn))
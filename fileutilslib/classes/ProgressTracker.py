@@ -0,0 +1,200 @@
+from enum import Enum
+from queue import Queue, Empty
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, Iterator, List
+
+
+class ProgressEventType(Enum):
+	STARTED = "started"
+	PROGRESS = "progress"
+	FINISHED = "finished"
+	FAILED = "failed"
+
+
+class ProgressEvent:
+	"""
+	A snapshot of a running job. throughput is an exponentially weighted moving average (bytes per second),
+	eta the seconds left at that throughput (None while unknown).
+	"""
+
+	__slots__ = ("type", "done_b", "total_b", "elapsed", "throughput", "eta", "retcode", "error")
+
+	def __init__(
+		self,
+		event_type: ProgressEventType,
+		done_b: int,
+		total_b: int,
+		elapsed: float,
+		throughput: float,
+		eta: float,
+		retcode: int = None,
+		error: BaseException = None
+	):
+		self.type = event_type
+		self.done_b = done_b
+		self.total_b = total_b
+		self.elapsed = elapsed
+		self.throughput = throughput
+		self.eta = eta
+		self.retcode = retcode
+		self.error = error
+
+	def is_final(self) -> bool:
+		return self.type == ProgressEventType.FINISHED or self.type == ProgressEventType.FAILED
+
+	def to_dict(self) -> Dict:
+		return {
+			"type": self.type.value,
+			"done_b": self.done_b,
+			"total_b": self.total_b,
+			"elapsed": self.elapsed,
+			"throughput": self.throughput,
+			"eta": self.eta,
+			"retcode": self.retcode,
+			"error": None if self.error is None else str(self.error)
+		}
+
+
+class ProgressTracker:
+	"""
+	Turns byte counts reported by a copy job into ProgressEvents for callbacks and iterators.
+	PROGRESS events are rate-limited to one per min_interval seconds.
+	"""
+
+	_total_b = None
+	""":type: int"""
+
+	_handlers = None
+	""":type: List[Callable]"""
+
+	_alpha = None
+	""":type: float"""
+
+	_min_interval = None
+	""":type: float"""
+
+	def __init__(self, total_b: int, handlers: List[Callable] = None, alpha: float = 0.2, min_interval: float = 0.5):
+		"""
+		:param total_b: The expected number of bytes, None if unknown
+		:param handlers: Callables receiving each ProgressEvent
+		:param alpha: Weight of the newest throughput sample in the moving average (0 < alpha <= 1)
+		:param min_interval: Minimum seconds between two PROGRESS events
+		"""
+		if not 0 < alpha <= 1:
+			raise Exception("alpha has to be in (0, 1]")
+		self._total_b = total_b
+		self._handlers = list(handlers) if handlers is not None else []
+		self._alpha = alpha
+		self._min_interval = min_interval
+		self._lock = Lock()
+		self._starttime = None
+		self._last_t = None
+		self._last_b = 0
+		self._last_emit = None
+		self._throughput = None
+		self._done_b = 0
+
+	def add_handler(self, handler: Callable) -> None:
+		with self._lock:
+			self._handlers.append(handler)
+
+	def remove_handler(self, handler: Callable) -> None:
+		with self._lock:
+			if handler in self._handlers:
+				self._handlers.remove(handler)
+
+	def has_handlers(self) -> bool:
+		return len(self._handlers) > 0
+
+	def get_done_b(self) -> int:
+		return self._done_b
+
+	def get_total_b(self) -> int:
+		return self._total_b
+
+	def set_total_b(self, total_b: int) -> None:
+		self._total_b = total_b
+
+	def _event(self, event_type: ProgressEventType, retcode: int = None, error: BaseException = None) -> ProgressEvent:
+		elapsed = 0.0 if self._starttime is None else monotonic() - self._starttime
+		eta = None
+		if self._throughput is not None and self._throughput > 0 and self._total_b is not None:
+			eta = max(0, self._total_b - self._done_b) / self._throughput
+		return ProgressEvent(
+			event_type, self._done_b, self._total_b, elapsed, self._throughput or 0.0, eta, retcode, error
+		)
+
+	def _emit(self, event: ProgressEvent) -> None:
+		for handler in list(self._handlers):
+			handler(event)
+
+	def start(self) -> None:
+		with self._lock:
+			self._starttime = monotonic()
+			self._last_t = self._starttime
+			self._last_b = 0
+			self._last_emit = None
+			self._throughput = None
+			self._done_b = 0
+			event = self._event(ProgressEventType.STARTED)
+		self._emit(event)
+
+	def update(self, done_b: int, total_b: int = None) -> None:
+		"""
+		Reports the number of bytes done so far; can be used as progress_handler of the copytools functions
+		"""
+		with self._lock:
+			if self._starttime is None:
+				self._starttime = monotonic()
+				self._last_t = self._starttime
+			if total_b is not None and self._total_b is None:
+				self._total_b = total_b
+			now = monotonic()
+			self._done_b = done_b
+			dt = now - self._last_t
+			# Samples are taken at least every 100 ms, otherwise tiny intervals make the average jump
+			if dt >= 0.1:
+				sample = (done_b - self._last_b) / dt
+				if self._throughput is None:
+					self._throughput = sample
+				else:
+					self._throughput = self._alpha * sample + (1 - self._alpha) * self._throughput
+				self._last_t = now
+				self._last_b = done_b
+			if self._last_emit is not None and now - self._last_emit < self._min_interval and (
+				self._total_b is None or done_b < self._total_b
+			):
+				return
+			self._last_emit = now
+			event = self._event(ProgressEventType.PROGRESS)
+		self._emit(event)
+
+	def finish(self, retcode: int = 0) -> None:
+		with self._lock:
+			event = self._event(ProgressEventType.FINISHED, retcode)
+		self._emit(event)
+
+	def fail(self, error: BaseException) -> None:
+		with self._lock:
+			event = self._event(ProgressEventType.FAILED, None, error)
+		self._emit(event)
+
+	def events(self, timeout: float = None) -> Iterator[ProgressEvent]:
+		"""
+		Iterates the events from now on until the job finished or failed (for consumers in another thread)
+		:param timeout: Seconds to wait for the next event before the iteration ends, None to wait forever
+		"""
+		q = Queue()
+		self.add_handler(q.put)
+		try:
+			while True:
+				try:
+					event = q.get(timeout=timeout)
+				except Empty:
+					return
+				yield event
+				if event.is_final():
+					return
+		finally:
+			self.remove_handler(q.put)
@@ -0,0 +1,84 @@
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable
+
+# The longest a throttled caller sleeps before it looks at the rate (and abort) again
+_MAX_SLEEP = 0.1
+
+
+class RateLimiter:
+	"""
+	Token bucket on bytes per second, shared by all threads of a copy. Callers report the bytes they
+	transferred with consume() and are put to sleep while the bucket is in debt. The rate can be changed
+	(or lifted) from another thread while a copy runs.
+	"""
+
+	_rate = None
+	""":type: float"""
+
+	_burst = None
+	""":type: float"""
+
+	_tokens = None
+	""":type: float"""
+
+	def __init__(self, rate_b: int = None, burst_b: int = None):
+		"""
+		:param rate_b: Bytes per second, None for no limit
+		:param burst_b: Bytes that may pass at once after an idle period, defaults to a quarter second at rate_b
+		"""
+		self._lock = Lock()
+		self._last = monotonic()
+		self._tokens = 0.0
+		self.set_rate(rate_b, burst_b)
+
+	def get_rate(self) -> float:
+		return self._rate
+
+	def set_rate(self, rate_b: int = None, burst_b: int = None) -> None:
+		if rate_b is not None and rate_b <= 0:
+			raise Exception("The rate has to be positive (None for no limit)")
+		with self._lock:
+			self._refill(monotonic())
+			self._rate = float(rate_b) if rate_b is not None else None
+			if burst_b is not None:
+				self._burst = float(burst_b)
+			elif self._rate is not None:
+				self._burst = self._rate / 4
+			else:
+				self._burst = 0.0
+			self._tokens = min(self._tokens, self._burst)
+
+	def _refill(self, now: float) -> None:
+		if self._rate is not None:
+			self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+		self._last = now
+
+	def consume(self, n: int, abort: Callable = None) -> float:
+		"""
+		Takes n bytes from the bucket and sleeps until it is out of debt
+		:param n: The bytes just transferred
+		:param abort: Called while sleeping, a True result ends the wait early
+		:return: The seconds slept
+		"""
+		start = monotonic()
+		with self._lock:
+			if self._rate is None:
+				return 0.0
+			self._refill(start)
+			self._tokens -= n
+
+		while True:
+			with self._lock:
+				if self._rate is None:
+					self._tokens = 0.0
+					break
+				self._refill(monotonic())
+				if self._tokens >= 0:
+					break
+				wait = min(-self._tokens / self._rate, _MAX_SLEEP)
+			if abort is not None and abort():
+				break
+			sleep(wait)
+
+		return monotonic() - start
@@ -0,0 +1,215 @@
+import gzip
+import lzma
+import os
+from os import O_RDONLY, O_WRONLY, O_RDWR, O_CREAT, O_TRUNC
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+from fileutilslib.classes.Bencher import Bencher
+from fileutilslib.disklib.copytools import fd_size, blocksize_to_bytes, copy_stream_compare, finish_compare_target, timed_io, IO_READ, IO_WRITE, DEFAULT_BLOCKSIZE
+
+COMPRESS_TYPE_GZIP = "gz"
+COMPRESS_TYPE_XZ = "xz"
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def compress_types() -> list:
+	return [COMPRESS_TYPE_GZIP, COMPRESS_TYPE_XZ]
+
+
+def _compressor(compress_type: str, level: int=None) -> Callable:
+	if compress_type == COMPRESS_TYPE_GZIP:
+		lvl = 6 if level is None else level
+		return lambda data: gzip.compress(data, lvl)
+	elif compress_type == COMPRESS_TYPE_XZ:
+		preset = 6 if level is None else level
+		return lambda data: lzma.compress(data, lzma.FORMAT_XZ, preset=preset)
+	else:
+		raise Exception("Wrong compression algorithm (use {})".format(" or ".join(compress_types())))
+
+
+def _read_chunk(fd: int, size: int) -> bytes:
+	data = timed_io(IO_READ, os.read, fd, size)
+	if 0 < len(data) < size:
+		parts = [data]
+		got = len(data)
+		while got < size:
+			d = timed_io(IO_READ, os.read, fd, size - got)
+			if len(d) == 0:
+				break
+			parts.append(d)
+			got += len(d)
+		data = b"".join(parts)
+	return data
+
+
+def compress_fd(
+	srcfd: int,
+	dstfd: int,
+	compress_type: str=COMPRESS_TYPE_GZIP,
+	level: int=None,
+	chunk_size: int=DEFAULT_CHUNK_SIZE,
+	workers: int=None,
+	progress_handler: Callable=None,
+	block_handler: Callable=None
+) -> int:
+	"""
+	Compresses srcfd into dstfd in a single pass the way pigz does it: The input is cut into fixed-size chunks,
+	which are compressed concurrently (zlib and lzma release the GIL) and written as independent gzip members
+	or xz streams in input order. gzip, xz and the gzip/lzma modules read such concatenations transparently.
+	At most 2 * workers chunks are held in memory.
+	:param srcfd: The source file descriptor, read from its current position to the end
+	:param dstfd: The target file descriptor, written at its current position
+	:param compress_type: COMPRESS_TYPE_GZIP or COMPRESS_TYPE_XZ
+	:param level: Compression level (gzip: 1-9, xz: preset 0-9), defaults to 6
+	:param chunk_size: Uncompressed bytes per chunk
+	:param workers: Number of compressing threads, defaults to the number of CPUs
+	:param progress_handler: Called with (read_bytes, total_bytes) each time a chunk was written
+	:param block_handler: Called with (offset, data) for each uncompressed chunk in order
+	:return: The number of compressed bytes written
+	"""
+	compress = _compressor(compress_type, level)
+	w = workers if workers is not None and workers > 0 else (os.cpu_count() or 1)
+	max_pending = 2 * w
+	total = fd_size(srcfd)
+	pending = deque()
+	read_b = 0
+	written_b = 0
+
+	def write_oldest():
+		nonlocal written_b
+		(end, future) = pending.popleft()
+		cdata = future.result()
+		mv = memoryview(cdata)
+		while len(mv) > 0:
+			mv = mv[timed_io(IO_WRITE, os.write, dstfd, mv):]
+		written_b += len(cdata)
+		if progress_handler is not None:
+			progress_handler(end, total)
+
+	with ThreadPoolExecutor(max_workers=w) as executor:
+		while True:
+			data = _read_chunk(srcfd, chunk_size)
+			if len(data) == 0:
+				break
+			if block_handler is not None:
+				block_handler(read_b, data)
+			read_b += len(data)
+			pending.append((read_b, executor.submit(compress, data)))
+			if len(pending) >= max_pending:
+				write_oldest()
+		while len(pending) > 0:
+			write_oldest()
+
+	return written_b
+
+
+@Bencher("compresstools.compress_path")
+def compress_path(
+	srcpath: str,
+	dstpath: str,
+	compress_type: str=COMPRESS_TYPE_GZIP,
+	level: int=None,
+	chunk_size=DEFAULT_CHUNK_SIZE,
+	workers: int=None,
+	progress_handler: Callable=None,
+	block_handler: Callable=None
+) -> int:
+	"""
+	Compresses a file or block device into dstpath (see compress_fd)
+	:param chunk_size: Uncompressed bytes per chunk as int or dd-style string (e.g. "4M")
+	:return: The number of compressed bytes written
+	"""
+	srcfd = os.open(srcpath, O_RDONLY)
+	try:
+		dstfd = os.open(dstpath, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+		try:
+			written = compress_fd(
+				srcfd, dstfd, compress_type, level, blocksize_to_bytes(chunk_size), workers, progress_handler,
+				block_handler
+			)
+			os.fsync(dstfd)
+			return written
+		finally:
+			os.close(dstfd)
+	finally:
+		os.close(srcfd)
+
+
+def open_compressed(path: str, compress_type: str=None):
+	"""
+	Opens a compressed image for reading. The type is guessed from the file suffix if not given.
+	:return: A binary file object
+	"""
+	ct = compress_type
+	if ct is None:
+		ct = COMPRESS_TYPE_XZ if path.endswith("." + COMPRESS_TYPE_XZ) else COMPRESS_TYPE_GZIP
+	if ct == COMPRESS_TYPE_GZIP:
+		return gzip.open(path, "rb")
+	elif ct == COMPRESS_TYPE_XZ:
+		return lzma.open(path, "rb")
+	else:
+		raise Exception("Wrong compression algorithm (use {})".format(" or ".join(compress_types())))
+
+
+@Bencher("compresstools.decompress_path")
+def decompress_path(
+	srcpath: str,
+	dstpath: str,
+	compress_type: str=None,
+	blocksize=DEFAULT_BLOCKSIZE,
+	truncate: bool=True,
+	progress_handler: Callable=None,
+	total_b: int=None
+) -> int:
+	"""
+	Decompresses an image created with compress_path into a file or onto a device
+	:param truncate: Truncate the target first (set to False when writing to devices)
+	:param progress_handler: Called with (written_bytes, total_b) after each block
+	:param total_b: The expected uncompressed size passed to progress_handler, None if unknown
+	:return: The number of uncompressed bytes written
+	"""
+	buffer = bytearray(blocksize_to_bytes(blocksize))
+	mv = memoryview(buffer)
+	written = 0
+	with open_compressed(srcpath, compress_type) as f:
+		dstfd = os.open(dstpath, O_WRONLY | O_CREAT | (O_TRUNC if truncate else 0), 0o644)
+		try:
+			while True:
+				n = timed_io(IO_READ, f.readinto, mv)
+				if n == 0:
+					break
+				wmv = mv[0:n]
+				while len(wmv) > 0:
+					wmv = wmv[timed_io(IO_WRITE, os.write, dstfd, wmv):]
+				written += n
+				if progress_handler is not None:
+					progress_handler(written, total_b)
+			os.fsync(dstfd)
+		finally:
+			os.close(dstfd)
+	return written
+
+
+@Bencher("compresstools.decompress_path_compare")
+def decompress_path_compare(
+	srcpath: str,
+	dstpath: str,
+	compress_type: str=None,
+	blocksize=DEFAULT_BLOCKSIZE,
+	progress_handler: Callable=None,
+	total_b: int=None
+) -> Dict:
+	"""
+	Decompresses an image onto a file or device with compare-before-write (see copytools.copy_fd_range_compare)
+	:return: A dict with the processed ("size_b"), written ("written_b") and skipped ("skipped_b") bytes
+	"""
+	with open_compressed(srcpath, compress_type) as f:
+		dstfd = os.open(dstpath, O_RDWR | O_CREAT, 0o644)
+		try:
+			result = copy_stream_compare(f, dstfd, blocksize_to_bytes(blocksize), progress_handler, total_b)
+			finish_compare_target(dstfd, result["size_b"])
+			return result
+		finally:
+			os.close(dstfd)
@@ -1,11 +1,53 @@
+import os
+import re
+from select import select
+from typing import Iterator
 from fileutilslib.misclib.helpertools import humantime, strip
 
+_LINE_SEPARATORS = re.compile(b"[\r\n]")
+
+
+def is_dd_progress_line(line: str) -> bool:
+	"""
+	True for the lines of dd (run with LC_ALL=C) that parse_dd_info understands, False for "records in/out"
+	"""
+	return len(line) > 0 and line[0].isdigit() and " bytes" in line and " copied, " in line
+
+
+def iter_dd_output_lines(stream, chunk_size: int = 4096, timeout: float = 1.0) -> Iterator[str]:
+	"""
+	Reads the stderr of dd in chunks (select + read instead of byte by byte) and yields each line.
+	status=progress terminates its lines with "\r", the summary with "\n".
+	:param stream: A pipe or its file descriptor
+	:param chunk_size: Maximum bytes per read
+	:param timeout: Seconds select waits before checking again
+	"""
+	fd = stream if isinstance(stream, int) else stream.fileno()
+	buf = b""
+	while True:
+		(readable, _, _) = select([fd], [], [], timeout)
+		if len(readable) == 0:
+			continue
+		data = os.read(fd, chunk_size)
+		if len(data) == 0:
+			break
+		parts = _LINE_SEPARATORS.split(buf + data)
+		buf = parts.pop()
+		for part in parts:
+			line = strip(part.decode("utf-8", errors="replace"))
+			if len(line) > 0:
+				yield line
+	line = strip(buf.decode("utf-8", errors="replace"))
+	if len(line) > 0:
+		yield line
+
 
 def parse_dd_info(line):
 	bytestrpos = line.find(" ")
 	bytestr = strip(line[0:bytestrpos])
 	byteint = int(bytestr)
-	brackpos = line.find(")")
+	# Counts below 1 kB are printed without the human-readable size in brackets
+	brackpos = max(line.find(")"), 0)
 	tmstartpos = line.find(",", brackpos)
 	nextcommapos = line.find(",", tmstartpos + 1)
 	charbeforecomma = line[nextcommapos-1:nextcommapos]
@@ -39,7 +81,8 @@ def parse_dd_info(line):
 			if tm_comma_pos > -1:
 				tm = int(tm[0:tm_comma_pos])
 			else:
-				tm = int(tm.strip("s").strip())
+				# dd prints fractional seconds with a dot in the C locale
+				tm = int(float(tm.strip("s").strip()))
 		elif is_mins:
 				tm = int(tm.strip("m").strip()) * 60
 		elif is_hours:
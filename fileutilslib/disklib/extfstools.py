@@ -0,0 +1,429 @@
+import os
+import re
+import struct
+from os import O_RDONLY, O_WRONLY, O_CREAT, O_TRUNC
+from typing import Callable, Dict, List, Tuple
+from fileutilslib.classes.Bencher import Bencher
+from fileutilslib.disklib.copytools import copy_fd_range, fd_size, blocksize_to_bytes, DEFAULT_BLOCKSIZE
+from fileutilslib.disklib.parttabletools import read_partition_table
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPERBLOCK_SIZE = 1024
+EXT_MAGIC = 0xef53
+
+EXT_STATE_VALID = 0x0001
+
+EXT_COMPAT_HAS_JOURNAL = 0x0004
+EXT_COMPAT_SPARSE_SUPER2 = 0x0200
+
+EXT_INCOMPAT_RECOVER = 0x0004
+EXT_INCOMPAT_JOURNAL_DEV = 0x0008
+EXT_INCOMPAT_META_BG = 0x0010
+EXT_INCOMPAT_EXTENTS = 0x0040
+EXT_INCOMPAT_64BIT = 0x0080
+EXT_INCOMPAT_FLEX_BG = 0x0200
+
+EXT_RO_COMPAT_SPARSE_SUPER = 0x0001
+EXT_RO_COMPAT_GDT_CSUM = 0x0010
+EXT_RO_COMPAT_BIGALLOC = 0x0200
+EXT_RO_COMPAT_METADATA_CSUM = 0x0400
+
+EXT_BG_BLOCK_UNINIT = 0x0002
+
+# s_inodes_count up to s_inodes_per_group
+_SUPERBLOCK_HEAD = struct.Struct("<IIIIIIIIIII")
+
+_MIN_DESC_SIZE = 32
+
+# Runs of bytes of a bitmap with at least one allocated block
+_USED_BYTES = re.compile(b"[^\x00]+")
+
+
+def read_ext_superblock(fd: int, offset: int = 0) -> Dict:
+	"""
+	Reads the superblock of an ext2/3/4 filesystem
+	:param fd: The device, partition or image
+	:param offset: The byte offset of the filesystem in fd (e.g. the start of a partition)
+	:return: A dict with the geometry and feature flags, None if there is no ext filesystem at offset
+	"""
+	raw = os.pread(fd, EXT_SUPERBLOCK_SIZE, offset + EXT_SUPERBLOCK_OFFSET)
+	if len(raw) < EXT_SUPERBLOCK_SIZE or struct.unpack_from("<H", raw, 56)[0] != EXT_MAGIC:
+		return None
+
+	(
+		inodes_count, blocks_lo, _, free_lo, _, first_data_block, log_block_size, log_cluster_size,
+		blocks_per_group, clusters_per_group, inodes_per_group
+	) = _SUPERBLOCK_HEAD.unpack_from(raw, 0)
+	state = struct.unpack_from("<H", raw, 58)[0]
+	rev_level = struct.unpack_from("<I", raw, 76)[0]
+	(compat, incompat, ro_compat) = struct.unpack_from("<III", raw, 92)
+	is64 = incompat & EXT_INCOMPAT_64BIT != 0
+
+	block_size = 1024 << log_block_size
+	bigalloc = ro_compat & EXT_RO_COMPAT_BIGALLOC != 0
+	blocks_count = blocks_lo | (struct.unpack_from("<I", raw, 336)[0] << 32 if is64 else 0)
+	if block_size > 65536 or blocks_per_group == 0 or blocks_count <= first_data_block:
+		raise Exception("Corrupt ext superblock at byte {}".format(offset + EXT_SUPERBLOCK_OFFSET))
+
+	desc_size = struct.unpack_from("<H", raw, 254)[0] if is64 else 0
+	if desc_size < _MIN_DESC_SIZE:
+		desc_size = _MIN_DESC_SIZE
+
+	if incompat & EXT_INCOMPAT_EXTENTS or incompat & EXT_INCOMPAT_64BIT or incompat & EXT_INCOMPAT_FLEX_BG:
+		fstype = "ext4"
+	elif compat & EXT_COMPAT_HAS_JOURNAL:
+		fstype = "ext3"
+	else:
+		fstype = "ext2"
+
+	return {
+		"type": fstype,
+		"offset": offset,
+		"block_size": block_size,
+		# Bitmaps of bigalloc filesystems have one bit per cluster of blocks
+		"cluster_size": 1024 << log_cluster_size if bigalloc else block_size,
+		"blocks_count": blocks_count,
+		"free_blocks_count": free_lo | (struct.unpack_from("<I", raw, 344)[0] << 32 if is64 else 0),
+		"first_data_block": first_data_block,
+		"blocks_per_group": blocks_per_group,
+		"clusters_per_group": clusters_per_group if bigalloc else blocks_per_group,
+		"inodes_count": inodes_count,
+		"inodes_per_group": inodes_per_group,
+		"inode_size": struct.unpack_from("<H", raw, 88)[0] if rev_level > 0 else 128,
+		"groups_count": (blocks_count - first_data_block + blocks_per_group - 1) // blocks_per_group,
+		"desc_size": desc_size,
+		"reserved_gdt_blocks": struct.unpack_from("<H", raw, 206)[0],
+		"first_meta_bg": struct.unpack_from("<I", raw, 260)[0],
+		"backup_bgs": struct.unpack_from("<II", raw, 588),
+		"state": state,
+		"feature_compat": compat,
+		"feature_incompat": incompat,
+		"feature_ro_compat": ro_compat,
+		"uuid": raw[104:120].hex(),
+		"label": raw[120:136].split(b"\0", 1)[0].decode("utf-8", "replace")
+	}
+
+
+def _is_power_of(n: int, base: int) -> bool:
+	while n > 1 and n % base == 0:
+		n //= base
+	return n == 1
+
+
+def group_has_super(sb: Dict, group: int) -> bool:
+	"""
+	:return: Whether the block group holds a copy of the superblock and the group descriptors
+	"""
+	if group == 0:
+		return True
+	if sb["feature_compat"] & EXT_COMPAT_SPARSE_SUPER2:
+		return group in sb["backup_bgs"]
+	if group == 1 or not sb["feature_ro_compat"] & EXT_RO_COMPAT_SPARSE_SUPER:
+		return True
+	if group % 2 == 0:
+		return False
+	return _is_power_of(group, 3) or _is_power_of(group, 5) or _is_power_of(group, 7)
+
+
+def _group_first_block(sb: Dict, group: int) -> int:
+	return sb["first_data_block"] + group * sb["blocks_per_group"]
+
+
+def _desc_per_block(sb: Dict) -> int:
+	return sb["block_size"] // sb["desc_size"]
+
+
+def _superblock_block(sb: Dict) -> int:
+	# Not always first_data_block, which is 0 for bigalloc filesystems with 1 KiB blocks
+	return EXT_SUPERBLOCK_OFFSET // sb["block_size"]
+
+
+def _descriptor_block(sb: Dict, n: int) -> int:
+	"""
+	The block of the n-th block of group descriptors, the primary copy
+	"""
+	if not sb["feature_incompat"] & EXT_INCOMPAT_META_BG or n < sb["first_meta_bg"]:
+		return _superblock_block(sb) + 1 + n
+	group = n * _desc_per_block(sb)
+	return _group_first_block(sb, group) + (1 if group_has_super(sb, group) else 0)
+
+
+def _group_base_blocks(sb: Dict, group: int) -> int:
+	"""
+	The number of blocks at the start of a group taken by superblock and descriptors. Together with the bitmaps
+	and inode tables these are the blocks the kernel reports allocated for a group with BLOCK_UNINIT set.
+	"""
+	n = 1 if group_has_super(sb, group) else 0
+	gdt_blocks = (sb["groups_count"] + _desc_per_block(sb) - 1) // _desc_per_block(sb)
+	if not sb["feature_incompat"] & EXT_INCOMPAT_META_BG:
+		return n + gdt_blocks + sb["reserved_gdt_blocks"] if n > 0 else 0
+	first_meta_group = sb["first_meta_bg"] * _desc_per_block(sb)
+	if group < first_meta_group:
+		return n + sb["first_meta_bg"] + sb["reserved_gdt_blocks"] if n > 0 else 0
+	# Meta groups keep their block of descriptors in their first, second and last group
+	index = group % _desc_per_block(sb)
+	return n + (1 if index in (0, 1, _desc_per_block(sb) - 1) else 0)
+
+
+def read_group_descriptors(fd: int, sb: Dict) -> List[Tuple[int, int, int, int]]:
+	"""
+	:param sb: The superblock as returned by read_ext_superblock
+	:return: (block bitmap, inode bitmap, inode table, flags) per block group, as block numbers
+	"""
+	bs = sb["block_size"]
+	dsize = sb["desc_size"]
+	per_block = _desc_per_block(sb)
+	is64 = sb["feature_incompat"] & EXT_INCOMPAT_64BIT and dsize > _MIN_DESC_SIZE
+	descs = []
+	n = 0
+	while len(descs) < sb["groups_count"]:
+		# Without meta_bg the descriptors are contiguous, read them at once
+		if not sb["feature_incompat"] & EXT_INCOMPAT_META_BG:
+			count = (sb["groups_count"] + per_block - 1) // per_block
+		else:
+			count = 1
+		pos = sb["offset"] + _descriptor_block(sb, n) * bs
+		raw = os.pread(fd, count * bs, pos)
+		if len(raw) < count * bs:
+			raise Exception("Unexpected end of the device at byte {}".format(pos + len(raw)))
+		for p in range(0, min(count * per_block, sb["groups_count"] - len(descs)) * dsize, dsize):
+			(bbitmap, ibitmap, itable) = struct.unpack_from("<III", raw, p)
+			flags = struct.unpack_from("<H", raw, p + 18)[0]
+			if is64:
+				(bhi, ihi, thi) = struct.unpack_from("<III", raw, p + 32)
+				bbitmap |= bhi << 32
+				ibitmap |= ihi << 32
+				itable |= thi << 32
+			if max(bbitmap, ibitmap, itable) >= sb["blocks_count"]:
+				raise Exception("Corrupt ext group descriptor {} at byte {}".format(len(descs), sb["offset"]))
+			descs.append((bbitmap, ibitmap, itable, flags))
+		n += count
+	return descs
+
+
+def _bitmap_extents(bitmap: bytes, nbits: int) -> List[Tuple[int, int]]:
+	"""
+	:return: (first, end) of the runs of set bits (LSB first) in the first nbits bits, as bit numbers. Clear bits
+	between set bits of the same run of non-zero bytes are included, which saves syscalls for a few blocks.
+	"""
+	result = []
+	for m in _USED_BYTES.finditer(bitmap, 0, (nbits + 7) // 8):
+		(s, e) = m.span()
+		first = bitmap[s]
+		last = bitmap[e - 1]
+		start = s * 8 + ((first & -first).bit_length() - 1)
+		end = (e - 1) * 8 + last.bit_length()
+		if start < nbits:
+			result.append((start, min(end, nbits)))
+	return result
+
+
+def _merge(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+	result = []
+	for (start, end) in sorted(ranges):
+		if len(result) > 0 and start <= result[-1][1]:
+			if end > result[-1][1]:
+				result[-1] = (result[-1][0], end)
+		else:
+			result.append((start, end))
+	return result
+
+
+def _check_consistent(sb: Dict) -> None:
+	if sb["feature_incompat"] & EXT_INCOMPAT_JOURNAL_DEV:
+		raise Exception("The ext filesystem at byte {} is an external journal".format(sb["offset"]))
+	if sb["feature_incompat"] & EXT_INCOMPAT_RECOVER or (
+		not sb["feature_compat"] & EXT_COMPAT_HAS_JOURNAL and not sb["state"] & EXT_STATE_VALID
+	):
+		# Blocks allocated by transactions in the journal aren't in the bitmaps yet
+		raise Exception(
+			"The ext filesystem at byte {} is mounted or wasn't cleanly unmounted, unmount it or run e2fsck"
+			.format(sb["offset"])
+		)
+
+
+@Bencher("extfstools.ext_used_ranges")
+def ext_used_ranges(fd: int, offset: int = 0, sb: Dict = None) -> List[Tuple[int, int]]:
+	"""
+	Lists the parts of an ext2/3/4 filesystem that have to be copied to image it: boot block and superblock,
+	the blocks allocated in the block bitmaps (which cover descriptors, journal, inode tables and files) and
+	the bitmaps and inode tables of all groups. Groups whose bitmap was never initialized (BLOCK_UNINIT)
+	contribute their metadata only. Like partclone, everything else holds no data and needn't be read.
+	:param fd: The device, partition or image
+	:param offset: The byte offset of the filesystem in fd
+	:param sb: The superblock if already read (see read_ext_superblock)
+	:return: Sorted and merged (start, end) byte ranges, relative to fd
+	"""
+	if sb is None:
+		sb = read_ext_superblock(fd, offset)
+		if sb is None:
+			raise Exception("No ext filesystem at byte {}".format(offset))
+	_check_consistent(sb)
+
+	bs = sb["block_size"]
+	cluster_blocks = sb["cluster_size"] // bs
+	has_csum = sb["feature_ro_compat"] & (EXT_RO_COMPAT_GDT_CSUM | EXT_RO_COMPAT_METADATA_CSUM) != 0
+	itable_blocks = (sb["inodes_per_group"] * sb["inode_size"] + bs - 1) // bs
+
+	# Blocks, end exclusive; the boot block precedes the groups of filesystems with 1 KiB blocks
+	blocks = [(0, _superblock_block(sb) + 1)]
+	for (group, (bbitmap, ibitmap, itable, flags)) in enumerate(read_group_descriptors(fd, sb)):
+		first = _group_first_block(sb, group)
+		blocks.append((bbitmap, bbitmap + 1))
+		blocks.append((ibitmap, ibitmap + 1))
+		blocks.append((itable, itable + itable_blocks))
+		if has_csum and flags & EXT_BG_BLOCK_UNINIT:
+			base = _group_base_blocks(sb, group)
+			if base > 0:
+				blocks.append((first, first + base))
+			continue
+		count = min(sb["blocks_count"] - first, sb["blocks_per_group"])
+		bitmap = os.pread(fd, bs, offset + bbitmap * bs)
+		for (s, e) in _bitmap_extents(bitmap, (count + cluster_blocks - 1) // cluster_blocks):
+			blocks.append((first + s * cluster_blocks, min(first + e * cluster_blocks, first + count)))
+
+	return [(offset + s * bs, offset + e * bs) for (s, e) in _merge(blocks)]
+
+
+def used_ranges(fd: int, size_b: int = None) -> Tuple[List[Tuple[int, int]], List[Dict]]:
+	"""
+	The parts of a device or image holding data as far as its ext filesystems tell. Without an ext
+	filesystem at the start, the partition table is read and each ext partition contributes its ext_used_ranges;
+	everything else (partition tables, boot loader gaps, other filesystems, space behind the end of a
+	filesystem) counts as used.
+	:return: Sorted and merged (start, end) byte ranges and the superblocks of the filesystems found
+	"""
+	if size_b is None:
+		size_b = fd_size(fd)
+	sb = read_ext_superblock(fd)
+	if sb is not None:
+		areas = [(0, size_b, sb)]
+	else:
+		areas = []
+		table = read_partition_table(fd)
+		for part in table["partitions"]:
+			start = part["start"] * table["sector_size"]
+			sb = read_ext_superblock(fd, start)
+			if sb is not None:
+				areas.append((start, min(start + part["size_b"], size_b), sb))
+
+	ranges = []
+	sbs = []
+	pos = 0
+	for (start, end, sb) in sorted(areas, key=lambda a: a[0]):
+		if start < pos:
+			# Overlapping partitions (e.g. an extended one) are copied as they are
+			continue
+		ranges.append((pos, start))
+		ranges.extend(ext_used_ranges(fd, start, sb))
+		pos = min(start + sb["blocks_count"] * sb["block_size"], end)
+		ranges.append((pos, end))
+		pos = end
+		sbs.append(sb)
+	ranges.append((pos, size_b))
+	return ([(s, min(e, size_b)) for (s, e) in _merge(r for r in ranges if r[0] < r[1]) if s < size_b], sbs)
+
+
+def used_sizebytes(path: str) -> int:
+	"""
+	:return: The bytes copy_path_used would copy from the device or image
+	"""
+	fd = os.open(path, O_RDONLY)
+	try:
+		return sum(e - s for (s, e) in used_ranges(fd)[0])
+	finally:
+		os.close(fd)
+
+
+def copy_fd_range_used(
+	srcfd: int,
+	dstfd: int,
+	ranges: List[Tuple[int, int]],
+	size_b: int,
+	blocksize: int = DEFAULT_BLOCKSIZE,
+	progress_handler: Callable = None,
+	block_handler: Callable = None
+) -> Dict:
+	"""
+	Copies the ranges of srcfd to the same offsets in dstfd and leaves the rest of the size_b bytes as holes,
+	so the target has to be a fresh or truncated file
+	:param ranges: Sorted (start, end) byte ranges, see used_ranges
+	:param size_b: The size of the target
+	:param blocksize: Bytes per syscall
+	:param progress_handler: Called with (processed_bytes, size_b), skipped bytes count as processed
+	:param block_handler: Called with (offset, memoryview) for each block in order, skipped bytes as zeros
+	:return: A dict with the processed ("size_b"), written ("written_b") and skipped ("skipped_b") bytes
+	"""
+	zeros = memoryview(bytes(blocksize))
+	buffer = bytearray(blocksize) if block_handler is not None else None
+	written = 0
+	pos = 0
+
+	def skip(to):
+		nonlocal pos
+		while block_handler is not None and pos < to:
+			n = min(blocksize, to - pos)
+			block_handler(pos, zeros[0:n])
+			pos += n
+		pos = to
+		if progress_handler is not None:
+			progress_handler(pos, size_b)
+
+	def progress(done, _):
+		if progress_handler is not None:
+			progress_handler(pos + done, size_b)
+
+	for (start, end) in ranges:
+		skip(start)
+		n = copy_fd_range(
+			srcfd, dstfd, start, end - start, blocksize, progress, buffer=buffer, block_handler=block_handler
+		)
+		written += n
+		pos = start + n
+		if n < end - start:
+			raise Exception("Unexpected end of the source at byte {}".format(pos))
+	skip(size_b)
+
+	if fd_size(dstfd) < size_b:
+		os.ftruncate(dstfd, size_b)
+
+	return {
+		"size_b": size_b,
+		"written_b": written,
+		"skipped_b": size_b - written
+	}
+
+
+@Bencher("extfstools.copy_path_used")
+def copy_path_used(
+	srcpath: str,
+	dstpath: str,
+	blocksize=DEFAULT_BLOCKSIZE,
+	progress_handler: Callable = None,
+	block_handler: Callable = None
+) -> Dict:
+	"""
+	Images a device, partition or image file copying only what its ext2/3/4 filesystems use (see used_ranges),
+	the free blocks become holes of the target file. Restoring the image writes zeros in their place.
+	:param srcpath: Path of the source (e.g. /dev/sde1)
+	:param dstpath: Path of the target file, truncated
+	:param blocksize: Bytes per syscall as int or dd-style string (e.g. "4M")
+	:param progress_handler: Called with (processed_bytes, total_bytes)
+	:param block_handler: Called with (offset, memoryview) for each block in order, free blocks as zeros
+	:return: See copy_fd_range_used, plus the superblocks of the filesystems in "filesystems"
+	"""
+	bs = blocksize_to_bytes(blocksize)
+	srcfd = os.open(srcpath, O_RDONLY)
+	try:
+		size_b = fd_size(srcfd)
+		(ranges, sbs) = used_ranges(srcfd, size_b)
+		dstfd = os.open(dstpath, O_WRONLY | O_CREAT | O_TRUNC, 0o644)
+		try:
+			result = copy_fd_range_used(srcfd, dstfd, ranges, size_b, bs, progress_handler, block_handler)
+			os.fsync(dstfd)
+		finally:
+			os.close(dstfd)
+	finally:
+		os.close(srcfd)
+	result["filesystems"] = sbs
+	return result
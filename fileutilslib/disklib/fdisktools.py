@@ -1,7 +1,25 @@
+import re
+from functools import lru_cache
 from plumbum import local
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from fileutilslib.disklib.filetools import bytes_to_unit, FileSizes
 from fileutilslib.misclib.helpertools import string_is_empty, strip, find_char_backwards
+from fileutilslib.disklib.sysfstools import print_devices
+
+# Keys of the partition table header's columns in the parsed dicts, older fdisk versions print Blocks and System
+_COLUMN_KEYS = {"Device": "dev", "Type": "type", "System": "type", "Name": "type"}
+_INT_KEYS = ("start", "end", "sectors", "cylinders")
+_TEXT_COLUMNS = ("Type", "System", "Name")
+
+_DISK_LINE = re.compile(r"^Disk (/\S+): (.+?), (\d+) bytes")
+_UNITS_LINE = re.compile(r"^Units: .*= (\d+) bytes")
+
+_NTFS_TYPE = "HPFS/NTFS/exFAT"
+
+DEFAULT_SECTOR_SIZE = 512
+
+DOS_PARTITION_COLUMNS = ("Device", "Boot", "Start", "End", "Sectors", "Size", "Id", "Type")
+GPT_PARTITION_COLUMNS = ("Device", "Start", "End", "Sectors", "Size", "Type")
 
 
 def predict_job_time(secs, target_sizebytes, current_sizebytes):
@@ -63,117 +81,174 @@ def fdiskdevicesize(devs_from_fdisk, device_name: str):
 	return dev_size
 
 
-def fdisklist(dbgout: bool=True) -> List[str]:
+def fdisklist(dbgout: bool=True) -> List[Dict]:
 	sudo = local["sudo"]
 	fdisk = local["fdisk"]
-	retcode, stdout, stderr = sudo[fdisk["-l"]].run(retcode=None)
+	env = local["env"]
+	# The parser relies on the English header and dots as decimal separator
+	retcode, stdout, stderr = sudo[env["LC_ALL=C", fdisk["-l"]]].run(retcode=None)
 
 	if retcode != 0:
 		raise Exception(stderr)
 
-	devs = []
+	devs = parse_fdisk_output(stdout)
+
+	if dbgout:
+		print_devices(devs)
+
+	return devs
+
 
-	startedpartitions = False
-	isboottype = False
+def parse_fdisk_output(output: str) -> List[Dict]:
+	"""
+	Parses the complete output of "fdisk -l" in one pass. The partition tables are parsed by the column names
+	of their header rows (see parse_partition_line).
+	:return: One dict per disk with "dev", "size_b", "size_h", "isntfs", "sector_size", "disklabel", "model",
+	"identifier" and "partitions"
+	"""
+	devs = []
+	dev = None
+	columns = None
 
-	for line in stdout.splitlines():
+	for line in output.splitlines():
 		line = line.strip()
 
-		if startedpartitions is True:
+		if columns is not None:
 			if len(line) == 0:
-				startedpartitions = False
+				columns = None
 			else:
-				pd = parse_partition_line(line, isboottype)
-				if dbgout:
-					print("\t" + pd["dev"] + " - " + pd["size_h"] + " - " + pd["type"])
+				pd = parse_partition_line(line, False, columns, dev["sector_size"])
 				dev["partitions"].append(pd)
-		else:
-			if line.startswith("Disk /dev/"):
-				sizeinfo = parse_device_sizeinfo(line)
-				devstr = line[5:line.find(":")]
+				if pd["isntfs"]:
+					dev["isntfs"] = True
+			continue
+
+		if line.startswith("Disk "):
+			m = _DISK_LINE.match(line)
+			if m is not None:
+				size_b = int(m.group(3))
 				dev = {
-					"dev": devstr,
+					"dev": m.group(1),
 					"isntfs": False,
 					"partitions": [],
-					"size_b": sizeinfo["size_b"],
-					"size_h": sizeinfo["size_h"]
+					"size_b": size_b,
+					"size_h": bytes_to_unit(size_b, True),
+					"sector_size": DEFAULT_SECTOR_SIZE,
+					"disklabel": None,
+					"model": None,
+					"identifier": None
 				}
 				devs.append(dev)
-				if dbgout:
-					print("=========================================")
-					print(line)
-			if line.startswith("Disklabel"):
-				if dbgout:
-					print(line)
-			if line.startswith("Disk identifier"):
-				if dbgout:
-					print(line)
-
-			if line.startswith("Device "):
-				isboottype = False
-				if line.find("Boot") > -1:
-					isboottype = True
-
-				startedpartitions = True
-
-			if line.find("HPFS/NTFS/exFAT") > -1:
-				devs[len(devs)-1]["isntfs"] = True
-				if dbgout:
-					print("NTFS")
+			elif dev is not None:
+				if line.startswith("Disk model:"):
+					dev["model"] = strip(line[11:])
+				elif line.startswith("Disk identifier:"):
+					dev["identifier"] = strip(line[16:])
+		elif dev is None:
+			continue
+		elif line.startswith("Units:"):
+			m = _UNITS_LINE.match(line)
+			if m is not None:
+				dev["sector_size"] = int(m.group(1))
+		elif line.startswith("Disklabel type:"):
+			dev["disklabel"] = strip(line[15:])
+		elif line.startswith("Device "):
+			columns = parse_partition_header(line)
+
 	return devs
 
 
 def parse_device_sizeinfo(line: str) -> Dict:
 	if string_is_empty(line):
 		return None
-	p = line.find("bytes")
-	c = find_char_backwards(line, ",", len(line) - p)
-	fsize = int(strip(line[(p - c):p]))
+	m = _DISK_LINE.match(strip(line))
+	if m is not None:
+		fsize = int(m.group(3))
+	else:
+		p = line.find("bytes")
+		c = find_char_backwards(line, ",", len(line) - p)
+		fsize = int(strip(line[(p - c):p]))
 	return {
 		"size_b": fsize,
 		"size_h": bytes_to_unit(fsize, True)
 	}
 
 
-def parse_partition_line(line: str, isboottype: bool) -> Dict:
-
+def parse_partition_header(line: str) -> List[str]:
+	"""
+	:return: The column names of a partition table header row (e.g. "Device Boot Start End Sectors Size Id Type")
+	"""
+	return line.split()
+
+
+@lru_cache(maxsize=64)
+def _partition_layout(columns: Tuple[str, ...]) -> Tuple[List[str], str, List[str]]:
+	"""
+	:return: The keys of the columns before the type column, the type column's key and the keys after it
+	"""
+	texti = len(columns) - 1
+	for name in _TEXT_COLUMNS:
+		if name in columns:
+			texti = columns.index(name)
+			break
+	keys = [_COLUMN_KEYS.get(name, name.lower()) for name in columns]
+	return keys[0:texti], keys[texti], keys[texti + 1:]
+
+
+def parse_partition_line(line: str, isboottype: bool, columns: List[str]=None, sector_size: int=DEFAULT_SECTOR_SIZE) -> Dict:
+	"""
+	Parses a row of a partition table printed by fdisk. Each column takes one whitespace separated token, except
+	Boot, which is empty for partitions without boot flag, and the type column (Type, System or Name, else the
+	last one), which takes the tokens the other columns leave and may contain spaces.
+	:param line: The row
+	:param isboottype: Use the default DOS columns (with Boot) instead of the GPT ones if columns is None
+	:param columns: The column names from the header row (see parse_partition_header)
+	:param sector_size: Bytes per sector (the "Units" of the disk) to calculate the exact size from Sectors
+	:return: A dict with "dev", "size_b", "size_h", "type" and "isntfs", plus "boot", "start", "end", "sectors",
+	"id" and any other column (by its lowercased name) if present
+	"""
 	if string_is_empty(line):
 		return None
 
-	columns = {}
-	columncount = 7 if isboottype else 6
-	startedgap = False
-	lastcolumn = False
-	columncollect = ""
-	collect = False
-	cc = 0
-
-	for c in line:
-		if c == ' ' and lastcolumn is False:
-			if startedgap is False:
-				collect = False
-				if isboottype:
-					if cc == 0 or cc == 4 or cc == 6:
-						collect = True
-				else:
-					if cc == 0 or cc == 4 or cc == 5:
-						collect = True
-				if collect is True:
-					if cc == 0:
-						columns["dev"] = columncollect
-					elif cc == 4:
-						partbytes = fdisk_size_to_bytesize(columncollect)
-						columns["size_b"] = partbytes
-						columns["size_h"] = bytes_to_unit(partbytes, True)
-
-				startedgap = True
-				cc += 1
-				columncollect = ""
-		else:
-			if cc == columncount - 1:
-				lastcolumn = True
-			if startedgap is True:
-				startedgap = False
-			columncollect += c
-	columns["type"] = columncollect
-	return columns
+	if columns is None:
+		columns = DOS_PARTITION_COLUMNS if isboottype else GPT_PARTITION_COLUMNS
+	(before, textkey, after) = _partition_layout(tuple(columns))
+
+	tokens = line.split()
+	n = len(tokens)
+	values = {}
+	ti = 0
+	for key in before:
+		if key == "boot":
+			boot = ti < n and tokens[ti] == "*"
+			values[key] = boot
+			if boot:
+				ti += 1
+		elif ti < n:
+			values[key] = tokens[ti]
+			ti += 1
+
+	textend = max(ti, n - len(after))
+	values[textkey] = " ".join(tokens[ti:textend])
+	for (key, token) in zip(after, tokens[textend:]):
+		values[key] = token
+
+	for key in _INT_KEYS:
+		if key in values:
+			values[key] = int(values[key])
+
+	if "sectors" in values:
+		partbytes = values["sectors"] * sector_size
+	elif "blocks" in values:
+		# Blocks of 1 KiB, odd sector counts are marked with "+"
+		partbytes = int(values["blocks"].rstrip("+")) * 1024
+	elif "size" in values:
+		partbytes = fdisk_size_to_bytesize(values["size"])
+	else:
+		partbytes = None
+
+	values["size_b"] = partbytes
+	values["size_h"] = bytes_to_unit(partbytes, True) if partbytes is not None else None
+	ptype = values.setdefault("type", "")
+	values["isntfs"] = ptype.find(_NTFS_TYPE) > -1
+	return values
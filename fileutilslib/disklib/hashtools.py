@@ -0,0 +1,216 @@
+import hashlib
+import mmap
+import os
+from os import O_RDONLY
+from os.path import basename, isfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from fileutilslib.classes.Bencher import Bencher
+from fileutilslib.disklib.copytools import fd_size, blocksize_to_bytes
+
+CHECKSUM_SUFFIX = ".checksums"
+# Digests of the device an image was created from, for images whose file differs from the device data
+SOURCE_CHECKSUM_SUFFIX = ".source.checksums"
+DEFAULT_HASHES = ["sha256"]
+DEFAULT_VERIFY_WINDOW = 64 * 1024 * 1024
+
+# Tags of the BSD-style checksum lines ("SHA256 (image) = ..."), which "sha256sum -c" and "b2sum -c" understand
+_HASH_TAGS = {
+	"md5": "MD5",
+	"sha1": "SHA1",
+	"sha224": "SHA224",
+	"sha256": "SHA256",
+	"sha384": "SHA384",
+	"sha512": "SHA512",
+	"blake2b": "BLAKE2b"
+}
+
+
+def checksum_path(imagepath: str) -> str:
+	return imagepath + CHECKSUM_SUFFIX
+
+
+def source_checksum_path(imagepath: str) -> str:
+	return imagepath + SOURCE_CHECKSUM_SUFFIX
+
+
+class StreamHasher:
+	"""
+	Computes several digests over a stream of blocks, e.g. as block_handler of copytools.copy_path
+	"""
+
+	_hashers = None
+	""":type: Dict"""
+
+	_size = None
+	""":type: int"""
+
+	def __init__(self, hash_names: List[str] = None):
+		names = hash_names if hash_names is not None and len(hash_names) > 0 else DEFAULT_HASHES
+		self._hashers = {}
+		for name in names:
+			if name not in _HASH_TAGS:
+				raise Exception("Unsupported hash algorithm '{}' (use {})".format(name, ", ".join(_HASH_TAGS)))
+			self._hashers[name] = hashlib.new(name)
+		self._size = 0
+
+	def __call__(self, offset: int, data) -> None:
+		if offset != self._size:
+			raise Exception("Blocks have to be hashed in order (expected offset {}, got {})".format(self._size, offset))
+		for h in self._hashers.values():
+			h.update(data)
+		self._size += len(data)
+
+	def get_size(self) -> int:
+		return self._size
+
+	def hexdigests(self) -> Dict:
+		return {name: h.hexdigest() for (name, h) in self._hashers.items()}
+
+
+def write_checksums(imagepath: str, digests: Dict, sourcepath: str = None) -> str:
+	"""
+	Writes the digests of an image to its sidecar file in BSD-style
+	:param sourcepath: The device the digests were computed from, if they aren't those of the image file
+	(compressed, chunked or delta images). They are written to "<image>.source.checksums" and name the device.
+	:return: The path of the sidecar file
+	"""
+	if sourcepath is not None:
+		cp = source_checksum_path(imagepath)
+		name = sourcepath
+	else:
+		cp = checksum_path(imagepath)
+		name = basename(imagepath)
+	tmp = cp + ".tmp"
+	with open(tmp, "w") as f:
+		for (hname, digest) in digests.items():
+			f.write("{} ({}) = {}\n".format(_HASH_TAGS[hname], name, digest))
+	os.replace(tmp, cp)
+	return cp
+
+
+def read_checksums(imagepath: str, source: bool = False) -> Dict:
+	"""
+	:param source: Read the digests of the source device (see write_checksums)
+	"""
+	cp = source_checksum_path(imagepath) if source is True else checksum_path(imagepath)
+	if not isfile(cp):
+		raise Exception("Image '{}' has no {}checksum file".format(imagepath, "source " if source is True else ""))
+	names = {tag: name for (name, tag) in _HASH_TAGS.items()}
+	digests = {}
+	with open(cp, "r") as f:
+		for line in f:
+			line = line.strip()
+			p = line.find(" (")
+			e = line.rfind(") = ")
+			if p < 0 or e < 0 or line[0:p] not in names:
+				continue
+			digests[names[line[0:p]]] = line[e + 4:]
+	return digests
+
+
+def checksum_file(path: str, hash_names: List[str] = None, blocksize=DEFAULT_VERIFY_WINDOW) -> Dict:
+	"""
+	Computes digests of a file or device in one pass
+	"""
+	hasher = StreamHasher(hash_names)
+	buffer = bytearray(blocksize_to_bytes(blocksize))
+	mv = memoryview(buffer)
+	with open(path, "rb", buffering=0) as f:
+		while True:
+			n = f.readinto(mv)
+			if not n:
+				break
+			hasher(hasher.get_size(), mv[0:n])
+	return hasher.hexdigests()
+
+
+def verify_checksums(imagepath: str) -> bool:
+	"""
+	Re-hashes an image and compares the result with its sidecar file
+	"""
+	expected = read_checksums(imagepath)
+	return checksum_file(imagepath, list(expected.keys())) == expected
+
+
+def _window_digest(mm: mmap.mmap, start: int, end: int, hash_name: str) -> bytes:
+	# hashlib releases the GIL on large buffers, so the page faults of the mmap'd windows
+	# (the actual reads) of several threads run in parallel
+	mv = memoryview(mm)
+	try:
+		return hashlib.new(hash_name, mv[start:end]).digest()
+	finally:
+		mv.release()
+
+
+@Bencher("hashtools.verify")
+def verify(
+	imagepath: str,
+	devicepath: str,
+	window=DEFAULT_VERIFY_WINDOW,
+	workers: int = None,
+	progress_handler: Callable = None,
+	hash_name: str = "blake2b"
+) -> List[int]:
+	"""
+	Compares an image with the device it was created from. Both are mmap'd and compared window by window,
+	several windows in parallel.
+	:param imagepath: The image
+	:param devicepath: The device (or another image)
+	:param window: Bytes per comparison as int or dd-style string
+	:param workers: Number of threads, defaults to the number of CPUs
+	:param progress_handler: Called with (compared_bytes, total_bytes) after each window
+	:param hash_name: The hashlib algorithm the windows are compared by
+	:return: The offsets of the differing windows, an empty list means both are equal
+	"""
+	ws = blocksize_to_bytes(window)
+	w = workers if workers is not None and workers > 0 else (os.cpu_count() or 1)
+
+	fda = os.open(imagepath, O_RDONLY)
+	try:
+		fdb = os.open(devicepath, O_RDONLY)
+		try:
+			size = fd_size(fda)
+			if fd_size(fdb) != size:
+				raise Exception("'{}' and '{}' differ in size".format(imagepath, devicepath))
+			if size == 0:
+				return []
+
+			mma = mmap.mmap(fda, size, prot=mmap.PROT_READ)
+			mmb = mmap.mmap(fdb, size, prot=mmap.PROT_READ)
+			try:
+				for mm in (mma, mmb):
+					if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+						mm.madvise(mmap.MADV_SEQUENTIAL)
+
+				mismatches = []
+				compared = 0
+
+				with ThreadPoolExecutor(max_workers=w * 2) as executor:
+					# Windows are submitted in groups, so only a bounded number of results is pending
+					starts = list(range(0, size, ws))
+					for g in range(0, len(starts), w):
+						group = []
+						for start in starts[g:g + w]:
+							end = min(start + ws, size)
+							group.append((
+								start,
+								end,
+								executor.submit(_window_digest, mma, start, end, hash_name),
+								executor.submit(_window_digest, mmb, start, end, hash_name)
+							))
+						for (start, end, fa, fb) in group:
+							if fa.result() != fb.result():
+								mismatches.append(start)
+							compared += end - start
+							if progress_handler is not None:
+								progress_handler(compared, size)
+
+				return mismatches
+			finally:
+				mma.close()
+				mmb.close()
+		finally:
+			os.close(fdb)
+	finally:
+		os.close(fda)
@@ -0,0 +1,72 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+from typing import List, Tuple
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _lib():
+	global _libc
+	if _libc is None:
+		_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		if not hasattr(_libc, "inotify_init1"):
+			raise Exception("inotify isn't supported on this platform")
+	return _libc
+
+
+def _check(r: int) -> int:
+	if r < 0:
+		e = ctypes.get_errno()
+		raise OSError(e, os.strerror(e))
+	return r
+
+
+def inotify_init(flags: int = IN_NONBLOCK | IN_CLOEXEC) -> int:
+	"""
+	:return: A new inotify file descriptor, close it with os.close
+	"""
+	return _check(_lib().inotify_init1(ctypes.c_int(flags)))
+
+
+def inotify_add_watch(fd: int, path: str, mask: int) -> int:
+	"""
+	:return: The watch descriptor reported with the events of path
+	"""
+	return _check(_lib().inotify_add_watch(ctypes.c_int(fd), os.fsencode(path), ctypes.c_uint32(mask)))
+
+
+def inotify_read(fd: int, bufsize: int = 64 * 1024) -> List[Tuple[int, int, int, str]]:
+	"""
+	Reads the pending events without blocking
+	:return: (wd, mask, cookie, name) per event, an empty list if there are none
+	"""
+	events = []
+	try:
+		buf = os.read(fd, bufsize)
+	except BlockingIOError:
+		return events
+	pos = 0
+	while pos + _EVENT_HEADER.size <= len(buf):
+		wd, mask, cookie, namelen = _EVENT_HEADER.unpack_from(buf, pos)
+		pos += _EVENT_HEADER.size
+		name = buf[pos:pos + namelen].rstrip(b"\0")
+		pos += namelen
+		events.append((wd, mask, cookie, os.fsdecode(name)))
+	return events
@@ -0,0 +1,96 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+from typing import List, Tuple
+
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+
+IOPRIO_WHO_PROCESS = 1
+
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_PRIO_MASK = (1 << _IOPRIO_CLASS_SHIFT) - 1
+
+_IOPRIO_CLASS_NAMES = {
+	"none": IOPRIO_CLASS_NONE,
+	"realtime": IOPRIO_CLASS_RT,
+	"best-effort": IOPRIO_CLASS_BE,
+	"idle": IOPRIO_CLASS_IDLE
+}
+
+# (ioprio_set, ioprio_get) syscall numbers, there is no libc wrapper
+_SYSCALLS = {
+	"x86_64": (251, 252),
+	"i386": (289, 290),
+	"i686": (289, 290),
+	"aarch64": (30, 31),
+	"armv7l": (314, 315),
+	"ppc64le": (273, 274),
+	"riscv64": (30, 31),
+	"s390x": (282, 283)
+}
+
+_libc = None
+
+
+def _syscall(index: int, *args) -> int:
+	global _libc
+	numbers = _SYSCALLS.get(platform.machine())
+	if numbers is None:
+		raise Exception("I/O priorities aren't supported on '{}'".format(platform.machine()))
+	if _libc is None:
+		_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	r = _libc.syscall(numbers[index], *[ctypes.c_int(a) for a in args])
+	if r < 0:
+		e = ctypes.get_errno()
+		raise OSError(e, os.strerror(e))
+	return r
+
+
+def ioprio_class(name) -> int:
+	"""
+	Accepts an IOPRIO_CLASS_* constant or its ionice name ("realtime", "best-effort", "idle")
+	"""
+	if isinstance(name, int):
+		return name
+	if name not in _IOPRIO_CLASS_NAMES:
+		raise Exception("Unknown I/O priority class '{}' (use {})".format(name, ", ".join(_IOPRIO_CLASS_NAMES)))
+	return _IOPRIO_CLASS_NAMES[name]
+
+
+def ioprio_get(tid: int = 0) -> Tuple[int, int]:
+	"""
+	:param tid: The thread (or process) id, 0 for the calling thread
+	:return: The class and level of the I/O priority
+	"""
+	value = _syscall(1, IOPRIO_WHO_PROCESS, tid)
+	return value >> _IOPRIO_CLASS_SHIFT, value & _IOPRIO_PRIO_MASK
+
+
+def ioprio_set(ioclass, level: int = 4, tid: int = 0) -> None:
+	"""
+	Sets the I/O priority like ionice. Linux keeps it per thread and threads started afterwards inherit it.
+	Only schedulers like BFQ honour all classes, mq-deadline only distinguishes realtime.
+	:param ioclass: An IOPRIO_CLASS_* constant or its ionice name
+	:param level: 0 (highest) to 7 for realtime and best-effort, ignored for idle and none
+	:param tid: The thread (or process) id, 0 for the calling thread
+	"""
+	c = ioprio_class(ioclass)
+	if not 0 <= level <= 7:
+		raise Exception("The I/O priority level has to be between 0 and 7")
+	# The kernel rejects levels for the classes without levels (ioprio_get reports 4 for none nevertheless)
+	data = level if c != IOPRIO_CLASS_IDLE and c != IOPRIO_CLASS_NONE else 0
+	_syscall(0, IOPRIO_WHO_PROCESS, tid, (c << _IOPRIO_CLASS_SHIFT) | data)
+
+
+def ionice_args(ioclass, level: int = 4) -> List[str]:
+	"""
+	:return: The arguments for the ionice command, to run external programs (like dd) with an I/O priority
+	"""
+	c = ioprio_class(ioclass)
+	if c == IOPRIO_CLASS_IDLE:
+		return ["-c", str(c)]
+	return ["-c", str(c), "-n", str(level)]
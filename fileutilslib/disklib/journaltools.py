@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+from os import O_RDONLY, O_WRONLY, O_CREAT, O_TRUNC
+from os.path import abspath, isfile, dirname
+from stat import S_ISBLK
+from typing import Callable, Dict
+from fileutilslib.classes.Bencher import Bencher
+from fileutilslib.disklib.copytools import fd_size, blocksize_to_bytes, copy_fd_range, timed_io, IO_READ, DEFAULT_BLOCKSIZE
+from fileutilslib.disklib.tunetools import device_identity
+
+JOURNAL_VERSION = 2
+JOURNAL_SUFFIX = ".journal.json"
+DEFAULT_CHECKPOINT_INTERVAL = 256 * 1024 * 1024
+JOURNAL_HASH = "blake2b"
+# Resuming only ever walks back over the last few segments, older ones aren't kept
+JOURNAL_SEGMENTS = 3
+
+
+def journal_path(imagepath: str) -> str:
+	return imagepath + JOURNAL_SUFFIX
+
+
+def load_journal(imagepath: str) -> Dict:
+	jp = journal_path(imagepath)
+	if not isfile(jp):
+		return None
+	try:
+		with open(jp, "r") as f:
+			journal = json.load(f)
+	except ValueError:
+		return None
+	return journal if journal.get("version") == JOURNAL_VERSION else None
+
+
+def _save_journal(imagepath: str, journal: Dict) -> None:
+	jp = journal_path(imagepath)
+	tmp = jp + ".tmp"
+	with open(tmp, "w") as f:
+		json.dump(journal, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp, jp)
+	# Makes the rename itself durable
+	dfd = os.open(dirname(abspath(jp)), O_RDONLY)
+	try:
+		os.fsync(dfd)
+	finally:
+		os.close(dfd)
+
+
+def remove_journal(imagepath: str) -> None:
+	jp = journal_path(imagepath)
+	if isfile(jp):
+		os.remove(jp)
+
+
+def _read_range(fd: int, offset: int, length: int, blocksize: int, block_handler: Callable) -> int:
+	buffer = bytearray(blocksize)
+	mv = memoryview(buffer)
+	pos = offset
+	end = offset + length
+	while pos < end:
+		n = timed_io(IO_READ, os.preadv, fd, [mv[0:min(blocksize, end - pos)]], pos)
+		if n == 0:
+			break
+		block_handler(pos, mv[0:n])
+		pos += n
+	return pos - offset
+
+
+def _segment_digest(fd: int, offset: int, length: int, blocksize: int) -> str:
+	h = hashlib.new(JOURNAL_HASH)
+	if _read_range(fd, offset, length, blocksize, lambda o, data: h.update(data)) != length:
+		return None
+	return h.hexdigest()
+
+
+def _source_identity(srcfd: int, srcpath: str) -> str:
+	"""
+	Model and serial of block devices (another disk can show up under the same name after it was unplugged),
+	inode and modification time of files
+	"""
+	st = os.fstat(srcfd)
+	if S_ISBLK(st.st_mode):
+		return device_identity(srcpath)
+	return "file:{}:{}:{}".format(st.st_dev, st.st_ino, st.st_mtime_ns)
+
+
+def _resume_offset(journal: Dict, srcfd: int, dstfd: int, blocksize: int) -> int:
+	# Only the last committed segment is re-read and compared, which is enough to detect a target
+	# that was modified or truncated since; if it doesn't match, earlier segments are tried. The segment
+	# is read from the source as well, a source with other contents than before means starting over.
+	segments = journal["segments"]
+	size = fd_size(dstfd)
+	while len(segments) > 0:
+		(start, end, digest) = segments[-1]
+		if end <= size and _segment_digest(dstfd, start, end - start, blocksize) == digest:
+			if _segment_digest(srcfd, start, end - start, blocksize) != digest:
+				segments.clear()
+				return 0
+			return end
+		segments.pop()
+	return 0
+
+
+@Bencher("journaltools.copy_path_resumable")
+def copy_path_resumable(
+	srcpath: str,
+	dstpath: str,
+	blocksize=DEFAULT_BLOCKSIZE,
+	checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+	resume: bool=False,
+	progress_handler: Callable=None,
+	block_handler: Callable=None
+) -> int:
+	"""
+	Copies like copytools.copy_path, but commits a checkpoint to "<target>.journal.json" every
+	checkpoint_interval bytes: The target is synced and the journal records the offset, the block size,
+	the identity of the source and digests of the last committed segments. An interrupted copy can then be
+	continued with resume=True. The journal is removed once the copy is complete.
+	:param srcpath: The source device or file
+	:param dstpath: The target file
+	:param blocksize: Bytes per syscall as int or dd-style string
+	:param checkpoint_interval: Bytes between checkpoints as int or dd-style string
+	:param resume: Continue after the last valid checkpoint if the journal matches source and block size and
+	the last segment still reads the same from source and target, otherwise the copy starts from the beginning
+	:param progress_handler: Called with (copied_bytes, total_bytes) after each block, including the resumed prefix
+	:param block_handler: Called with (offset, memoryview) for each block in order. On resume the prefix
+	is read back from the target and passed to it first, so whole-image digests stay correct.
+	:return: The size of the copy
+	"""
+	bs = blocksize_to_bytes(blocksize)
+	ci = max(bs, (blocksize_to_bytes(checkpoint_interval) // bs) * bs)
+
+	srcfd = os.open(srcpath, O_RDONLY)
+	try:
+		size = fd_size(srcfd)
+		source_id = _source_identity(srcfd, srcpath)
+		journal = load_journal(dstpath) if resume is True else None
+
+		if journal is not None and (
+			journal["source"] != abspath(srcpath) or journal["source_id"] != source_id or
+			journal["size_b"] != size or journal["blocksize"] != bs
+		):
+			journal = None
+
+		dstfd = os.open(dstpath, O_WRONLY | O_CREAT | (0 if journal is not None else O_TRUNC), 0o644)
+		try:
+			start = 0
+			if journal is not None:
+				rfd = os.open(dstpath, O_RDONLY)
+				try:
+					start = _resume_offset(journal, srcfd, rfd, bs)
+					journal["offset"] = start
+					if block_handler is not None and start > 0:
+						_read_range(rfd, 0, start, bs, block_handler)
+				finally:
+					os.close(rfd)
+			else:
+				journal = {
+					"version": JOURNAL_VERSION,
+					"source": abspath(srcpath),
+					"source_id": source_id,
+					"size_b": size,
+					"blocksize": bs,
+					"offset": 0,
+					"segments": []
+				}
+
+			pos = start
+
+			while pos < size:
+				length = min(ci, size - pos)
+				h = hashlib.new(JOURNAL_HASH)
+
+				def handle_block(offset, data):
+					h.update(data)
+					if block_handler is not None:
+						block_handler(offset, data)
+
+				segstart = pos
+
+				def handle_progress(copied, total):
+					if progress_handler is not None:
+						progress_handler(segstart + copied, size)
+
+				copied = copy_fd_range(
+					srcfd, dstfd, pos, length, bs, handle_progress, block_handler=handle_block
+				)
+				if copied == 0:
+					break
+				pos += copied
+				os.fdatasync(dstfd)
+				journal["segments"].append([segstart, pos, h.hexdigest()])
+				del journal["segments"][:-JOURNAL_SEGMENTS]
+				journal["offset"] = pos
+				_save_journal(dstpath, journal)
+
+			os.ftruncate(dstfd, pos)
+			os.fsync(dstfd)
+		finally:
+			os.close(dstfd)
+	finally:
+		os.close(srcfd)
+
+	remove_journal(dstpath)
+	return pos
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+from os import O_RDONLY, O_WRONLY, O_CREAT, O_TRUNC, SEEK_SET, lseek
+from os.path import abspath, isfile
+from typing import Callable, Dict, List
+from fileutilslib.classes.Bencher import Bencher
+from fileutilslib.misclib.helpertools import string_is_empty
+from fileutilslib.disklib.copytools import fd_size, path_size, blocksize_to_bytes, copy_path, copy_fd_range, timed_io, IO_READ, \
+	IO_WRITE
+
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".manifest.json"
+DEFAULT_MANIFEST_BLOCKSIZE = 4 * 1024 * 1024
+DEFAULT_MANIFEST_HASH = "blake2b"
+
+# The image only contains the changed blocks (the rest are holes) and needs its base to be rebuilt
+INCREMENTAL_MODE_DELTA = "delta"
+# The image is a copy of the base with the changed blocks written over it, so it is complete on its own
+INCREMENTAL_MODE_PATCH = "patch"
+
+
+def manifest_path(imagepath: str) -> str:
+	return imagepath + MANIFEST_SUFFIX
+
+
+def load_manifest(imagepath: str) -> Dict:
+	"""
+	Loads the block-hash manifest stored next to an image
+	:param imagepath: The path of the image (not of the manifest)
+	"""
+	mp = manifest_path(imagepath)
+	if not isfile(mp):
+		raise Exception("Image '{}' has no manifest".format(imagepath))
+	with open(mp, "r") as f:
+		manifest = json.load(f)
+	if manifest.get("version") != MANIFEST_VERSION:
+		raise Exception("Unsupported manifest version in '{}'".format(mp))
+	return manifest
+
+
+def save_manifest(imagepath: str, manifest: Dict) -> None:
+	mp = manifest_path(imagepath)
+	tmp = mp + ".tmp"
+	with open(tmp, "w") as f:
+		json.dump(manifest, f)
+	os.replace(tmp, mp)
+
+
+@Bencher("manifesttools.create_incremental")
+def create_incremental(
+	srcpath: str,
+	imagepath: str,
+	base_imagepath: str=None,
+	mode: str=INCREMENTAL_MODE_DELTA,
+	block_size=None,
+	hash_name: str=None,
+	progress_handler: Callable=None,
+	block_handler: Callable=None
+) -> Dict:
+	"""
+	Images srcpath and stores a per-block hash manifest next to the image. With a base image (which needs a
+	manifest too) only the blocks whose hashes differ from the base manifest are written.
+	:param srcpath: The device or file to image
+	:param imagepath: The image to create
+	:param base_imagepath: The previous image of the same source, None for a full image
+	:param mode: INCREMENTAL_MODE_DELTA or INCREMENTAL_MODE_PATCH
+	:param block_size: Granularity of the manifest (int or dd-style string), taken from the base if given
+	:param hash_name: A hashlib algorithm, taken from the base if given
+	:param progress_handler: Called with (processed_bytes, total_bytes) after each block
+	:param block_handler: Called with (offset, memoryview) for each block of the source in order
+	:return: The manifest, with the list of written block indices in "changed"
+	"""
+	if mode != INCREMENTAL_MODE_DELTA and mode != INCREMENTAL_MODE_PATCH:
+		raise Exception("Unknown incremental mode '{}'".format(mode))
+
+	base = None
+	if not string_is_empty(base_imagepath):
+		base = load_manifest(base_imagepath)
+		if abspath(base_imagepath) == abspath(imagepath):
+			raise Exception("The image can't be its own base")
+
+	if base is not None:
+		bs = base["block_size"]
+		hn = base["hash"]
+		base_blocks = base["blocks"]
+	else:
+		bs = blocksize_to_bytes(block_size if block_size is not None else DEFAULT_MANIFEST_BLOCKSIZE)
+		hn = hash_name if hash_name is not None else DEFAULT_MANIFEST_HASH
+		base_blocks = []
+
+	patch = base is not None and mode == INCREMENTAL_MODE_PATCH
+
+	if patch:
+		if base["base"] is not None:
+			# A delta base only holds its changed blocks, the full base has to be rebuilt from its chain
+			rebuild_image(base_imagepath, imagepath)
+		else:
+			# copy_file_range lets filesystems like btrfs or xfs share the extents instead of copying them
+			copy_path(base_imagepath, imagepath)
+
+	blocks = []
+	changed = []
+	buffer = bytearray(bs)
+	mv = memoryview(buffer)
+
+	srcfd = os.open(srcpath, O_RDONLY)
+	try:
+		size = fd_size(srcfd)
+		dstfd = os.open(imagepath, O_WRONLY | O_CREAT | (0 if patch else O_TRUNC), 0o644)
+		try:
+			pos = 0
+			index = 0
+			lseek(srcfd, 0, SEEK_SET)
+			while pos < size:
+				n = timed_io(IO_READ, os.readv, srcfd, [mv[0:min(bs, size - pos)]])
+				if n == 0:
+					break
+				if block_handler is not None:
+					block_handler(pos, mv[0:n])
+				digest = hashlib.new(hn, mv[0:n]).hexdigest()
+				blocks.append(digest)
+				if index >= len(base_blocks) or base_blocks[index] != digest:
+					changed.append(index)
+					wmv = mv[0:n]
+					wpos = pos
+					while len(wmv) > 0:
+						w = timed_io(IO_WRITE, os.pwrite, dstfd, wmv, wpos)
+						wmv = wmv[w:]
+						wpos += w
+				pos += n
+				index += 1
+				if progress_handler is not None:
+					progress_handler(pos, size)
+			os.ftruncate(dstfd, pos)
+			os.fsync(dstfd)
+		finally:
+			os.close(dstfd)
+	finally:
+		os.close(srcfd)
+
+	manifest = {
+		"version": MANIFEST_VERSION,
+		"size_b": pos,
+		"block_size": bs,
+		"hash": hn,
+		"base": abspath(base_imagepath) if base is not None and not patch else None,
+		"changed": changed,
+		"blocks": blocks
+	}
+	save_manifest(imagepath, manifest)
+	return manifest
+
+
+def image_chain(imagepath: str) -> List[str]:
+	"""
+	Lists the images needed to rebuild imagepath, starting with the full image and ending with imagepath
+	"""
+	chain = []
+	p = imagepath
+	while p is not None:
+		if p in chain:
+			raise Exception("Image chain of '{}' contains a cycle".format(imagepath))
+		chain.append(p)
+		p = load_manifest(p)["base"]
+	chain.reverse()
+	return chain
+
+
+def rebuild_total_b(imagepath: str) -> int:
+	"""
+	:return: The bytes rebuild_image writes, the full image plus the changed blocks of the deltas
+	"""
+	chain = image_chain(imagepath)
+	total = path_size(chain[0])
+	for p in chain[1:]:
+		m = load_manifest(p)
+		total += sum(min(m["block_size"], m["size_b"] - index * m["block_size"]) for index in m["changed"])
+	return total
+
+
+@Bencher("manifesttools.rebuild_image")
+def rebuild_image(
+	imagepath: str,
+	outputpath: str,
+	truncate: bool=True,
+	blocksize=None,
+	progress_handler: Callable=None
+) -> int:
+	"""
+	Rebuilds the full image (or device content) from a chain of delta images
+	:param imagepath: The newest image of the chain
+	:param outputpath: The file or device to write the full image to
+	:param truncate: Truncate the target first (set to False when writing to devices)
+	:param blocksize: Bytes per syscall of the copy of the full image as int or dd-style string
+	:param progress_handler: Called with (written_bytes, total_bytes), the total being rebuild_total_b().
+	Raising from it stops the rebuild.
+	:return: The size of the rebuilt image
+	"""
+	chain = image_chain(imagepath)
+	manifests = [load_manifest(p) for p in chain[1:]]
+	size = load_manifest(imagepath)["size_b"]
+	base_size = path_size(chain[0])
+	total = rebuild_total_b(imagepath)
+	done = 0
+
+	def progress(copied, _):
+		if progress_handler is not None:
+			progress_handler(done + copied, total)
+
+	copy_path(chain[0], outputpath, blocksize, progress, truncate=truncate)
+	done = base_size
+
+	dstfd = os.open(outputpath, O_WRONLY)
+	try:
+		for (p, m) in zip(chain[1:], manifests):
+			bs = m["block_size"]
+			srcfd = os.open(p, O_RDONLY)
+			try:
+				for index in m["changed"]:
+					offset = index * bs
+					done += copy_fd_range(srcfd, dstfd, offset, min(bs, m["size_b"] - offset), bs, progress)
+			finally:
+				os.close(srcfd)
+		if truncate is True:
+			os.ftruncate(dstfd, size)
+		os.fsync(dstfd)
+	finally:
+		os.close(dstfd)
+
+	progress(0, total)
+	return size
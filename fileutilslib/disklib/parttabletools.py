@@ -0,0 +1,303 @@
+import fcntl
+import os
+import struct
+import zlib
+from os import O_RDONLY
+from stat import S_ISBLK
+from typing import Dict, List, Tuple
+from uuid import UUID
+from fileutilslib.disklib.copytools import fd_size
+from fileutilslib.disklib.filetools import bytes_to_unit
+
+# ioctl returning the logical sector size of a block device
+BLKSSZGET = 0x1268
+
+MBR_SIGNATURE = b"\x55\xaa"
+GPT_SIGNATURE = b"EFI PART"
+
+MBR_TYPE_GPT_PROTECTIVE = 0xee
+MBR_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+
+# Logical partitions of a corrupt or looping EBR chain are read up to this count
+MAX_LOGICAL_PARTITIONS = 256
+
+_MBR_ENTRY = struct.Struct("<B3sB3sII")
+_GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+_GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+
+_ZERO_GUID = b"\0" * 16
+
+# Names as printed by fdisk
+MBR_TYPE_NAMES = {
+	0x01: "FAT12", 0x04: "FAT16 <32M", 0x05: "Extended", 0x06: "FAT16", 0x07: "HPFS/NTFS/exFAT",
+	0x0b: "W95 FAT32", 0x0c: "W95 FAT32 (LBA)", 0x0e: "W95 FAT16 (LBA)", 0x0f: "W95 Ext'd (LBA)",
+	0x27: "Hidden NTFS WinRE", 0x82: "Linux swap / Solaris", 0x83: "Linux", 0x85: "Linux extended",
+	0x8e: "Linux LVM", 0xa5: "FreeBSD", 0xa8: "Darwin UFS", 0xaf: "HFS / HFS+", 0xee: "GPT", 0xef: "EFI (FAT-12/16/32)",
+	0xfd: "Linux raid autodetect"
+}
+
+GPT_TYPE_NAMES = {
+	"c12a7328-f81f-11d2-ba4b-00a0c93ec93b": "EFI System",
+	"21686148-6449-6e6f-744e-656564454649": "BIOS boot",
+	"e3c9e316-0b5c-4db8-817d-f92df00215ae": "Microsoft reserved",
+	"ebd0a0a2-b9e5-4433-87c0-68b6b72699c7": "Microsoft basic data",
+	"de94bba4-06d1-4d40-a16a-bfd50179d6ac": "Windows recovery environment",
+	"0fc63daf-8483-4772-8e79-3d69d8477de4": "Linux filesystem",
+	"0657fd6d-a4ab-43c4-84e5-0933c84b4f4f": "Linux swap",
+	"e6d6d379-f507-44c2-a23c-238f2a3df928": "Linux LVM",
+	"a19d880f-05fc-4d3b-a006-743f0f84911e": "Linux RAID",
+	"4f68bce3-e8cd-4db1-96e7-fbcaf984b709": "Linux root (x86-64)",
+	"933ac7e1-2eb4-4f13-b844-0e14e2aef915": "Linux home",
+	"bc13c2ff-59e6-4262-a352-b275fd6f7172": "Linux extended boot",
+	"48465300-0000-11aa-aa11-00306543ecac": "Apple HFS/HFS+",
+	"7c3457ef-0000-11aa-aa11-00306543ecac": "Apple APFS"
+}
+
+
+def _pread(fd: int, length: int, offset: int) -> bytes:
+	data = os.pread(fd, length, offset)
+	if len(data) < length:
+		raise Exception("Unexpected end of the device at byte {}".format(offset + len(data)))
+	return data
+
+
+def _guid(raw: bytes) -> str:
+	# GUIDs are stored mixed-endian
+	return str(UUID(bytes_le=raw))
+
+
+def logical_sector_size(fd: int) -> int:
+	"""
+	:return: The logical sector size of a block device, None for files
+	"""
+	if not S_ISBLK(os.fstat(fd).st_mode):
+		return None
+	buf = fcntl.ioctl(fd, BLKSSZGET, struct.pack("i", 0))
+	return struct.unpack("i", buf)[0]
+
+
+def partition_devpath(path: str, partn: int) -> str:
+	"""
+	The name fdisk uses for a partition: sda1, nvme0n1p1, loop0p1, disk.img1
+	"""
+	if len(path) > 0 and path[-1].isdigit() and path.startswith("/dev/"):
+		return "{}p{}".format(path, partn)
+	return "{}{}".format(path, partn)
+
+
+def _partition(path: str, partn: int, start: int, sectors: int, sector_size: int, ptype: str) -> Dict:
+	size_b = sectors * sector_size
+	return {
+		"dev": partition_devpath(path, partn),
+		"partn": partn,
+		"start": start,
+		"end": start + sectors - 1,
+		"sectors": sectors,
+		"size_b": size_b,
+		"size_h": bytes_to_unit(size_b, True),
+		"type": ptype,
+		"isntfs": False
+	}
+
+
+def _mbr_entries(sector: bytes) -> List[Tuple[int, int, int, int]]:
+	"""
+	:return: (status, type, first lba, sectors) of the four primary entries, empty ones included
+	"""
+	entries = []
+	for i in range(4):
+		(status, _, ptype, _, lba, sectors) = _MBR_ENTRY.unpack_from(sector, 446 + i * 16)
+		entries.append((status, ptype, lba, sectors))
+	return entries
+
+
+def _mbr_record(path: str, partn: int, entry: Tuple[int, int, int, int], start: int, sector_size: int) -> Dict:
+	(status, ptype, _, sectors) = entry
+	part = _partition(path, partn, start, sectors, sector_size, MBR_TYPE_NAMES.get(ptype, "unknown"))
+	part["boot"] = status == 0x80
+	part["id"] = "{:x}".format(ptype)
+	part["isntfs"] = ptype == 0x07
+	return part
+
+
+def _read_logical(fd: int, path: str, ext_start: int, sector_size: int) -> List[Dict]:
+	parts = []
+	ebr = ext_start
+	seen = set()
+	while len(parts) < MAX_LOGICAL_PARTITIONS and ebr not in seen:
+		seen.add(ebr)
+		sector = _pread(fd, sector_size, ebr * sector_size)
+		if sector[510:512] != MBR_SIGNATURE:
+			break
+		entries = _mbr_entries(sector)
+		# The first entry is relative to this EBR, the second links the next EBR relative to the extended partition
+		if entries[0][1] != 0 and entries[0][3] > 0:
+			parts.append(_mbr_record(path, 5 + len(parts), entries[0], ebr + entries[0][2], sector_size))
+		if entries[1][1] not in MBR_EXTENDED_TYPES or entries[1][2] == 0:
+			break
+		ebr = ext_start + entries[1][2]
+	return parts
+
+
+def _read_mbr(fd: int, path: str, mbr: bytes, sector_size: int) -> List[Dict]:
+	parts = []
+	for (i, entry) in enumerate(_mbr_entries(mbr)):
+		(_, ptype, lba, sectors) = entry
+		if ptype == 0 or sectors == 0:
+			continue
+		parts.append(_mbr_record(path, i + 1, entry, lba, sector_size))
+		if ptype in MBR_EXTENDED_TYPES:
+			parts.extend(_read_logical(fd, path, lba, sector_size))
+	return parts
+
+
+def _gpt_header(fd: int, lba: int, sector_size: int) -> Dict:
+	"""
+	:return: The GPT header at lba, None if there is none or its CRC doesn't match
+	"""
+	sector = _pread(fd, sector_size, lba * sector_size)
+	if sector[0:8] != GPT_SIGNATURE:
+		return None
+	fields = _GPT_HEADER.unpack_from(sector)
+	(_, revision, header_size, header_crc, _, current, backup, first, last, disk_guid, entries_lba,
+		num_entries, entry_size, entries_crc) = fields
+	if header_size < _GPT_HEADER.size or header_size > sector_size:
+		return None
+	header = bytearray(sector[0:header_size])
+	header[16:20] = b"\0\0\0\0"
+	if zlib.crc32(header) != header_crc or current != lba:
+		return None
+	return {
+		"revision": revision,
+		"current_lba": current,
+		"backup_lba": backup,
+		"first_lba": first,
+		"last_lba": last,
+		"disk_guid": _guid(disk_guid),
+		"entries_lba": entries_lba,
+		"num_entries": num_entries,
+		"entry_size": entry_size,
+		"entries_crc": entries_crc
+	}
+
+
+def _gpt_entries(fd: int, header: Dict, sector_size: int) -> bytes:
+	"""
+	:return: The partition entry array, None if its CRC doesn't match
+	"""
+	length = header["num_entries"] * header["entry_size"]
+	if header["entry_size"] < _GPT_ENTRY.size or length > 1024 * 1024:
+		return None
+	data = _pread(fd, length, header["entries_lba"] * sector_size)
+	return data if zlib.crc32(data) == header["entries_crc"] else None
+
+
+def _read_gpt(fd: int, path: str, size_b: int, sector_size: int) -> Tuple[Dict, List[Dict]]:
+	"""
+	Reads the primary GPT, the backup at the end of the device if the primary header or entries are damaged
+	:return: The header (with "header" set to "primary" or "backup") and the partitions
+	"""
+	for (which, lba) in (("primary", 1), ("backup", size_b // sector_size - 1)):
+		header = _gpt_header(fd, lba, sector_size)
+		if header is None:
+			continue
+		data = _gpt_entries(fd, header, sector_size)
+		if data is None:
+			continue
+		header["header"] = which
+		parts = []
+		for i in range(header["num_entries"]):
+			(type_guid, part_guid, first, last, attrs, name) = _GPT_ENTRY.unpack_from(data, i * header["entry_size"])
+			if type_guid == _ZERO_GUID:
+				continue
+			tguid = _guid(type_guid)
+			part = _partition(path, i + 1, first, last - first + 1, sector_size, GPT_TYPE_NAMES.get(tguid, tguid))
+			part["type_guid"] = tguid
+			part["partuuid"] = _guid(part_guid)
+			part["attrs"] = attrs
+			part["name"] = name.decode("utf-16-le", errors="replace").split("\0", 1)[0]
+			parts.append(part)
+		return header, parts
+	raise Exception("The GPT of '{}' is damaged, the CRCs of the primary and the backup table don't match".format(path))
+
+
+def _detect_gpt_sector_size(fd: int, size_b: int) -> int:
+	# Images don't tell their sector size, the GPT header is at LBA 1 of 512 or 4096 bytes
+	for sector_size in (512, 4096):
+		if size_b >= 2 * sector_size and os.pread(fd, 8, sector_size) == GPT_SIGNATURE:
+			return sector_size
+	return None
+
+
+def read_partition_table(source, path: str = None, sector_size: int = None) -> Dict:
+	"""
+	Reads the MBR (with extended and logical partitions) or GPT of a device or image file without running fdisk.
+	CRCs of the GPT headers and entries are checked, damaged primary tables are replaced by the backup.
+	Compressed images and chunk stores have to be restored (or mounted) first.
+	:param source: A path or an open file descriptor
+	:param path: The name used for the records, defaults to source if that's a path
+	:param sector_size: The logical sector size, detected if None (ioctl for devices, GPT position for images)
+	:return: A device dict like fdisktools.parse_fdisk_output with "dev", "size_b", "size_h", "isntfs",
+	"sector_size", "disklabel" ("dos", "gpt" or None), "identifier" and "partitions". Partitions have "dev",
+	"partn", "start", "end", "sectors", "size_b", "size_h", "type" and "isntfs", plus "boot" and "id" (dos)
+	or "type_guid", "partuuid", "attrs" and "name" (gpt). GPT disks also have "gpt" with the header fields.
+	"""
+	if isinstance(source, int):
+		fd = source
+		name = path if path is not None else "fd:{}".format(source)
+	else:
+		fd = os.open(str(source), O_RDONLY)
+		name = path if path is not None else str(source)
+
+	try:
+		size_b = fd_size(fd)
+		dev = {
+			"dev": name,
+			"size_b": size_b,
+			"size_h": bytes_to_unit(size_b, True),
+			"isntfs": False,
+			"sector_size": None,
+			"disklabel": None,
+			"identifier": None,
+			"partitions": []
+		}
+
+		ss = sector_size or logical_sector_size(fd)
+		if ss is None:
+			ss = _detect_gpt_sector_size(fd, size_b) or 512
+		dev["sector_size"] = ss
+
+		if size_b < 512:
+			return dev
+		mbr = _pread(fd, 512, 0)
+		if mbr[510:512] != MBR_SIGNATURE:
+			return dev
+
+		entries = _mbr_entries(mbr)
+		if any(e[1] == MBR_TYPE_GPT_PROTECTIVE for e in entries):
+			(header, parts) = _read_gpt(fd, name, size_b, ss)
+			dev["disklabel"] = "gpt"
+			dev["identifier"] = header["disk_guid"].upper()
+			dev["gpt"] = header
+		else:
+			# A boot sector of a partitionless filesystem (e.g. FAT) has the signature as well, but no valid entries
+			if any(e[0] not in (0x00, 0x80) for e in entries):
+				return dev
+			parts = _read_mbr(fd, name, mbr, ss)
+			dev["disklabel"] = "dos"
+			dev["identifier"] = "0x{:08x}".format(struct.unpack_from("<I", mbr, 440)[0])
+
+		dev["partitions"] = parts
+		dev["isntfs"] = any(p["isntfs"] for p in parts)
+		return dev
+	finally:
+		if not isinstance(source, int):
+			os.close(fd)
+
+
+def parttablelist(paths: List[str]) -> List[Dict]:
+	"""
+	Reads the partition tables of several devices or images (see read_partition_table)
+	:return: The device dicts in the order of paths, like fdisktools.fdisklist
+	"""
+	return [read_partition_table(p) for p in paths]
@@ -0,0 +1,225 @@
+from os import listdir
+from os.path import isdir, isfile, join
+from typing import Dict, List
+from fileutilslib.disklib.filetools import bytes_to_unit
+
+DEFAULT_SYSFS_ROOT = "/sys"
+DEFAULT_PROCFS_ROOT = "/proc"
+DEFAULT_UDEV_ROOT = "/run/udev"
+DEFAULT_DEV_ROOT = "/dev"
+
+# The size attributes of sysfs count 512-byte sectors, whatever the logical block size of the device is
+SYSFS_SECTOR_SIZE = 512
+
+_NTFS_PARTITION_TYPES = ("0x7", "0x07", "ebd0a0a2-b9e5-4433-87c0-68b6b72699c7")
+_NTFS_FS_TYPES = ("ntfs", "ntfs3", "exfat")
+
+
+def read_sysattr(path: str) -> str:
+	"""
+	:return: The stripped content of a sysfs/procfs attribute, "" if it doesn't exist or can't be read
+	"""
+	try:
+		with open(path, "r") as f:
+			return f.read().strip()
+	except OSError:
+		return ""
+
+
+def read_keyvalues(path: str, prefix: str = "") -> Dict[str, str]:
+	"""
+	Reads KEY=VALUE lines (uevent files, udev database entries)
+	:param prefix: Only lines starting with it are read, it is removed from the keys (e.g. "E:" for udev)
+	"""
+	result = {}
+	for line in read_sysattr(path).splitlines():
+		if not line.startswith(prefix):
+			continue
+		p = line.find("=")
+		if p > -1:
+			result[line[len(prefix):p]] = line[p + 1:]
+	return result
+
+
+def _int_attr(path: str, default: int = 0) -> int:
+	try:
+		return int(read_sysattr(path))
+	except ValueError:
+		return default
+
+
+def sysfs_available(sysfs_root: str = DEFAULT_SYSFS_ROOT) -> bool:
+	return isdir(join(sysfs_root, "block"))
+
+
+def _devpath(name: str, uevent: Dict[str, str], dev_root: str) -> str:
+	# Slashes of device names are replaced with "!" in sysfs (e.g. cciss!c0d0 for /dev/cciss/c0d0)
+	return join(dev_root, uevent.get("DEVNAME") or name.replace("!", "/"))
+
+
+def _udev_properties(major: int, minor: int, udev_root: str) -> Dict[str, str]:
+	return read_keyvalues(join(udev_root, "data", "b{}:{}".format(major, minor)), "E:")
+
+
+def _partition_type(udev: Dict[str, str]) -> str:
+	"""
+	The filesystem type udev probed (e.g. "ext4"), else the partition type of the table (e.g. "0x83")
+	"""
+	return udev.get("ID_FS_TYPE") or udev.get("ID_PART_ENTRY_TYPE") or ""
+
+
+def _is_ntfs(udev: Dict[str, str]) -> bool:
+	return udev.get("ID_PART_ENTRY_TYPE", "").lower() in _NTFS_PARTITION_TYPES or \
+		udev.get("ID_FS_TYPE", "") in _NTFS_FS_TYPES
+
+
+def _blockdev(sysdir: str, name: str, udev_root: str, dev_root: str) -> Dict:
+	uevent = read_keyvalues(join(sysdir, "uevent"))
+	major, _, minor = read_sysattr(join(sysdir, "dev")).partition(":")
+	major = int(major) if major.isdigit() else int(uevent.get("MAJOR", -1))
+	minor = int(minor) if minor.isdigit() else int(uevent.get("MINOR", -1))
+	size_b = _int_attr(join(sysdir, "size")) * SYSFS_SECTOR_SIZE
+	udev = _udev_properties(major, minor, udev_root)
+	return {
+		"dev": _devpath(name, uevent, dev_root),
+		"size_b": size_b,
+		"size_h": bytes_to_unit(size_b, True),
+		"major": major,
+		"minor": minor,
+		"ro": read_sysattr(join(sysdir, "ro")) == "1",
+		"_udev": udev
+	}
+
+
+def _sysfs_partitions(disksysdir: str, diskname: str, udev_root: str, dev_root: str) -> List[Dict]:
+	parts = []
+	for name in listdir(disksysdir):
+		partdir = join(disksysdir, name)
+		if not name.startswith(diskname) or not isfile(join(partdir, "partition")):
+			continue
+		part = _blockdev(partdir, name, udev_root, dev_root)
+		udev = part.pop("_udev")
+		part["type"] = _partition_type(udev)
+		part["partn"] = _int_attr(join(partdir, "partition"))
+		part["start"] = _int_attr(join(partdir, "start"))
+		part["isntfs"] = _is_ntfs(udev)
+		parts.append(part)
+	return sorted(parts, key=lambda p: p["partn"])
+
+
+def _sysfs_disks(sysfs_root: str, udev_root: str, dev_root: str, include_empty: bool) -> List[Dict]:
+	devs = []
+	blockdir = join(sysfs_root, "block")
+	for name in sorted(listdir(blockdir)):
+		sysdir = join(blockdir, name)
+		dev = _blockdev(sysdir, name, udev_root, dev_root)
+		dev.pop("_udev")
+		# Loop devices without backing file and empty card readers have size 0, fdisk skips them as well
+		if dev["size_b"] == 0 and not include_empty:
+			continue
+		dev["removable"] = read_sysattr(join(sysdir, "removable")) == "1"
+		dev["model"] = read_sysattr(join(sysdir, "device", "model"))
+		dev["serial"] = read_sysattr(join(sysdir, "device", "serial")) or read_sysattr(join(sysdir, "serial"))
+		dev["partitions"] = _sysfs_partitions(sysdir, name, udev_root, dev_root)
+		dev["isntfs"] = any(p["isntfs"] for p in dev["partitions"])
+		devs.append(dev)
+	return devs
+
+
+def _procfs_disks(procfs_root: str, udev_root: str, dev_root: str, include_empty: bool) -> List[Dict]:
+	"""
+	Fallback without sysfs: /proc/partitions doesn't tell which entries are partitions, so entries named
+	like an earlier entry plus a number (sda1, nvme0n1p1, mmcblk0p1) are taken as its partitions.
+	Partitions don't have "ro" and "start" here, disks lack "ro", "removable", "model" and "serial".
+	"""
+	devs = []
+	lines = read_sysattr(join(procfs_root, "partitions")).splitlines()
+	for line in lines[1:]:
+		cols = line.split()
+		if len(cols) != 4 or not cols[0].isdigit():
+			continue
+		major, minor, blocks, name = int(cols[0]), int(cols[1]), int(cols[2]), cols[3]
+		# /proc/partitions counts 1 KiB blocks
+		size_b = blocks * 1024
+		entry = {
+			"dev": join(dev_root, name.replace("!", "/")),
+			"size_b": size_b,
+			"size_h": bytes_to_unit(size_b, True),
+			"major": major,
+			"minor": minor
+		}
+		disk = None
+		for d in reversed(devs):
+			rest = name[len(d["_name"]):]
+			# Disks whose names end with a digit separate the partition number with "p" (md1 isn't md10's disk)
+			if d["_name"][-1].isdigit() and not rest.startswith("p"):
+				continue
+			if name.startswith(d["_name"]) and len(rest) > 0 and rest.lstrip("p").isdigit():
+				disk = d
+				break
+		udev = _udev_properties(major, minor, udev_root)
+		if disk is not None:
+			entry["type"] = _partition_type(udev)
+			entry["partn"] = int(rest.lstrip("p"))
+			entry["isntfs"] = _is_ntfs(udev)
+			disk["partitions"].append(entry)
+			disk["isntfs"] = disk["isntfs"] or entry["isntfs"]
+		elif size_b > 0 or include_empty:
+			entry["_name"] = name
+			entry["partitions"] = []
+			entry["isntfs"] = False
+			devs.append(entry)
+	for d in devs:
+		d.pop("_name")
+	return devs
+
+
+def sysfslist(
+	dbgout: bool = True,
+	sysfs_root: str = DEFAULT_SYSFS_ROOT,
+	procfs_root: str = DEFAULT_PROCFS_ROOT,
+	udev_root: str = DEFAULT_UDEV_ROOT,
+	dev_root: str = DEFAULT_DEV_ROOT,
+	include_empty: bool = False
+) -> List[Dict]:
+	"""
+	Lists the block devices and their partitions like fdisktools.fdisklist, but without root and without
+	spawning a process: sizes and the disk/partition hierarchy are read from sysfs (/proc/partitions if
+	there is no sysfs), partition types from the udev database if it exists.
+	Each device dict has "dev", "size_b", "size_h", "isntfs" and "partitions" like fdisklist, plus "major",
+	"minor", "ro", "removable", "model" and "serial". Partitions have "dev", "size_b", "size_h" and "type"
+	(the filesystem type if udev knows it, else the partition table type), plus "major", "minor", "ro",
+	"partn", "start" (in 512-byte sectors) and "isntfs". Sizes are exact, fdisk rounds partition sizes.
+	:param dbgout: Print the devices
+	:param sysfs_root: Where sysfs is mounted, point the roots to a copied or fake tree for tests
+	:param procfs_root: Where procfs is mounted
+	:param udev_root: The udev runtime directory, the database is read from its "data" subdirectory
+	:param dev_root: Prefix of the returned device paths
+	:param include_empty: Also list devices of size 0 (unbound loop devices, card readers without card)
+	"""
+	if sysfs_available(sysfs_root):
+		devs = _sysfs_disks(sysfs_root, udev_root, dev_root, include_empty)
+	elif isfile(join(procfs_root, "partitions")):
+		devs = _procfs_disks(procfs_root, udev_root, dev_root, include_empty)
+	else:
+		raise Exception("Neither '{}' nor '{}' can be read".format(
+			join(sysfs_root, "block"), join(procfs_root, "partitions")
+		))
+
+	if dbgout:
+		print_devices(devs)
+
+	return devs
+
+
+def print_devices(devs: List[Dict]) -> None:
+	"""
+	Prints devices listed by sysfslist or fdisktools.fdisklist
+	"""
+	for dev in devs:
+		print("=========================================")
+		print("Disk {}: {}, {} bytes".format(dev["dev"], dev["size_h"], dev["size_b"]))
+		for pd in dev["partitions"]:
+			print("\t" + pd["dev"] + " - " + pd["size_h"] + " - " + pd["type"])
+		if dev["isntfs"]:
+			print("NTFS")
@@ -0,0 +1,265 @@
+import json
+import os
+import re
+from errno import EINVAL
+from os import O_RDONLY, fstat
+from os.path import realpath, basename, dirname, isfile, join, expanduser
+from stat import S_ISBLK
+from time import perf_counter
+from typing import Dict, List
+from fileutilslib.disklib.copytools import path_size, aligned_buffer, blocksize_to_bytes, copy_path
+from fileutilslib.disklib.filetools import bytes_to_unit
+from fileutilslib.disklib.sysfstools import read_sysattr
+
+IO_MODE_BUFFERED = "buffered"
+IO_MODE_DIRECT = "direct"
+
+DEFAULT_TUNE_BLOCKSIZES = ["64K", "256K", "1M", "4M", "16M"]
+DEFAULT_TUNE_SAMPLE_SIZE = 256 * 1024 * 1024
+
+_SYS_CLASS_BLOCK = "/sys/class/block"
+
+_PCI_ADDRESS = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-9a-f]$")
+_USB_ROOT_HUB = re.compile(r"^usb[0-9]+$")
+
+
+def tune_cache_path() -> str:
+	cachedir = os.environ.get("XDG_CACHE_HOME") or join(expanduser("~"), ".cache")
+	return join(cachedir, "fileutilslib", "blocksizes.json")
+
+
+def _disk_sysdir(rp: str) -> str:
+	sysdir = realpath(join(_SYS_CLASS_BLOCK, basename(rp)))
+	if isfile(join(sysdir, "partition")):
+		sysdir = dirname(sysdir)
+	return sysdir
+
+
+def device_disk(devpath: str) -> str:
+	"""
+	Returns a key for the physical disk a device or partition belongs to ("block:sda" for /dev/sda2),
+	plain files get the key of the disk they reside on ("file:<major>:<minor>")
+	"""
+	rp = realpath(devpath)
+	st = os.stat(rp)
+	if not S_ISBLK(st.st_mode):
+		return "file:{}:{}".format(os.major(st.st_dev), os.minor(st.st_dev))
+	return "block:{}".format(basename(_disk_sysdir(rp)))
+
+
+def device_identity(devpath: str) -> str:
+	"""
+	Returns a key identifying the model and serial of the disk a device or partition belongs to.
+	Plain files are identified by the filesystem they reside on.
+	"""
+	rp = realpath(devpath)
+	fd = os.open(rp, O_RDONLY)
+	try:
+		st = fstat(fd)
+	finally:
+		os.close(fd)
+
+	if not S_ISBLK(st.st_mode):
+		return "file:{}:{}".format(os.major(st.st_dev), os.minor(st.st_dev))
+
+	sysdir = _disk_sysdir(rp)
+
+	model = read_sysattr(join(sysdir, "device", "model"))
+	serial = read_sysattr(join(sysdir, "device", "serial")) or read_sysattr(join(sysdir, "device", "wwid"))
+
+	if model == "" and serial == "":
+		return "block:{}".format(basename(sysdir))
+	return "{}|{}".format(model, serial)
+
+
+def device_bus(devpath: str) -> str:
+	"""
+	Returns a key for the controller a device is attached to: "usb:<pci address>:usbN" for devices behind the
+	same USB root hub, "pci:<address>" for the controller of SATA/SAS/NVMe disks and "virtual" for loop, ram
+	or device-mapper devices. Plain files get the key of the disk they reside on ("file:<major>:<minor>").
+	"""
+	rp = realpath(devpath)
+	st = os.stat(rp)
+
+	if not S_ISBLK(st.st_mode):
+		return "file:{}:{}".format(os.major(st.st_dev), os.minor(st.st_dev))
+
+	parts = realpath(join(_SYS_CLASS_BLOCK, basename(rp))).split("/")
+	pci = None
+	for part in parts:
+		if _USB_ROOT_HUB.match(part):
+			return "usb:{}:{}".format(pci, part)
+		if _PCI_ADDRESS.match(part):
+			pci = part
+	return "pci:{}".format(pci) if pci is not None else "virtual"
+
+
+def _drop_cache(fd: int, offset: int, length: int) -> None:
+	if hasattr(os, "posix_fadvise"):
+		os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def _direct_io_supported(devpath: str) -> bool:
+	# Filesystems without O_DIRECT (e.g. tmpfs) reject it when the file is opened
+	try:
+		fd = os.open(devpath, O_RDONLY | os.O_DIRECT)
+	except OSError as e:
+		if e.errno == EINVAL:
+			return False
+		raise
+	os.close(fd)
+	return True
+
+
+def _bench_read(devpath: str, blocksize: int, mode: str, offset: int, length: int) -> float:
+	flags = O_RDONLY
+	if mode == IO_MODE_DIRECT:
+		flags |= os.O_DIRECT
+	fd = os.open(devpath, flags)
+	try:
+		_drop_cache(fd, offset, length)
+		buffer = aligned_buffer(blocksize)
+		mv = memoryview(buffer)
+		try:
+			pos = offset
+			end = offset + length
+			start = perf_counter()
+			while pos < end:
+				n = os.preadv(fd, [mv], pos)
+				if n == 0:
+					break
+				pos += n
+			secs = perf_counter() - start
+		finally:
+			mv.release()
+			buffer.close()
+		return (pos - offset) / secs if secs > 0 else 0.0
+	finally:
+		os.close(fd)
+
+
+def benchmark_blocksizes(
+	devpath: str,
+	blocksizes: List = None,
+	modes: List[str] = None,
+	sample_size=DEFAULT_TUNE_SAMPLE_SIZE,
+	sample_offset: int = None
+) -> List[Dict]:
+	"""
+	Measures the read throughput of a region of the device for each combination of block size and I/O mode.
+	The page cache of the region is dropped before each run, so buffered runs don't profit from earlier ones.
+	:param devpath: The device (or file) to benchmark, only read from
+	:param blocksizes: ints or dd-style strings, defaults to 64K to 16M
+	:param modes: IO_MODE_BUFFERED and/or IO_MODE_DIRECT (skipped where the filesystem rejects O_DIRECT)
+	:param sample_size: Bytes read per run as int or dd-style string, at most the device size
+	:param sample_offset: Start of the sampled region, defaults to the middle of the device. It is aligned
+	down to the largest block size, which direct I/O requires.
+	:return: A list of dicts with "blocksize", "blocksize_h", "mode" and "throughput" (bytes per second)
+	"""
+	bss = [blocksize_to_bytes(bs) for bs in (blocksizes or DEFAULT_TUNE_BLOCKSIZES)]
+	mds = modes or [IO_MODE_BUFFERED, IO_MODE_DIRECT]
+
+	size = path_size(devpath)
+	length = min(blocksize_to_bytes(sample_size), size)
+	# Aligned to the largest block size, so every run reads the same region in whole blocks
+	align = max(bss)
+	if sample_offset is None:
+		offset = ((size - length) // 2 // align) * align
+	else:
+		offset = (sample_offset // align) * align
+	length = max(align, (length // align) * align) if size >= align else length
+
+	results = []
+	for mode in mds:
+		if mode != IO_MODE_BUFFERED and mode != IO_MODE_DIRECT:
+			raise Exception("Unknown I/O mode '{}'".format(mode))
+		if mode == IO_MODE_DIRECT and (not hasattr(os, "O_DIRECT") or not _direct_io_supported(devpath)):
+			continue
+		for bs in bss:
+			throughput = _bench_read(devpath, bs, mode, offset, length)
+			results.append({
+				"blocksize": bs,
+				"blocksize_h": bytes_to_unit(bs, True, True, False),
+				"mode": mode,
+				"throughput": throughput
+			})
+	return results
+
+
+def benchmark_copy_modes(srcpath: str, dstpath: str, blocksize="1M", modes: List[str] = None) -> List[Dict]:
+	"""
+	Compares the throughput of a complete copy with buffered and direct I/O (copytools.copy_path).
+	Buffered copies are timed including the final fsync, so both modes have to bring the data to the disk.
+	:param srcpath: The source device or file
+	:param dstpath: The target file, overwritten by each run and removed afterwards
+	:param blocksize: int or dd-style string
+	:param modes: IO_MODE_BUFFERED and/or IO_MODE_DIRECT
+	:return: A list of dicts with "mode", "size_b", "seconds" and "throughput" (bytes per second)
+	"""
+	results = []
+	try:
+		for mode in (modes or [IO_MODE_BUFFERED, IO_MODE_DIRECT]):
+			fd = os.open(srcpath, O_RDONLY)
+			try:
+				_drop_cache(fd, 0, 0)
+			finally:
+				os.close(fd)
+			start = perf_counter()
+			copied = copy_path(srcpath, dstpath, blocksize, direct=(mode == IO_MODE_DIRECT))
+			secs = perf_counter() - start
+			results.append({
+				"mode": mode,
+				"size_b": copied,
+				"seconds": secs,
+				"throughput": copied / secs if secs > 0 else 0.0
+			})
+	finally:
+		if isfile(dstpath):
+			os.remove(dstpath)
+	return results
+
+
+def pick_best(results: List[Dict]) -> Dict:
+	if results is None or len(results) == 0:
+		raise Exception("No benchmark results")
+	return max(results, key=lambda r: r["throughput"])
+
+
+def _load_tune_cache() -> Dict:
+	cp = tune_cache_path()
+	if not isfile(cp):
+		return {}
+	try:
+		with open(cp, "r") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+
+def tuned_blocksize(devpath: str, use_cache: bool = True, **benchmark_args) -> Dict:
+	"""
+	Returns the fastest block size and I/O mode for a device. Results are cached per device model and serial.
+	:param devpath: The device (or file)
+	:param use_cache: False to benchmark again (the new result is cached anyway)
+	:param benchmark_args: Passed to benchmark_blocksizes
+	:return: A dict like the ones of benchmark_blocksizes, plus "results" with all measurements if not cached
+	"""
+	key = device_identity(devpath)
+	cache = _load_tune_cache()
+
+	if use_cache and key in cache:
+		return cache[key]
+
+	results = benchmark_blocksizes(devpath, **benchmark_args)
+	best = dict(pick_best(results))
+	cache[key] = dict(best)
+
+	cp = tune_cache_path()
+	os.makedirs(dirname(cp), exist_ok=True)
+	tmp = cp + ".tmp"
+	with open(tmp, "w") as f:
+		json.dump(cache, f)
+	os.replace(tmp, cp)
+
+	best["results"] = results
+	return best
@@ -0,0 +1,392 @@
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+from collections import OrderedDict
+from datetime import datetime
+from os.path import join, dirname, abspath
+from tempfile import mkdtemp
+from typing import Callable, Dict, List, Tuple
+from fileutilslib.classes.Bencher import Bencher, BenchRegistry
+from fileutilslib.disklib.copytools import copy_path, copy_methods
+from fileutilslib.disklib.ddtools import parse_dd_info
+from fileutilslib.disklib.fdisktools import parse_partition_line, fdisk_size_to_bytesize, parse_fdisk_output
+from fileutilslib.disklib.filetools import bytes_to_unit, walk_flat, count_file_rows
+from fileutilslib.misclib.helpertools import humantime
+
+BASELINE_FORMAT = 1
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_REPEAT = 10
+
+# The synthetic inputs are generated from a fixed seed, so every run (and every library version) gets the same
+_SEED = 4711
+
+_MiB = 1024 * 1024
+
+_PARTITION_TYPES = (
+	("83", "Linux"), ("82", "Linux swap / Solaris"), ("7", "HPFS/NTFS/exFAT"), ("c", "W95 FAT32 (LBA)"),
+	("5", "Extended"), ("8e", "Linux LVM"), ("fd", "Linux raid autodetect")
+)
+
+_GPT_TYPES = ("Linux filesystem", "EFI System", "Microsoft basic data", "Linux swap", "Linux LVM")
+
+_SIZE_SUFFIXES = ("", "M", "G", "T")
+
+FIXTURES_DIR = join(dirname(abspath(__file__)), "fixtures")
+
+# Recorded "LC_ALL=C fdisk -l" outputs
+FDISK_FIXTURES = ("mbr", "gpt", "many", "multipath")
+
+
+def _fdisk_size(sectors: int, rng: random.Random) -> str:
+	size_b = sectors * 512
+	suffix = rng.choice(_SIZE_SUFFIXES)
+	if suffix == "":
+		return str(size_b)
+	value = size_b / {"M": _MiB, "G": _MiB * 1024, "T": _MiB * 1024 * 1024}[suffix]
+	# fdisk prints the decimals localized
+	return "{:.1f}{}".format(value, suffix).replace(".0" + suffix, suffix).replace(".", rng.choice((".", ",")))
+
+
+def partition_lines(count: int, isboottype: bool, seed: int = _SEED) -> List[str]:
+	"""
+	:return: Partition lines as printed by "fdisk -l" for DOS (isboottype) or GPT disk labels
+	"""
+	rng = random.Random(seed)
+	lines = []
+	start = 2048
+	for i in range(count):
+		sectors = rng.choice((1, 8, 64, 512, 4096)) * 2048 * rng.randint(1, 64)
+		end = start + sectors - 1
+		dev = "/dev/sd{}{}".format(chr(ord("a") + (i // 16) % 26), i % 16 + 1)
+		if isboottype:
+			ptype = rng.choice(_PARTITION_TYPES)
+			lines.append("{:<10} {} {:>12} {:>12} {:>12} {:>5} {:>2} {}".format(
+				dev, "*" if i % 16 == 0 else " ", start, end, sectors, _fdisk_size(sectors, rng), ptype[0], ptype[1]
+			))
+		else:
+			lines.append("{:<10} {:>12} {:>12} {:>12} {:>5} {}".format(
+				dev, start, end, sectors, _fdisk_size(sectors, rng), rng.choice(_GPT_TYPES)
+			))
+		start = end + 1
+	return lines
+
+
+def dd_info_lines(count: int, seed: int = _SEED) -> List[str]:
+	"""
+	:return: Progress lines as printed by "dd status=progress" in the C and in a comma locale
+	"""
+	rng = random.Random(seed)
+	lines = []
+	done_b = 0
+	for i in range(count):
+		done_b += rng.randint(20, 200) * _MiB
+		secs = i + 1 + rng.random()
+		rate = done_b / secs / 1000000
+		gb = done_b / 1000000000
+		gib = done_b / (_MiB * 1024)
+		line = "{} bytes ({:.1f} GB, {:.1f} GiB) copied, {:.5f} s, {:.0f} MB/s".format(done_b, gb, gib, secs, rate)
+		lines.append(line if i % 2 == 0 else line.replace(".", ","))
+	return lines
+
+
+def fdisk_fixture(name: str) -> str:
+	"""
+	:param name: One of FDISK_FIXTURES
+	:return: The recorded fdisk output
+	"""
+	with open(join(FIXTURES_DIR, "fdisk_{}.txt".format(name))) as f:
+		return f.read()
+
+
+def fdisk_output(min_lines: int) -> str:
+	"""
+	:return: The recorded fdisk outputs repeated until they have at least min_lines lines
+	"""
+	blob = "\n".join(fdisk_fixture(name) for name in FDISK_FIXTURES)
+	lines = blob.count("\n") + 1
+	return "\n".join([blob] * max(1, -(-min_lines // lines)))
+
+
+def fdisk_sizes(count: int, seed: int = _SEED) -> List[str]:
+	rng = random.Random(seed)
+	return [_fdisk_size(rng.randint(1, 1 << 32), rng) for _ in range(count)]
+
+
+def byte_sizes(count: int, seed: int = _SEED) -> List[int]:
+	"""
+	:return: Sizes spread evenly over the magnitudes from bytes to petabytes
+	"""
+	rng = random.Random(seed)
+	return [rng.randint(1, 1 << rng.randint(1, 52)) for _ in range(count)]
+
+
+def durations(count: int, seed: int = _SEED) -> List[float]:
+	rng = random.Random(seed)
+	return [rng.uniform(0, 10 ** rng.randint(1, 5)) for _ in range(count)]
+
+
+def _bench_partition_lines(workdir: str, scale: float) -> Tuple[Callable, int]:
+	dos = partition_lines(max(1, int(5000 * scale)), True)
+	gpt = partition_lines(max(1, int(5000 * scale)), False)
+
+	def run():
+		for line in dos:
+			parse_partition_line(line, True)
+		for line in gpt:
+			parse_partition_line(line, False)
+
+	return run, len(dos) + len(gpt)
+
+
+def _bench_fdisk_output(workdir: str, scale: float) -> Tuple[Callable, int]:
+	blob = fdisk_output(max(1, int(10000 * scale)))
+
+	def run():
+		parse_fdisk_output(blob)
+
+	return run, blob.count("\n") + 1
+
+
+def _bench_dd_info(workdir: str, scale: float) -> Tuple[Callable, int]:
+	lines = dd_info_lines(max(1, int(10000 * scale)))
+
+	def run():
+		for line in lines:
+			parse_dd_info(line)
+
+	return run, len(lines)
+
+
+def _bench_fdisk_sizes(workdir: str, scale: float) -> Tuple[Callable, int]:
+	sizes = fdisk_sizes(max(1, int(50000 * scale)))
+
+	def run():
+		for s in sizes:
+			fdisk_size_to_bytesize(s)
+
+	return run, len(sizes)
+
+
+def _bench_bytes_to_unit(workdir: str, scale: float) -> Tuple[Callable, int]:
+	sizes = byte_sizes(max(1, int(50000 * scale)))
+
+	def run():
+		for s in sizes:
+			bytes_to_unit(s, True)
+			bytes_to_unit(s, False, False)
+
+	return run, len(sizes) * 2
+
+
+def _bench_humantime(workdir: str, scale: float) -> Tuple[Callable, int]:
+	secs = durations(max(1, int(50000 * scale)))
+
+	def run():
+		for s in secs:
+			humantime(s)
+
+	return run, len(secs)
+
+
+def _bench_walk_flat(workdir: str, scale: float) -> Tuple[Callable, int]:
+	folder = join(workdir, "walk_flat")
+	os.mkdir(folder)
+	files = max(1, int(5000 * scale))
+	dirs = max(1, int(500 * scale))
+	for i in range(files):
+		open(join(folder, "file{:06d}.img".format(i)), "w").close()
+	for i in range(dirs):
+		os.mkdir(join(folder, "dir{:05d}".format(i)))
+
+	def run():
+		# walk_flat always returns a generator, the results are only produced with yieldresults
+		for _ in walk_flat(folder, onlyfiles=True, yieldresults=True):
+			pass
+		for _ in walk_flat(folder, onlydirs=True, yieldresults=True):
+			pass
+
+	return run, files + dirs
+
+
+def _bench_count_file_rows(workdir: str, scale: float) -> Tuple[Callable, int]:
+	path = join(workdir, "rows.txt")
+	rows = max(1, int(200000 * scale))
+	rng = random.Random(_SEED)
+	with open(path, "w") as f:
+		for i in range(rows):
+			f.write("{:012d} {:016x} {}\n".format(i * 4096, rng.getrandbits(64), "x" * rng.randint(0, 80)))
+
+	def run():
+		count_file_rows(path)
+
+	return run, rows
+
+
+def _copy_source(workdir: str, scale: float) -> Tuple[str, int]:
+	path = join(workdir, "copy_src.img")
+	if not os.path.exists(path):
+		size = max(1, int(64 * scale)) * _MiB
+		rng = random.Random(_SEED)
+		with open(path, "wb") as f:
+			for i in range(size // _MiB):
+				# Half of the MiBs are zeros, like the unused space of a disk image
+				f.write(bytes(_MiB) if i % 2 == 1 else rng.getrandbits(8 * _MiB).to_bytes(_MiB, "little"))
+	return path, os.path.getsize(path)
+
+
+def _copy_bench(method: str = None, sparse: bool = False) -> Callable:
+	def setup(workdir: str, scale: float) -> Tuple[Callable, int]:
+		src, size = _copy_source(workdir, scale)
+		dst = join(workdir, "copy_dst.img")
+
+		def run():
+			copy_path(src, dst, method=method, sparse=sparse)
+
+		return run, size
+
+	return setup
+
+
+def benchmarks() -> Dict[str, Callable]:
+	"""
+	The benchmarks of the suite. Each is a setup function taking (workdir, scale) and returning the function
+	to time and the number of items (lines, values, files or bytes) it processes per run.
+	"""
+	result = OrderedDict([
+		("fdisktools.parse_partition_line", _bench_partition_lines),
+		("fdisktools.parse_fdisk_output", _bench_fdisk_output),
+		("fdisktools.fdisk_size_to_bytesize", _bench_fdisk_sizes),
+		("ddtools.parse_dd_info", _bench_dd_info),
+		("filetools.bytes_to_unit", _bench_bytes_to_unit),
+		("helpertools.humantime", _bench_humantime),
+		("filetools.walk_flat", _bench_walk_flat),
+		("filetools.count_file_rows", _bench_count_file_rows)
+	])
+	for method in copy_methods():
+		result["copytools.copy_path[{}]".format(method)] = _copy_bench(method)
+	result["copytools.copy_path[sparse]"] = _copy_bench(sparse=True)
+	return result
+
+
+def _meta(repeat: int, scale: float) -> Dict:
+	try:
+		from pkg_resources import get_distribution
+		version = get_distribution("FileUtilsLib").version
+	except Exception:
+		version = None
+	return {
+		"format": BASELINE_FORMAT,
+		"created": datetime.now().isoformat(timespec="seconds"),
+		"host": socket.gethostname(),
+		"machine": platform.machine(),
+		"platform": platform.platform(),
+		"python": platform.python_version(),
+		"fileutilslib": version,
+		"repeat": repeat,
+		"scale": scale
+	}
+
+
+def run_benchmarks(
+	names: List[str] = None,
+	repeat: int = DEFAULT_REPEAT,
+	warmup: int = 1,
+	scale: float = 1.0,
+	workdir: str = None,
+	progress_handler: Callable = None
+) -> Dict:
+	"""
+	Runs the suite (see benchmarks())
+	:param names: Only run the benchmarks whose names contain one of these strings
+	:param repeat: Measured runs per benchmark
+	:param warmup: Unmeasured runs per benchmark
+	:param scale: Factor for the input sizes
+	:param workdir: Directory for the generated files, a temporary directory below it is removed afterwards.
+	Pick one on the disk you want the copy benchmarks to measure, the default (/tmp) is often a tmpfs.
+	:param progress_handler: Called with the name and the statistics after each benchmark
+	:return: A baseline (see save_baseline) with "meta" and "results", the results keyed by benchmark name
+	"""
+	selected = [
+		(name, setup) for (name, setup) in benchmarks().items()
+		if names is None or len(names) == 0 or any(n in name for n in names)
+	]
+	if len(selected) == 0:
+		raise Exception("No benchmark matches {}".format(", ".join(names)))
+
+	tmpdir = mkdtemp(prefix="fileutilslib-bench-", dir=workdir)
+	results = OrderedDict()
+	try:
+		for (name, setup) in selected:
+			func, items = setup(tmpdir, scale)
+			# The decorated library functions still record into the global registry, below the benchmark's section
+			stats = Bencher.repeat(func, repeat, warmup, name, BenchRegistry(False))
+			stats["items"] = items
+			stats["items_per_s"] = items / stats["median_s"] if stats["median_s"] > 0 else 0.0
+			results[name] = stats
+			if progress_handler is not None:
+				progress_handler(name, stats)
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+
+	return {"meta": _meta(repeat, scale), "results": results}
+
+
+def save_baseline(baseline: Dict, path: str) -> None:
+	with open(path, "w") as f:
+		json.dump(baseline, f, indent=2)
+		f.write("\n")
+
+
+def load_baseline(path: str) -> Dict:
+	with open(path) as f:
+		baseline = json.load(f)
+	if not isinstance(baseline, dict) or "results" not in baseline:
+		raise Exception("'{}' is not a benchmark baseline".format(path))
+	if baseline.get("meta", {}).get("format") != BASELINE_FORMAT:
+		raise Exception("The baseline '{}' has an unsupported format".format(path))
+	return baseline
+
+
+def compare_baselines(baseline: Dict, current: Dict, threshold: float = DEFAULT_THRESHOLD) -> List[Dict]:
+	"""
+	Compares the medians per item of two runs. Medians are used because single outliers (another process,
+	a cache flush) barely move them. Per item times keep runs with different scales comparable.
+	:param baseline: The reference run (see run_benchmarks and load_baseline)
+	:param current: The run to check
+	:param threshold: Relative slowdown above which a benchmark counts as regression (0.1 for 10 %)
+	:return: One dict per benchmark in both runs with name, baseline_s, current_s (seconds per item),
+	change (relative, positive is slower) and regression
+	"""
+	rows = []
+	for (name, cur) in current["results"].items():
+		base = baseline["results"].get(name)
+		if base is None or base.get("items", 0) == 0 or cur.get("items", 0) == 0:
+			continue
+		base_s = base["median_s"] / base["items"]
+		cur_s = cur["median_s"] / cur["items"]
+		change = (cur_s / base_s - 1) if base_s > 0 else 0.0
+		rows.append({
+			"name": name,
+			"baseline_s": base_s,
+			"current_s": cur_s,
+			"change": change,
+			"regression": change > threshold
+		})
+	return rows
+
+
+def format_comparison(rows: List[Dict]) -> str:
+	header = "{0:44} {1:>14} {2:>14} {3:>9}".format("Benchmark", "Baseline/item", "Current/item", "Change")
+	lines = [header, "-" * len(header)]
+	for r in rows:
+		lines.append("{0:44} {1:>14} {2:>14} {3:>+8.1f}%{4}".format(
+			r["name"][0:44],
+			"{:.2f} ns".format(r["baseline_s"] * 1e9),
+			"{:.2f} ns".format(r["current_s"] * 1e9),
+			r["change"] * 100,
+			"  REGRESSION" if r["regression"] else ""
+		))
+	return "\n".join(lines)
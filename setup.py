@@ -25,6 +25,9 @@ setup(
 		'fileutilslib.misclib',
 		'fileutilslib.classes'
 	],
+	package_data={
+		'fileutilslib.misclib': ['fixtures/*.txt']
+	},
 	classifiers=[
 		'Development Status :: 0.0.1 - Alpha',
 		'Environment :: Console',
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+from fileutilslib.classes.BackupScheduler import BackupScheduler, JOB_STATE_DONE
+from fileutilslib.classes.ImageBackup import ImageBackup
+
+
+class BackupSchedulerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def _backup(self, name: str) -> ImageBackup:
+		source = join(self.tmp, name + ".bin")
+		with open(source, "wb") as f:
+			f.write(os.urandom(256 * 1024))
+		backup = ImageBackup()
+		backup.set_device(source)
+		backup.set_image_path(join(self.tmp, name + ".img"))
+		return backup
+
+	def _assert_done(self, scheduler: BackupScheduler) -> None:
+		jobs = scheduler.run()
+		for job in jobs:
+			self.assertEqual((job.get_state(), job.get_retcode(), job.get_error()), (JOB_STATE_DONE, 0, None))
+			with open(str(job.get_backup().get_devicepath()), "rb") as src, open(job.get_imagepath(), "rb") as img:
+				self.assertEqual(img.read(), src.read())
+
+	def test_file_sources(self):
+		scheduler = BackupScheduler()
+		for name in ("a", "b"):
+			scheduler.add(self._backup(name), native=True)
+		self._assert_done(scheduler)
+
+	def test_unknown_size(self):
+		scheduler = BackupScheduler()
+		with mock.patch.object(ImageBackup, "get_target_image_ondisk_sizebytes", return_value=None):
+			job = scheduler.add(self._backup("a"), native=True)
+		self.assertEqual(job.get_size_b(), 0)
+		self._assert_done(scheduler)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from os.path import join
+from fileutilslib.classes.ChunkStore import ChunkStore, CHUNKING_FIXED, CHUNKING_CDC
+
+_KiB = 1024
+
+
+class ChunkStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.source = join(self.tmp, "source.bin")
+		block = os.urandom(64 * _KiB)
+		self.data = block * 4 + os.urandom(100 * _KiB)
+		with open(self.source, "wb") as f:
+			f.write(self.data)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def _restored(self, store: ChunkStore, recipe: str) -> bytes:
+		target = join(self.tmp, "restored.bin")
+		store.read_image(recipe, target)
+		with open(target, "rb") as f:
+			return f.read()
+
+	def test_fixed_roundtrip(self):
+		store = ChunkStore(join(self.tmp, "store"), CHUNKING_FIXED, "16K")
+		recipe = join(self.tmp, "image.recipe")
+		result = store.write_image(self.source, recipe)
+		self.assertEqual(result["size_b"], len(self.data))
+		# The repeated block is stored once
+		self.assertLess(result["new_b"], len(self.data) // 2)
+		self.assertEqual(self._restored(store, recipe), self.data)
+
+	def test_cdc_dedups_shifted_data(self):
+		store = ChunkStore(join(self.tmp, "store"), CHUNKING_CDC, "4K")
+		store.write_image(self.source, join(self.tmp, "a.recipe"))
+		with open(self.source, "wb") as f:
+			f.write(b"inserted" + self.data)
+		recipe = join(self.tmp, "b.recipe")
+		result = store.write_image(self.source, recipe)
+		self.assertLess(result["new_b"], 32 * _KiB)
+		self.assertEqual(self._restored(store, recipe), b"inserted" + self.data)
+
+	def test_gc_waits_for_writers(self):
+		store = ChunkStore(join(self.tmp, "store"), CHUNKING_FIXED, "16K")
+		store.write_image(self.source, join(self.tmp, "old.recipe"))
+		os.remove(join(self.tmp, "old.recipe"))
+
+		# The second image reuses the chunks of the deleted one, gc must not remove them meanwhile
+		recipe = join(self.tmp, "new.recipe")
+		started = threading.Event()
+		proceed = threading.Event()
+
+		def progress(processed, total):
+			started.set()
+			proceed.wait()
+
+		writer = threading.Thread(target=store.write_image, args=(self.source, recipe, progress))
+		writer.start()
+		started.wait()
+		collected = []
+		collector = threading.Thread(target=lambda: collected.append(store.gc()))
+		collector.start()
+		collector.join(0.5)
+		self.assertTrue(collector.is_alive())
+		proceed.set()
+		writer.join()
+		collector.join()
+
+		self.assertEqual(collected[0]["chunks"], 0)
+		self.assertEqual(self._restored(store, recipe), self.data)
+		self.assertEqual(store.stats()["images"], 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
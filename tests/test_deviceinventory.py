@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from time import monotonic, sleep
+from fileutilslib.classes.DeviceInventory import DeviceInventory
+from fileutilslib.classes.DeviceTable import DeviceTable
+
+_PARTITIONS = "major minor  #blocks  name\n\n   8        0   15728640 sda\n"
+
+
+class DeviceInventoryTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		for name in ("sys", "proc", "udev/data", "dev"):
+			os.makedirs(join(self.tmp, name))
+		with open(join(self.tmp, "proc", "partitions"), "w") as f:
+			f.write(_PARTITIONS)
+		self.inventory = DeviceInventory(
+			ttl=0,
+			sysfs_root=join(self.tmp, "sys"),
+			procfs_root=join(self.tmp, "proc"),
+			udev_root=join(self.tmp, "udev"),
+			dev_root=join(self.tmp, "dev")
+		)
+		self.listed = 0
+
+		def list_devices():
+			self.listed += 1
+			return DeviceTable([], join(self.tmp, "dev"))
+		self.inventory._list = list_devices
+
+	def tearDown(self):
+		self.inventory.stop_watching()
+		shutil.rmtree(self.tmp)
+
+	def _udev_probed(self, name: str) -> None:
+		# udev writes the entry next to the database and moves it in place
+		tmp = join(self.tmp, "udev", name + ".tmp")
+		with open(tmp, "w") as f:
+			f.write("E:ID_FS_TYPE=ext4\n")
+		os.replace(tmp, join(self.tmp, "udev", "data", name))
+
+	def test_fingerprint_follows_udev(self):
+		before = self.inventory.fingerprint()
+		self._udev_probed("c189:1")
+		self.assertEqual(self.inventory.fingerprint(), before)
+		self._udev_probed("b8:0")
+		self.assertNotEqual(self.inventory.fingerprint(), before)
+
+	def test_refresh_after_probe(self):
+		self.inventory.get_table()
+		self.inventory.get_table()
+		self.assertEqual(self.listed, 1)
+		self._udev_probed("b8:0")
+		self.inventory.get_table()
+		self.assertEqual(self.listed, 2)
+
+	def test_watcher_sees_probe(self):
+		self.inventory.start_watching(poll_interval=60)
+		self.assertEqual(self.listed, 1)
+		self._udev_probed("b8:0")
+		deadline = monotonic() + 5
+		while self.listed < 2 and monotonic() < deadline:
+			sleep(0.05)
+		self.assertEqual(self.listed, 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
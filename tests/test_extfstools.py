@@ -0,0 +1,128 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+from os.path import join
+from fileutilslib.disklib.extfstools import copy_path_used, used_ranges, used_sizebytes, read_ext_superblock, \
+	EXT_SUPERBLOCK_OFFSET, EXT_INCOMPAT_RECOVER, EXT_STATE_VALID
+
+# e2fsprogs lives in sbin, which isn't on the PATH of every user
+_SEARCH_PATH = os.pathsep.join([os.environ.get("PATH", ""), "/sbin", "/usr/sbin"])
+_MKFS = shutil.which("mkfs.ext4", path=_SEARCH_PATH)
+_MKE2FS = shutil.which("mke2fs", path=_SEARCH_PATH)
+_DEBUGFS = shutil.which("debugfs", path=_SEARCH_PATH)
+_E2FSCK = shutil.which("e2fsck", path=_SEARCH_PATH)
+
+_MiB = 1024 * 1024
+
+
+@unittest.skipIf(_MKFS is None or _MKE2FS is None or _DEBUGFS is None, "mkfs.ext4 and debugfs are needed")
+class ExtUsedBlocksTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.files = {
+			"big.bin": os.urandom(3 * _MiB),
+			"sub/small.bin": os.urandom(50000),
+			"sub/gone.bin": os.urandom(2 * _MiB)
+		}
+		content = join(self.tmp, "content")
+		for (name, data) in self.files.items():
+			os.makedirs(join(content, os.path.dirname(name)), exist_ok=True)
+			with open(join(content, name), "wb") as f:
+				f.write(data)
+		self.image = join(self.tmp, "fs.img")
+		self._mkfs(_MKFS, self.image, 64, content)
+		# Freed blocks keep their data, the copy must not
+		self._debugfs(self.image, "rm /sub/gone.bin", True)
+		del self.files["sub/gone.bin"]
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def _mkfs(self, mkfs: str, path: str, size_mib: int, content: str, *args):
+		subprocess.run(
+			[mkfs, "-q", "-F", *args, "-d", content, path, "{}M".format(size_mib)],
+			check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+		)
+
+	def _debugfs(self, path: str, request: str, writable: bool = False) -> bytes:
+		return subprocess.run(
+			[_DEBUGFS] + (["-w"] if writable else []) + ["-R", request, path],
+			check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+		).stdout
+
+	def _patch_superblock(self, path: str, offset: int, fmt: str, update) -> None:
+		with open(path, "r+b") as f:
+			f.seek(EXT_SUPERBLOCK_OFFSET + offset)
+			value = struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+			f.seek(EXT_SUPERBLOCK_OFFSET + offset)
+			f.write(struct.pack(fmt, update(value)))
+
+	def test_used_sizebytes(self):
+		fd = os.open(self.image, os.O_RDONLY)
+		try:
+			sb = read_ext_superblock(fd)
+			(ranges, sbs) = used_ranges(fd)
+		finally:
+			os.close(fd)
+		used = used_sizebytes(self.image)
+		self.assertEqual(used, sum(e - s for (s, e) in ranges))
+		self.assertEqual(len(sbs), 1)
+		# Every allocated block is copied, the free ones aren't
+		self.assertGreaterEqual(used, (sb["blocks_count"] - sb["free_blocks_count"]) * sb["block_size"])
+		self.assertLess(used, os.path.getsize(self.image) // 2)
+
+	def test_copy_keeps_allocated_blocks(self):
+		target = join(self.tmp, "copy.img")
+		result = copy_path_used(self.image, target)
+		self.assertEqual(result["size_b"], os.path.getsize(self.image))
+		self.assertEqual(os.path.getsize(target), result["size_b"])
+
+		fd = os.open(self.image, os.O_RDONLY)
+		try:
+			ranges = used_ranges(fd)[0]
+		finally:
+			os.close(fd)
+		self.assertEqual(result["written_b"], sum(e - s for (s, e) in ranges))
+
+		with open(self.image, "rb") as f:
+			source = f.read()
+		with open(target, "rb") as f:
+			copy = f.read()
+		pos = 0
+		for (start, end) in ranges:
+			self.assertEqual(copy[pos:start].count(0), start - pos)
+			self.assertEqual(copy[start:end], source[start:end])
+			pos = end
+		self.assertEqual(copy[pos:].count(0), len(copy) - pos)
+
+		for (name, data) in self.files.items():
+			self.assertEqual(self._debugfs(target, "cat /" + name), data)
+		if _E2FSCK is not None:
+			self.assertEqual(subprocess.run(
+				[_E2FSCK, "-fn", target], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+			).returncode, 0)
+
+	def test_refuses_needs_recovery(self):
+		# Set while a journaled filesystem is mounted and after a crash
+		self._patch_superblock(self.image, 96, "<I", lambda v: v | EXT_INCOMPAT_RECOVER)
+		with self.assertRaisesRegex(Exception, "mounted"):
+			used_sizebytes(self.image)
+		with self.assertRaisesRegex(Exception, "mounted"):
+			copy_path_used(self.image, join(self.tmp, "copy.img"))
+
+	def test_refuses_unclean_ext2(self):
+		# Filesystems without journal clear the valid state while they are mounted
+		image = join(self.tmp, "ext2.img")
+		self._mkfs(_MKE2FS, image, 16, join(self.tmp, "content"), "-t", "ext2")
+		self.assertGreater(used_sizebytes(image), 0)
+		self._patch_superblock(image, 58, "<H", lambda v: v & ~EXT_STATE_VALID)
+		with self.assertRaisesRegex(Exception, "mounted"):
+			used_sizebytes(image)
+
+
+if __name__ == "__main__":
+	unittest.main()
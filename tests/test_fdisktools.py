@@ -0,0 +1,72 @@
+import unittest
+from fileutilslib.disklib.fdisktools import parse_fdisk_output
+from fileutilslib.misclib.benchtools import fdisk_fixture
+
+
+def _partitions(dev):
+	return [(p["dev"], p["start"], p["size_b"], p["type"]) for p in dev["partitions"]]
+
+
+class ParseFdiskOutputTest(unittest.TestCase):
+
+	def test_mbr(self):
+		devs = parse_fdisk_output(fdisk_fixture("mbr"))
+		self.assertEqual(len(devs), 2)
+		sda = devs[0]
+		self.assertEqual(sda["dev"], "/dev/sda")
+		self.assertEqual(sda["size_b"], 500107862016)
+		self.assertEqual(sda["sector_size"], 512)
+		self.assertEqual(sda["disklabel"], "dos")
+		self.assertEqual(sda["identifier"], "0x2c8f4a1e")
+		self.assertTrue(sda["isntfs"])
+		self.assertEqual(_partitions(sda), [
+			("/dev/sda1", 2048, 1024000 * 512, "HPFS/NTFS/exFAT"),
+			("/dev/sda2", 1026048, 418406400 * 512, "HPFS/NTFS/exFAT"),
+			("/dev/sda3", 419432448, 557338624 * 512, "W95 Ext'd (LBA)"),
+			("/dev/sda5", 419434496, 548947968 * 512, "Linux"),
+			("/dev/sda6", 968384512, 8386560 * 512, "Linux swap / Solaris")
+		])
+		self.assertEqual([p["boot"] for p in sda["partitions"]], [True, False, False, False, False])
+		self.assertEqual([p["id"] for p in sda["partitions"]], ["7", "7", "f", "83", "82"])
+		self.assertEqual(_partitions(devs[1]), [("/dev/sdb1", 2048, 30029202 * 512, "W95 FAT32 (LBA)")])
+		self.assertFalse(devs[1]["partitions"][0]["boot"])
+
+	def test_gpt(self):
+		devs = parse_fdisk_output(fdisk_fixture("gpt"))
+		self.assertEqual([d["dev"] for d in devs], ["/dev/nvme0n1", "/dev/sdc"])
+		self.assertEqual([d["disklabel"] for d in devs], ["gpt", "gpt"])
+		self.assertEqual(devs[0]["sector_size"], 512)
+		self.assertEqual(devs[0]["identifier"], "6A1F2C3B-8D4E-4F5A-9B6C-7D8E9F0A1B2C")
+		self.assertEqual(_partitions(devs[0])[3], ("/dev/nvme0n1p4", 420513792, 1286144 * 512, "Windows recovery environment"))
+		self.assertEqual(len(devs[0]["partitions"]), 5)
+		# Sizes of 4Kn disks are counted in 4096-byte sectors
+		self.assertEqual(devs[1]["sector_size"], 4096)
+		self.assertEqual(_partitions(devs[1]), [("/dev/sdc1", 256, 976754176 * 4096, "Linux RAID")])
+
+	def test_many(self):
+		devs = parse_fdisk_output(fdisk_fixture("many"))
+		sdf = devs[0]
+		self.assertEqual(sdf["dev"], "/dev/sdf")
+		self.assertEqual(len(sdf["partitions"]), 128)
+		self.assertEqual(_partitions(sdf)[-1], ("/dev/sdf128", 3875432448, 30515200 * 512, "Microsoft basic data"))
+		# Devices without partition table have neither label nor partitions
+		self.assertEqual([(d["dev"], d["disklabel"], len(d["partitions"])) for d in devs[1:]], [
+			("/dev/loop0", None, 0), ("/dev/loop1", None, 0), ("/dev/loop2", None, 0), ("/dev/loop3", None, 0)
+		])
+
+	def test_multipath(self):
+		devs = parse_fdisk_output(fdisk_fixture("multipath"))
+		self.assertEqual([d["dev"] for d in devs], [
+			"/dev/sdd", "/dev/sde", "/dev/mapper/mpatha", "/dev/mapper/mpathb", "/dev/mapper/vg0-data"
+		])
+		self.assertEqual(_partitions(devs[2]), [("/dev/mapper/mpatha-part1", 2048, 209713119 * 512, "Linux LVM")])
+		mpathb = devs[3]
+		self.assertEqual(mpathb["disklabel"], "dos")
+		self.assertEqual(_partitions(mpathb), [("/dev/mapper/mpathb-part1", 63, 104857537 * 512, "Linux LVM")])
+		self.assertFalse(mpathb["partitions"][0]["boot"])
+		self.assertEqual(mpathb["partitions"][0]["id"], "8e")
+		self.assertEqual(devs[4]["partitions"], [])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,204 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Timer
+from os.path import join
+from time import perf_counter
+from unittest import mock
+from fileutilslib.classes.ChunkStore import ChunkStore
+from fileutilslib.classes.ImageBackup import ImageBackup
+from fileutilslib.disklib.hashtools import read_checksums, checksum_path, source_checksum_path
+from fileutilslib.classes.ProgressTracker import ProgressEventType
+from fileutilslib.disklib.manifesttools import rebuild_total_b, INCREMENTAL_MODE_PATCH
+from fileutilslib.disklib.tunetools import IO_MODE_BUFFERED, IO_MODE_DIRECT
+
+_KiB = 1024
+_MiB = 1024 * 1024
+
+
+class ImageBackupTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.source = join(self.tmp, "source.bin")
+		self.data = bytearray(os.urandom(2 * _MiB))
+		self._write_source()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def _write_source(self) -> None:
+		with open(self.source, "wb") as f:
+			f.write(self.data)
+
+	def _backup(self, imagename: str) -> ImageBackup:
+		backup = ImageBackup()
+		backup.set_device(self.source)
+		backup.set_image_path(join(self.tmp, imagename))
+		return backup
+
+	def _read(self, path: str) -> bytes:
+		with open(path, "rb") as f:
+			return f.read()
+
+
+class FileSourceTest(ImageBackupTestCase):
+
+	def test_size_of_file_source(self):
+		# Files aren't in the device table
+		backup = self._backup("image.img")
+		self.assertEqual(backup.get_target_image_sizebytes(), len(self.data))
+		self.assertEqual(backup.get_target_image_ondisk_sizebytes(), len(self.data))
+		backup.assert_free_space()
+		with self.assertRaisesRegex(Exception, "not enough free space"):
+			backup.assert_free_space(backup.get_image_mountpoint_sizeinfo()["free"])
+
+
+class ChecksumsTest(ImageBackupTestCase):
+
+	def _checksummed(self, imagename: str, configure=None) -> str:
+		backup = self._backup(imagename)
+		backup.set_checksums(["sha256"])
+		if configure is not None:
+			configure(backup)
+		self.assertEqual(backup.start_native(), 0)
+		return join(self.tmp, imagename)
+
+	def _sha256(self, path: str) -> str:
+		return hashlib.sha256(self._read(path)).hexdigest()
+
+	def test_plain(self):
+		image = self._checksummed("plain.img")
+		self.assertEqual(read_checksums(image), {"sha256": self._sha256(image)})
+		self.assertFalse(os.path.isfile(source_checksum_path(image)))
+
+	def test_compressed(self):
+		image = self._checksummed("image.gz", lambda b: b.set_compression("gz"))
+		self.assertFalse(os.path.isfile(checksum_path(image)))
+		self.assertEqual(read_checksums(image, True), {"sha256": self._sha256(self.source)})
+		with open(source_checksum_path(image), "r") as f:
+			self.assertIn(self.source, f.read())
+
+	def test_chunkstore(self):
+		store = ChunkStore(join(self.tmp, "store"))
+		image = self._checksummed("image.recipe", lambda b: b.set_chunkstore(store))
+		self.assertFalse(os.path.isfile(checksum_path(image)))
+		self.assertEqual(read_checksums(image, True), {"sha256": self._sha256(self.source)})
+
+	def test_incremental(self):
+		full = self._checksummed("full.img", lambda b: b.set_incremental(True, block_size="64K"))
+		self.assertEqual(read_checksums(full), {"sha256": self._sha256(full)})
+		self.data[0:100] = os.urandom(100)
+		self._write_source()
+		delta = self._checksummed("delta.img", lambda b: b.set_incremental(True, full))
+		self.assertEqual(read_checksums(delta, True), {"sha256": self._sha256(self.source)})
+		patch = self._checksummed("patch.img", lambda b: b.set_incremental(True, delta, INCREMENTAL_MODE_PATCH))
+		self.assertEqual(read_checksums(patch), {"sha256": self._sha256(patch)})
+		self.assertEqual(self._sha256(patch), self._sha256(self.source))
+
+	def test_stale_sidecar_removed(self):
+		image = self._checksummed("image.img")
+		self._checksummed("image.img", lambda b: b.set_compression("gz"))
+		self.assertFalse(os.path.isfile(checksum_path(image)))
+		self._checksummed("image.img")
+		self.assertFalse(os.path.isfile(source_checksum_path(image)))
+		self.assertEqual(read_checksums(image), {"sha256": self._sha256(image)})
+
+
+class TuneBatchsizeTest(ImageBackupTestCase):
+
+	def _tuned(self, mode: str):
+		return mock.patch(
+			"fileutilslib.classes.ImageBackup.tuned_blocksize", return_value={"blocksize": 256 * _KiB, "mode": mode}
+		)
+
+	def test_apply_io_mode(self):
+		backup = self._backup("image.img")
+		with self._tuned(IO_MODE_DIRECT):
+			self.assertEqual(backup.tune_batchsize(), "256K")
+			self.assertFalse(backup.is_direct_io())
+			backup.tune_batchsize(apply_io_mode=True)
+			self.assertTrue(backup.is_direct_io())
+		with self._tuned(IO_MODE_BUFFERED):
+			backup.tune_batchsize(apply_io_mode=True)
+			self.assertFalse(backup.is_direct_io())
+
+	def test_only_plain_copies(self):
+		backup = self._backup("image.gz")
+		backup.set_compression("gz")
+		with self._tuned(IO_MODE_DIRECT):
+			backup.tune_batchsize(apply_io_mode=True)
+		self.assertFalse(backup.is_direct_io())
+
+	def test_auto_native(self):
+		backup = self._backup("image.img")
+		with self._tuned(IO_MODE_DIRECT):
+			self.assertEqual(backup.start_dd(ddbatchsize="auto", native=True, confirm=False), 0)
+		self.assertTrue(backup.is_direct_io())
+		self.assertEqual(self._read(join(self.tmp, "image.img")), self.data)
+
+
+class IoPriorityTest(ImageBackupTestCase):
+
+	def test_failed_reset_keeps_result(self):
+		backup = self._backup("image.img")
+		backup.set_io_priority("idle")
+
+		def ioprio_set(ioclass, level=4):
+			if ioclass != 3:
+				raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+		with mock.patch("fileutilslib.classes.ImageBackup.ioprio_get", return_value=(0, 4)), \
+			mock.patch("fileutilslib.classes.ImageBackup.ioprio_set", side_effect=ioprio_set) as set_mock:
+			self.assertEqual(backup.start_native(), 0)
+		self.assertEqual([c.args for c in set_mock.call_args_list], [(3, 4), (0, 4)])
+		self.assertEqual(self._read(join(self.tmp, "image.img")), self.data)
+
+
+class DeltaRestoreTest(ImageBackupTestCase):
+
+	def setUp(self):
+		super().setUp()
+		full = self._backup("full.img")
+		full.set_incremental(True, block_size="64K")
+		self.assertEqual(full.start_native(), 0)
+		self.data[100 * _KiB:200 * _KiB] = os.urandom(100 * _KiB)
+		self._write_source()
+		self.backup = self._backup("delta.img")
+		self.backup.set_incremental(True, join(self.tmp, "full.img"))
+		self.assertEqual(self.backup.start_native(), 0)
+		self.target = join(self.tmp, "restored.img")
+
+	def test_progress(self):
+		events = []
+		result = self.backup.restore(self.target, confirm=False, progress_handler=events.append)
+		self.assertEqual(result["size_b"], len(self.data))
+		self.assertEqual(self._read(self.target), self.data)
+		self.assertEqual(events[-1].type, ProgressEventType.FINISHED)
+		total = rebuild_total_b(join(self.tmp, "delta.img"))
+		self.assertEqual((events[-1].done_b, events[-1].total_b), (total, total))
+
+	def test_rate_limit(self):
+		self.backup.set_rate_limit("4M", "256K")
+		start = perf_counter()
+		self.backup.restore(self.target, ddbatchsize="64K", confirm=False)
+		# About 2.2 MiB at 4 MiB/s
+		self.assertGreater(perf_counter() - start, 0.4)
+
+	def test_cancel(self):
+		# Also wakes the rate limiter, which would take a few seconds otherwise
+		self.backup.set_rate_limit("512K", "64K")
+		timer = Timer(0.2, self.backup.cancel)
+		timer.start()
+		start = perf_counter()
+		try:
+			self.assertIsNone(self.backup.restore(self.target, ddbatchsize="64K", confirm=False))
+		finally:
+			timer.cancel()
+		self.assertLess(perf_counter() - start, 2)
+
+
+if __name__ == "__main__":
+	unittest.main()
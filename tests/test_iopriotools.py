@@ -0,0 +1,56 @@
+import threading
+import unittest
+from unittest import mock
+from fileutilslib.disklib import iopriotools
+from fileutilslib.disklib.iopriotools import ioprio_get, ioprio_set, IOPRIO_CLASS_NONE, IOPRIO_CLASS_BE, \
+	IOPRIO_CLASS_IDLE, IOPRIO_WHO_PROCESS
+
+
+def _in_thread(fn):
+	# The priority is kept per thread, so the test runner keeps its own
+	result = []
+
+	def run():
+		try:
+			result.append(fn())
+		except BaseException as e:
+			result.append(e)
+	t = threading.Thread(target=run)
+	t.start()
+	t.join()
+	if isinstance(result[0], BaseException):
+		raise result[0]
+	return result[0]
+
+
+class IoprioSetTest(unittest.TestCase):
+
+	def test_levels_of_classes_without_levels(self):
+		with mock.patch.object(iopriotools, "_syscall") as syscall:
+			ioprio_set(IOPRIO_CLASS_NONE, 4)
+			ioprio_set("idle", 7)
+			ioprio_set("best-effort", 6)
+		self.assertEqual([c.args for c in syscall.call_args_list], [
+			(0, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_NONE << 13),
+			(0, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << 13),
+			(0, IOPRIO_WHO_PROCESS, 0, (IOPRIO_CLASS_BE << 13) | 6)
+		])
+
+	def test_restore_previous(self):
+		try:
+			previous = ioprio_get()
+		except Exception as e:
+			self.skipTest(str(e))
+
+		def roundtrip():
+			ioprio_set(IOPRIO_CLASS_BE, 7)
+			changed = ioprio_get()
+			# What ioprio_get reported has to be accepted back, also (none, 4)
+			ioprio_set(*previous)
+			ioprio_set(IOPRIO_CLASS_NONE, 4)
+			return changed
+		self.assertEqual(_in_thread(roundtrip), (IOPRIO_CLASS_BE, 7))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from fileutilslib.disklib.journaltools import copy_path_resumable, journal_path, load_journal, JOURNAL_SEGMENTS
+
+_SEGMENT = 1024 * 1024
+
+
+class _Interrupt(Exception):
+	pass
+
+
+class CopyPathResumableTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.source = join(self.tmp, "source.bin")
+		self.target = join(self.tmp, "target.img")
+		self.data = os.urandom(10 * _SEGMENT)
+		with open(self.source, "wb") as f:
+			f.write(self.data)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def _copy(self, resume: bool = False, interrupt_at: int = None) -> int:
+		def progress(copied, total):
+			if interrupt_at is not None and copied > interrupt_at:
+				raise _Interrupt()
+		return copy_path_resumable(self.source, self.target, "64K", _SEGMENT, resume, progress)
+
+	def _interrupt_after(self, segments: int) -> None:
+		# Stops in the segment after the last committed one, like a pulled cable
+		with self.assertRaises(_Interrupt):
+			self._copy(interrupt_at=segments * _SEGMENT)
+		self.assertEqual(load_journal(self.target)["offset"], segments * _SEGMENT)
+
+	def _swap_source(self, keep_mtime: bool) -> bytes:
+		st = os.stat(self.source)
+		data = os.urandom(len(self.data))
+		with open(self.source, "r+b") as f:
+			f.write(data)
+		if keep_mtime:
+			os.utime(self.source, ns=(st.st_atime_ns, st.st_mtime_ns))
+		return data
+
+	def _target(self) -> bytes:
+		with open(self.target, "rb") as f:
+			return f.read()
+
+	def test_resume(self):
+		self._interrupt_after(4)
+		starts = []
+		copy_path_resumable(
+			self.source, self.target, "64K", _SEGMENT, True, lambda copied, total: starts.append(copied)
+		)
+		# The committed prefix isn't copied again
+		self.assertGreater(starts[0], 4 * _SEGMENT)
+		self.assertEqual(self._target(), self.data)
+		self.assertIsNone(load_journal(self.target))
+
+	def test_journal_keeps_last_segments(self):
+		self._interrupt_after(8)
+		with open(journal_path(self.target), "r") as f:
+			segments = json.load(f)["segments"]
+		self.assertEqual(len(segments), JOURNAL_SEGMENTS)
+		self.assertEqual(segments[-1][1], 8 * _SEGMENT)
+
+	def test_resume_after_modified_target(self):
+		self._interrupt_after(4)
+		with open(self.target, "r+b") as f:
+			f.seek(3 * _SEGMENT + 100)
+			f.write(b"x")
+		self.assertEqual(self._copy(resume=True), len(self.data))
+		self.assertEqual(self._target(), self.data)
+
+	def test_swapped_source(self):
+		self._interrupt_after(4)
+		data = self._swap_source(False)
+		self._copy(resume=True)
+		self.assertEqual(self._target(), data)
+
+	def test_swapped_source_same_identity(self):
+		# A disk without serial that comes back under the same name looks like this
+		self._interrupt_after(4)
+		data = self._swap_source(True)
+		self._copy(resume=True)
+		self.assertEqual(self._target(), data)
+
+
+if __name__ == "__main__":
+	unittest.main()
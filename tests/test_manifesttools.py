@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from fileutilslib.disklib.manifesttools import create_incremental, rebuild_image, rebuild_total_b, image_chain, \
+	INCREMENTAL_MODE_DELTA, INCREMENTAL_MODE_PATCH
+
+_BLOCK = 64 * 1024
+
+
+class IncrementalChainTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.source = join(self.tmp, "source.bin")
+		self.data = bytearray(os.urandom(20 * _BLOCK + 1000))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def _change(self, *blocks: int) -> bytes:
+		for index in blocks:
+			self.data[index * _BLOCK:index * _BLOCK + 100] = os.urandom(100)
+		with open(self.source, "wb") as f:
+			f.write(self.data)
+		return bytes(self.data)
+
+	def _rebuilt(self, imagepath: str) -> bytes:
+		target = join(self.tmp, "rebuilt.img")
+		rebuild_image(imagepath, target)
+		with open(target, "rb") as f:
+			return f.read()
+
+	def _image(self, name: str, base: str = None, mode: str = INCREMENTAL_MODE_DELTA) -> str:
+		imagepath = join(self.tmp, name)
+		create_incremental(self.source, imagepath, base, mode, _BLOCK)
+		return imagepath
+
+	def test_full_delta_patch_delta(self):
+		states = [self._change()]
+		full = self._image("full.img")
+		states.append(self._change(1, 7))
+		delta1 = self._image("delta1.img", full)
+		# The patch image on top of a delta has to hold the whole device, not just the delta's blocks
+		states.append(self._change(3, 20))
+		patch = self._image("patch.img", delta1, INCREMENTAL_MODE_PATCH)
+		states.append(self._change(0, 7))
+		delta2 = self._image("delta2.img", patch)
+
+		self.assertEqual(image_chain(delta2), [patch, delta2])
+		for (imagepath, expected) in zip([full, delta1, patch, delta2], states):
+			self.assertEqual(self._rebuilt(imagepath), expected)
+		with open(patch, "rb") as f:
+			self.assertEqual(f.read(), states[2])
+
+	def test_rebuild_progress(self):
+		self._change()
+		full = self._image("full.img")
+		self._change(2, 5, 20)
+		delta = self._image("delta.img", full)
+		# The last block is the short one
+		self.assertEqual(rebuild_total_b(delta), len(self.data) + 2 * _BLOCK + 1000)
+
+		reports = []
+		rebuild_image(
+			delta, join(self.tmp, "rebuilt.img"), blocksize="16K", progress_handler=lambda d, t: reports.append((d, t))
+		)
+		self.assertEqual(reports[-1], (rebuild_total_b(delta), rebuild_total_b(delta)))
+		self.assertEqual([d for (d, t) in reports], sorted(d for (d, t) in reports))
+
+	def test_rebuild_cancel(self):
+		self._change()
+		full = self._image("full.img")
+		self._change(3)
+		delta = self._image("delta.img", full)
+
+		def cancel(done, total):
+			if done > _BLOCK:
+				raise KeyboardInterrupt()
+		with self.assertRaises(KeyboardInterrupt):
+			rebuild_image(delta, join(self.tmp, "rebuilt.img"), blocksize="16K", progress_handler=cancel)
+
+
+if __name__ == "__main__":
+	unittest.main()
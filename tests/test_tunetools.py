@@ -0,0 +1,53 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+from fileutilslib.disklib import tunetools
+from fileutilslib.disklib.tunetools import benchmark_blocksizes, IO_MODE_BUFFERED, IO_MODE_DIRECT
+
+_MiB = 1024 * 1024
+
+
+class BenchmarkBlocksizesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.path = join(self.tmp, "sample.bin")
+		with open(self.path, "wb") as f:
+			f.write(os.urandom(8 * _MiB))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	@unittest.skipUnless(hasattr(os, "O_DIRECT"), "O_DIRECT is needed")
+	def test_unaligned_sample_offset(self):
+		if not tunetools._direct_io_supported(self.path):
+			self.skipTest("The filesystem doesn't support O_DIRECT")
+		results = benchmark_blocksizes(self.path, ["64K", "1M"], sample_size="2M", sample_offset=_MiB + 4097)
+		self.assertEqual(
+			[(r["mode"], r["blocksize"]) for r in results],
+			[(IO_MODE_BUFFERED, 64 * 1024), (IO_MODE_BUFFERED, _MiB), (IO_MODE_DIRECT, 64 * 1024), (IO_MODE_DIRECT, _MiB)]
+		)
+
+	def test_direct_unsupported(self):
+		def reject(path, flags, *args):
+			raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+		with mock.patch.object(tunetools.os, "open", side_effect=reject):
+			self.assertFalse(tunetools._direct_io_supported(self.path))
+		with mock.patch.object(tunetools, "_direct_io_supported", return_value=False):
+			results = benchmark_blocksizes(self.path, ["1M"], sample_size="1M")
+		self.assertEqual([r["mode"] for r in results], [IO_MODE_BUFFERED])
+
+	def test_read_errors_are_raised(self):
+		def fail(*args):
+			raise OSError(errno.EIO, os.strerror(errno.EIO))
+		with mock.patch.object(tunetools, "_bench_read", side_effect=fail):
+			with self.assertRaises(OSError):
+				benchmark_blocksizes(self.path, ["1M"], [IO_MODE_DIRECT], sample_size="1M")
+
+
+if __name__ == "__main__":
+	unittest.main()